@@ -0,0 +1,240 @@
+"""
+Benchmarks of the transfer stack against the in-process stand-in server.
+
+Measures DataManager.getJobs on large listings, end-to-end
+DataManager.download throughput and the connections opened. Results are
+written as json and can be compared with a previous run:
+
+    PYTHONPATH=src python benchmarks/bench.py --output new.json --baseline old.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import logging as log
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ftpserver import StandInFTPServer
+from automatization.datamanager import FTPManager, EcmwfInput, DataManager
+from automatization.asyncftp import AsyncFTPManager
+
+
+BACKENDS = {"sync": FTPManager, "async": AsyncFTPManager}
+
+# metric name to True when bigger is better
+METRICS = {
+    "first_poll_s": False,
+    "idle_poll_s": False,
+    "changed_poll_s": False,
+    "elapsed_s": False,
+    "throughput_mib_s": True,
+    "connections": False,
+}
+
+
+def bench_getjobs(entries, backend, latency):
+    """
+    Time getJobs on a listing of the given size
+
+    Arguments
+    ---------
+    entries: int
+        files in the remote directory
+    backend: str
+        sync or async
+    latency: float
+        seconds added to every control reply
+
+    Return
+    ------
+    result: dict
+    """
+    server = StandInFTPServer(_latency=latency).start()
+    localdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        server.populate("/remote", entries // 8, 1)
+        ftp = BACKENDS[backend]("127.0.0.1", "bench", "bench", _port=server.port)
+        site = EcmwfInput("bench", "getJobs benchmark", "/remote", localdir + "/YEAR/MONTH/DAY/")
+        manager = DataManager(ftp, site, _settle_time=0)
+
+        started = time.perf_counter()
+        done_jobs, _ = manager.getJobs()
+        first = time.perf_counter() - started
+
+        started = time.perf_counter()
+        manager.getJobs()
+        idle = time.perf_counter() - started
+
+        # one new day appears
+        server.populate("/remote", 1, 1, start=datetime.date(2050, 1, 1))
+        started = time.perf_counter()
+        manager.getJobs()
+        changed = time.perf_counter() - started
+
+        ftp.close()
+        return {
+            "entries": entries,
+            "days": len(done_jobs),
+            "first_poll_s": first,
+            "idle_poll_s": idle,
+            "changed_poll_s": changed,
+            "connections": server.counters.get("connections", 0),
+        }
+    finally:
+        server.stop()
+        shutil.rmtree(localdir, ignore_errors=True)
+
+
+def bench_download(days, file_size, workers, segments, backend, latency, bandwidth):
+    """
+    Time a complete DataManager.download cycle
+
+    Arguments
+    ---------
+    days: int
+        complete days on the server
+    file_size: int
+        bytes of each file
+    workers: int
+        DataManager workers
+    segments: int
+        DataManager segments per file
+    backend: str
+        sync or async
+    latency: float
+        seconds added to every control reply
+    bandwidth: int
+        bytes per second cap of each data connection, 0 for none
+
+    Return
+    ------
+    result: dict
+    """
+    server = StandInFTPServer(_latency=latency, _bandwidth=bandwidth).start()
+    localdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        server.populate("/remote", days, file_size, start=datetime.date(2014, 5, 10))
+        ftp = BACKENDS[backend]("127.0.0.1", "bench", "bench", _port=server.port,
+                                _max_sessions=max(workers, segments), _min_segment=1024 * 1024)
+        site = EcmwfInput("bench", "download benchmark", "/remote", localdir + "/YEAR/MONTH/DAY/")
+        manager = DataManager(ftp, site, _workers=workers, _segments=segments, _settle_time=0)
+
+        started = time.perf_counter()
+        manager.download()
+        elapsed = time.perf_counter() - started
+
+        ftp.close()
+        total = days * 8 * file_size
+        left = len(server.list_dir("/remote"))
+        if left:
+            raise Exception("%d files were not transferred" % left)
+
+        return {
+            "days": days,
+            "file_size": file_size,
+            "workers": workers,
+            "segments": segments,
+            "elapsed_s": elapsed,
+            "throughput_mib_s": total / elapsed / 1024 / 1024,
+            "connections": server.counters.get("connections", 0),
+            "commands": sum(v for k, v in server.counters.items() if k.isupper()),
+        }
+    finally:
+        server.stop()
+        shutil.rmtree(localdir, ignore_errors=True)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the change of every metric against a previous run
+
+    Return
+    ------
+    regressions: list of str
+        metrics worse than the tolerance
+    """
+    regressions = []
+    for name, result in sorted(results["results"].items()):
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+
+        for metric, bigger_better in METRICS.items():
+            if metric not in result or not previous.get(metric):
+                continue
+
+            change = (result[metric] - previous[metric]) / float(previous[metric])
+            worse = -change if bigger_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  REGRESSION"
+                regressions.append("%s.%s" % (name, metric))
+            print("%-40s %-18s %12.4f -> %12.4f (%+.1f%%)%s" %
+                  (name, metric, previous[metric], result[metric], change * 100, flag))
+
+    return regressions
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ecmwf-tools transfer benchmarks")
+    parser.add_argument("--output", default="bench_output.json", help="json file for the results")
+    parser.add_argument("--baseline", help="previous results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change counted as regression")
+    parser.add_argument("--backend", default="sync", choices=sorted(BACKENDS))
+    parser.add_argument("--listing", type=int_list, default=[10000, 100000], help="listing sizes for getJobs")
+    parser.add_argument("--days", type=int, default=2, help="days transferred by the download benchmark")
+    parser.add_argument("--file-size", type=int, default=8 * 1024 * 1024, help="bytes of each file")
+    parser.add_argument("--workers", type=int_list, default=[1, 4], help="DataManager workers to try")
+    parser.add_argument("--segments", type=int_list, default=[1, 4], help="segments per file to try")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each control reply")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes per second cap of each data connection")
+    args = parser.parse_args()
+
+    log.getLogger().setLevel(log.WARNING)
+
+    results = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": {},
+    }
+
+    for entries in args.listing:
+        name = "getjobs_%s_%d" % (args.backend, entries)
+        results["results"][name] = bench_getjobs(entries, args.backend, args.latency)
+        print("%-40s %s" % (name, results["results"][name]))
+
+    for workers in args.workers:
+        for segments in args.segments:
+            name = "download_%s_w%d_s%d" % (args.backend, workers, segments)
+            results["results"][name] = bench_download(args.days, args.file_size, workers, segments,
+                                                      args.backend, args.latency, args.bandwidth)
+            print("%-40s %s" % (name, results["results"][name]))
+
+    with open(args.output, "w") as outfile:
+        json.dump(results, outfile, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""
+In-process stand-in FTP server.
+
+It serves a synthetic in-memory tree so the transfer stack can be measured
+without a real remote site. Only the commands used by automatization are
+implemented.
+"""
+
+import time
+import socket
+import datetime
+import threading
+import socketserver
+
+
+def synthetic_chunk(name, offset, length):
+    """
+    Deterministic content for a synthetic file
+
+    Arguments
+    ---------
+    name: str
+        file name, seeds the byte pattern
+    offset: int
+        first byte to generate
+    length: int
+        amount of bytes
+
+    Return
+    ------
+    data: bytes
+    """
+    seed = sum(name.encode("utf-8")) % 251
+    block = bytes((seed + i) % 256 for i in range(256))
+    start = offset % 256
+    reps = (start + length) // 256 + 1
+    return (block * reps)[start:start + length]
+
+
+class VirtualFile(object):
+    """
+    File stored by the stand-in server. Either real bytes or a synthetic size.
+    """
+
+    def __init__(self, _name, _size=0, _data=None, _mtime=None):
+        self.name = _name
+        self.data = _data
+        self.size = len(_data) if _data is not None else _size
+        self.mtime = _mtime or time.time()
+
+    def read(self, offset, length):
+        length = max(0, min(length, self.size - offset))
+        if self.data is not None:
+            return self.data[offset:offset + length]
+        return synthetic_chunk(self.name, offset, length)
+
+
+class FTPHandler(socketserver.StreamRequestHandler):
+    """
+    One control connection
+    """
+
+    def reply(self, line):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write((line + "\r\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        self.server.count("connections")
+        self.cwd = "/"
+        self.rest = 0
+        self.pasv = None
+        self.reply("220 stand-in ftp ready")
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            line = line.decode("utf-8").rstrip("\r\n")
+            cmd, _, arg = line.partition(" ")
+            cmd = cmd.upper()
+            self.server.count(cmd)
+            method = getattr(self, "ftp_" + cmd, None)
+            if method is None:
+                self.reply("502 command not implemented")
+                continue
+            try:
+                if method(arg) is False:
+                    break
+            except (ConnectionError, socket.timeout):
+                break
+        self.close_pasv()
+
+    # ------------------------------------------------------------------ utils
+
+    def resolve(self, arg):
+        if not arg:
+            return self.cwd
+        path = arg if arg.startswith("/") else self.cwd.rstrip("/") + "/" + arg
+        parts = []
+        for part in path.split("/"):
+            if part in ("", "."):
+                continue
+            if part == "..":
+                if parts:
+                    parts.pop()
+                continue
+            parts.append(part)
+        return "/" + "/".join(parts)
+
+    def close_pasv(self):
+        if self.pasv is not None:
+            self.pasv.close()
+            self.pasv = None
+
+    def open_data(self):
+        if self.pasv is None:
+            self.reply("425 use PASV first")
+            return None
+        self.pasv.settimeout(10)
+        try:
+            conn, _ = self.pasv.accept()
+        finally:
+            self.close_pasv()
+        return conn
+
+    def send_data(self, conn, payload):
+        rate = self.server.bandwidth
+        chunk = 64 * 1024
+        sent = 0
+        started = time.time()
+        for position in range(0, len(payload), chunk):
+            conn.sendall(payload[position:position + chunk])
+            sent += len(payload[position:position + chunk])
+            if rate:
+                ahead = sent / float(rate) - (time.time() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    # --------------------------------------------------------------- commands
+
+    def ftp_USER(self, arg):
+        self.reply("331 password required")
+
+    def ftp_PASS(self, arg):
+        self.reply("230 logged in")
+
+    def ftp_SYST(self, arg):
+        self.reply("215 UNIX Type: L8")
+
+    def ftp_FEAT(self, arg):
+        self.wfile.write(b"211-Features:\r\n MLSD\r\n SIZE\r\n MDTM\r\n REST STREAM\r\n")
+        self.reply("211 End")
+
+    def ftp_OPTS(self, arg):
+        self.reply("200 ok")
+
+    def ftp_TYPE(self, arg):
+        self.reply("200 type set")
+
+    def ftp_NOOP(self, arg):
+        self.reply("200 noop ok")
+
+    def ftp_PWD(self, arg):
+        self.reply('257 "%s" is current directory' % self.cwd)
+
+    def ftp_CWD(self, arg):
+        path = self.resolve(arg)
+        if not self.server.is_dir(path):
+            self.reply("550 no such directory")
+            return
+        self.cwd = path
+        self.reply("250 directory changed")
+
+    def ftp_PASV(self, arg):
+        self.close_pasv()
+        self.pasv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.pasv.bind((self.server.server_address[0], 0))
+        self.pasv.listen(1)
+        host, port = self.pasv.getsockname()
+        self.reply("227 Entering Passive Mode (%s,%d,%d)" %
+                   (host.replace(".", ","), port >> 8, port & 0xff))
+
+    def ftp_EPSV(self, arg):
+        self.close_pasv()
+        self.pasv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.pasv.bind((self.server.server_address[0], 0))
+        self.pasv.listen(1)
+        self.reply("229 Entering Extended Passive Mode (|||%d|)" % self.pasv.getsockname()[1])
+
+    def ftp_REST(self, arg):
+        self.rest = int(arg)
+        self.reply("350 restarting at %d" % self.rest)
+
+    def ftp_SIZE(self, arg):
+        entry = self.server.get_file(self.resolve(arg))
+        if entry is None:
+            self.reply("550 no such file")
+            return
+        self.reply("213 %d" % entry.size)
+
+    def ftp_MDTM(self, arg):
+        entry = self.server.get_file(self.resolve(arg))
+        if entry is None:
+            self.reply("550 no such file")
+            return
+        self.reply("213 %s" % time.strftime("%Y%m%d%H%M%S", time.gmtime(entry.mtime)))
+
+    def listing(self, arg, formatter):
+        path = self.resolve(arg)
+        entries = self.server.list_dir(path)
+        if entries is None:
+            self.reply("550 no such directory")
+            return
+        self.reply("150 opening data connection")
+        conn = self.open_data()
+        if conn is None:
+            return
+        payload = "".join(formatter(e) for e in entries).encode("utf-8")
+        with conn:
+            self.send_data(conn, payload)
+        self.reply("226 transfer complete")
+
+    def ftp_NLST(self, arg):
+        self.listing(arg, lambda e: e.name + "\r\n")
+
+    def ftp_LIST(self, arg):
+        def fmt(e):
+            stamp = time.strftime("%b %d %H:%M", time.gmtime(e.mtime))
+            return "-rw-r--r--    1 ftp      ftp      %12d %s %s\r\n" % (e.size, stamp, e.name)
+        self.listing(arg, fmt)
+
+    def ftp_MLSD(self, arg):
+        if not self.server.mlsd:
+            self.reply("500 MLSD not understood")
+            return
+
+        def fmt(e):
+            stamp = time.strftime("%Y%m%d%H%M%S", time.gmtime(e.mtime))
+            return "type=file;size=%d;modify=%s; %s\r\n" % (e.size, stamp, e.name)
+        self.listing(arg, fmt)
+
+    def ftp_RETR(self, arg):
+        entry = self.server.get_file(self.resolve(arg))
+        rest, self.rest = self.rest, 0
+        if entry is None:
+            self.reply("550 no such file")
+            return
+        self.reply("150 opening data connection")
+        conn = self.open_data()
+        if conn is None:
+            return
+        self.server.count("bytes", entry.size - rest)
+        try:
+            with conn:
+                position = rest
+                rate = self.server.bandwidth
+                started = time.time()
+                while position < entry.size:
+                    chunk = entry.read(position, 256 * 1024)
+                    conn.sendall(chunk)
+                    position += len(chunk)
+                    if rate:
+                        ahead = (position - rest) / float(rate) - (time.time() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+        except (ConnectionError, socket.timeout):
+            self.reply("426 connection closed; transfer aborted")
+            return
+        self.reply("226 transfer complete")
+
+    def ftp_ABOR(self, arg):
+        self.reply("226 abort ok")
+
+    def ftp_DELE(self, arg):
+        if not self.server.remove_file(self.resolve(arg)):
+            self.reply("550 no such file")
+            return
+        self.reply("250 file deleted")
+
+    def ftp_QUIT(self, arg):
+        self.reply("221 bye")
+        return False
+
+
+class StandInFTPServer(socketserver.ThreadingTCPServer):
+    """
+    Threaded FTP server over an in-memory tree
+
+    Arguments
+    ---------
+    _latency: float
+        seconds slept before every control reply
+    _bandwidth: int
+        bytes per second cap for each data connection (0 means unlimited)
+    _mlsd: bool
+        advertise and answer MLSD
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, _host="127.0.0.1", _port=0, _latency=0.0, _bandwidth=0, _mlsd=True):
+        socketserver.ThreadingTCPServer.__init__(self, (_host, _port), FTPHandler)
+        self.latency = _latency
+        self.bandwidth = _bandwidth
+        self.mlsd = _mlsd
+        self.tree = {"/": {}}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def is_dir(self, path):
+        with self.lock:
+            return path in self.tree
+
+    def list_dir(self, path):
+        with self.lock:
+            folder = self.tree.get(path)
+            return None if folder is None else list(folder.values())
+
+    def get_file(self, path):
+        folder, _, name = path.rpartition("/")
+        with self.lock:
+            return self.tree.get(folder or "/", {}).get(name)
+
+    def remove_file(self, path):
+        folder, _, name = path.rpartition("/")
+        with self.lock:
+            return self.tree.get(folder or "/", {}).pop(name, None) is not None
+
+    def add_file(self, path, size=0, data=None, mtime=None):
+        folder, _, name = path.rpartition("/")
+        folder = folder or "/"
+        with self.lock:
+            parts = [p for p in folder.split("/") if p]
+            for i in range(len(parts) + 1):
+                self.tree.setdefault("/" + "/".join(parts[:i]), {})
+            self.tree[folder][name] = VirtualFile(name, size, data, mtime)
+
+    def populate(self, path, days, file_size, start=None, steps=None, prefix="EN"):
+        """
+        Create a synthetic tree of complete days
+
+        Arguments
+        ---------
+        path: str
+            remote directory
+        days: int
+            amount of days, going forward from start
+        file_size: int
+            bytes of each file
+        start: datetime.date
+            first day, 1990-01-01 by default
+        steps: list of str
+            step suffixes, the 8 three hourly ones by default
+        prefix: str
+            file name prefix
+        """
+        start = start or datetime.date(1990, 1, 1)
+        steps = steps or ["00", "03", "06", "09", "12", "15", "18", "21"]
+        mtime = time.time() - 3600
+
+        with self.lock:
+            parts = [p for p in path.split("/") if p]
+            for i in range(len(parts) + 1):
+                self.tree.setdefault("/" + "/".join(parts[:i]), {})
+            folder = self.tree[path]
+
+            for day in range(days):
+                datestr = (start + datetime.timedelta(days=day)).strftime("%y%m%d")
+                for step in steps:
+                    name = prefix + datestr + step
+                    folder[name] = VirtualFile(name, file_size, None, mtime)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,767 @@
+"""
+Asyncio implementation of the FTPManager interface.
+
+A single event loop keeps every control and data connection, so many sites
+can be served at the same time without one slow server blocking the others.
+
+Coroutines are named after the blocking methods with an "a" prefix
+(alist_files, adownload, adelete, ...). The blocking methods are kept with
+the same signatures as FTPManager, so DataManager can use this backend
+unchanged:
+
+    ftp = AsyncFTPManager("ftp.site.com", "user", "password")
+    dmsites = DataManager(ftp, sitesArgs, _workers=8)
+
+"""
+
+import os
+import re
+import time
+import asyncio
+import threading
+import logging as log
+
+from contextlib import asynccontextmanager
+from ftplib import error_perm, error_temp, error_reply, error_proto
+
+from automatization import metrics
+from automatization.datamanager import split_filepath, parse_list_line
+from automatization.diskio import publish
+
+
+class EventLoopThread(object):
+    """
+    Event loop running forever in a daemon thread
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name="asyncftp-loop", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro):
+        """
+        Run a coroutine on the loop and wait for its result
+
+        Arguments
+        ---------
+        coro: coroutine
+            work to run
+
+        Return
+        ------
+        result: object
+            value returned by the coroutine
+        """
+        if threading.current_thread() is self.thread:
+            raise Exception("Blocking call from the event loop thread, await the coroutine instead")
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+_shared_loop = None
+_shared_lock = threading.Lock()
+
+
+def shared_loop():
+    """
+    Event loop shared by every AsyncFTPManager not given its own one
+
+    Return
+    ------
+    loop_thread: EventLoopThread
+    """
+    global _shared_loop
+
+    with _shared_lock:
+        if _shared_loop is None:
+            _shared_loop = EventLoopThread()
+        return _shared_loop
+
+
+def raise_for_reply(code, text):
+    """
+    Map an FTP reply to the ftplib exceptions used by the blocking backend
+    """
+    if code.startswith("5"):
+        raise error_perm(text)
+    if code.startswith("4"):
+        raise error_temp(text)
+    raise error_reply(text)
+
+
+class AsyncFTPSession(object):
+    """
+    Logged in control connection
+    """
+
+    def __init__(self, _reader, _writer, _host, _timeout):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _reader: asyncio.StreamReader
+            control connection reader
+        _writer: asyncio.StreamWriter
+            control connection writer
+        _host: str
+            server address, also used for passive data connections
+        _timeout: int
+            seconds to wait for any reply
+        """
+        self.reader = _reader
+        self.writer = _writer
+        self.host = _host
+        self.timeout = _timeout
+        self.cwd = None
+        self.type = None
+        self.last_used = time.time()
+
+    async def getresp(self):
+        """
+        Read a complete, possibly multi line, reply
+
+        Return
+        ------
+        code: str
+            three digit reply code
+        text: str
+            whole reply
+        """
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line:
+            raise EOFError("Connection closed by server")
+
+        line = line.decode("utf-8", "replace").rstrip("\r\n")
+        code = line[:3]
+        lines = [line]
+
+        if line[3:4] == "-":
+            while True:
+                nextline = await asyncio.wait_for(self.reader.readline(), self.timeout)
+                if not nextline:
+                    raise EOFError("Connection closed by server")
+                nextline = nextline.decode("utf-8", "replace").rstrip("\r\n")
+                lines.append(nextline)
+                if nextline[:3] == code and nextline[3:4] != "-":
+                    break
+
+        return code, "\n".join(lines)
+
+    async def sendcmd(self, line, expected="2"):
+        """
+        Send a command and check its reply
+
+        Arguments
+        ---------
+        line: str
+            command line
+        expected: str
+            accepted leading digits of the reply code
+
+        Return
+        ------
+        text: str
+            whole reply
+        """
+        self.writer.write((line + "\r\n").encode("utf-8"))
+        await self.writer.drain()
+        code, text = await self.getresp()
+        if code[:1] not in expected:
+            raise_for_reply(code, text)
+
+        self.last_used = time.time()
+        return text
+
+    async def chdir(self, path):
+        """
+        Move to remote path only when it differs from the cached one
+        """
+        if path != self.cwd:
+            await self.sendcmd("CWD %s" % (path or "."))
+            self.cwd = path
+
+    async def settype(self, mode):
+        """
+        Change transfer type only when needed
+        """
+        if mode != self.type:
+            await self.sendcmd("TYPE %s" % mode)
+            self.type = mode
+
+    async def is_alive(self):
+        """
+        Health check sending a NOOP
+        """
+        try:
+            await self.sendcmd("NOOP")
+        except (OSError, EOFError, asyncio.TimeoutError, error_reply, error_temp, error_perm):
+            return False
+        return True
+
+    async def open_data(self, line, rest=None):
+        """
+        Open a passive data connection and start a transfer command
+
+        Arguments
+        ---------
+        line: str
+            transfer command, e.g. RETR name
+        rest: int
+            restart offset sent with REST
+
+        Return
+        ------
+        reader: asyncio.StreamReader
+        writer: asyncio.StreamWriter
+        """
+        try:
+            text = await self.sendcmd("EPSV")
+            match = re.search(r"\(\|\|\|(\d+)\|\)", text)
+            if not match:
+                raise error_proto(text)
+            port = int(match.group(1))
+        except error_perm:
+            text = await self.sendcmd("PASV")
+            match = re.search(r"(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)", text)
+            if not match:
+                raise error_proto(text)
+            numbers = [int(x) for x in match.groups()]
+            port = (numbers[4] << 8) + numbers[5]
+
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, port), self.timeout)
+        try:
+            if rest is not None:
+                await self.sendcmd("REST %s" % rest, expected="3")
+            await self.sendcmd(line, expected="1")
+        except:
+            writer.close()
+            raise
+
+        return reader, writer
+
+    async def close(self):
+        """
+        Quit politely, otherwise close the socket
+        """
+        try:
+            await asyncio.wait_for(self.sendcmd("QUIT"), 2)
+        except Exception:
+            pass
+        self.writer.close()
+
+
+class AsyncFTPManager(object):
+    """
+    FTP manager on asyncio. Sessions are pooled as in FTPManager.
+    """
+
+    def __init__(self, _address, _user, _password, _port=21, _max_sessions=4,
+                 _keepalive=30, _idle_timeout=300, _timeout=60,
+                 _blocksize=256 * 1024, _min_segment=8 * 1024 * 1024, _loop=None, _metrics=None):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _address: str
+            ftp host
+        _user: str
+            ftp user
+        _password: str
+            ftp password
+        _port: int
+            ftp port
+        _max_sessions: int
+            maximum simultaneous sessions opened against this host
+        _keepalive: int
+            seconds idle after which a session is checked with NOOP before reuse
+        _idle_timeout: int
+            seconds idle after which a session is closed
+        _timeout: int
+            seconds to wait for a reply or data
+        _blocksize: int
+            bytes read per call on data connections
+        _min_segment: int
+            smallest byte range worth its own connection
+        _loop: EventLoopThread
+            loop running the coroutines of the blocking methods, shared by default
+        _metrics: object MetricsRegistry
+            registry receiving timings, the shared one by default
+        """
+        if not _user:
+            raise Exception("user is not defined")
+
+        if not _password:
+            raise Exception("user is not defined")
+
+        if _max_sessions < 1:
+            raise Exception("At least one session is required")
+
+        self.address = _address
+        self.user = _user
+        self.pwd = _password
+        self.port = _port
+        self.max_sessions = _max_sessions
+        self.keepalive = _keepalive
+        self.idle_timeout = _idle_timeout
+        self.timeout = _timeout
+        self.blocksize = _blocksize
+        self.min_segment = _min_segment
+        self.loop = _loop
+        self.metrics = _metrics or metrics.REGISTRY
+
+        # switched off the first time the server refuses MLSD
+        self.mlsd = True
+
+        self.sessions = []
+        # created on first use, inside the running loop
+        self.slots = None
+
+    # ------------------------------------------------------------------ pool
+
+    async def _connect(self):
+        """
+        Open and log in a new session
+        """
+        with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="connect"):
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.address, self.port), self.timeout)
+        session = AsyncFTPSession(reader, writer, self.address, self.timeout)
+        try:
+            code, text = await session.getresp()
+            if not code.startswith("2"):
+                raise_for_reply(code, text)
+            with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="login"):
+                await session.sendcmd("USER %s" % self.user, expected="23")
+                await session.sendcmd("PASS %s" % self.pwd)
+        except:
+            writer.close()
+            raise
+
+        self.metrics.inc("ftp_connections_total", host=self.address)
+
+        log.debug("  New async FTP session to %s" % self.address)
+        return session
+
+    async def acquire(self):
+        """
+        Borrow a logged in session, waiting if the pool is exhausted
+
+        Return
+        ------
+        session: AsyncFTPSession
+        """
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_sessions)
+        await self.slots.acquire()
+
+        now = time.time()
+        while self.sessions:
+            session = self.sessions.pop()
+            if now - session.last_used > self.idle_timeout:
+                await session.close()
+                continue
+            if now - session.last_used > self.keepalive and not await session.is_alive():
+                await session.close()
+                continue
+            return session
+
+        try:
+            return await self._connect()
+        except:
+            self.slots.release()
+            raise
+
+    async def release(self, session, discard=False):
+        """
+        Give back a session to the pool
+
+        Arguments
+        ---------
+        session: AsyncFTPSession
+            session returned by acquire
+        discard: bool
+            close it instead, e.g. after a connection error
+        """
+        if discard:
+            await session.close()
+        else:
+            session.last_used = time.time()
+            self.sessions.append(session)
+        self.slots.release()
+
+    @asynccontextmanager
+    async def session(self, path=None):
+        """
+        Borrow a session for a block of commands
+
+        Arguments
+        ---------
+        path: str
+            remote directory to move to, if any
+        """
+        session = await self.acquire()
+        try:
+            await self._chdir(session, path)
+            yield session
+        except error_perm:
+            await self.release(session)
+            raise
+        except BaseException:
+            await self.release(session, discard=True)
+            raise
+        else:
+            await self.release(session)
+
+    async def _run(self, path, action, can_retry=None):
+        """
+        Run an action on a pooled session, reconnecting once if the
+        session was lost.
+        """
+        try:
+            async with self.session(path) as session:
+                return await action(session)
+        except error_perm:
+            raise
+        except (OSError, EOFError, asyncio.TimeoutError, error_reply, error_temp, error_proto):
+            if can_retry is not None and not can_retry():
+                raise
+            log.debug("  Async FTP session lost, retrying on a new one...")
+
+        async with self.session(path) as session:
+            return await action(session)
+
+    async def _chdir(self, session, path):
+        """
+        Change directory recording the time of real CWD commands
+        """
+        if path is not None and path != session.cwd:
+            with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="cwd"):
+                await session.chdir(path)
+
+    def _observe_transfer(self, received, elapsed):
+        """
+        Record the time and throughput of a transfer
+        """
+        self.metrics.observe("ftp_phase_seconds", elapsed, host=self.address, phase="retr")
+        self.metrics.inc("ftp_bytes_total", received, host=self.address)
+        if received and elapsed > 0:
+            self.metrics.observe("ftp_transfer_bytes_per_second", received / elapsed, host=self.address)
+
+    async def aclose(self):
+        """
+        Close every idle session
+        """
+        idle, self.sessions = self.sessions, []
+        for session in idle:
+            await session.close()
+
+    async def akeepalive_all(self):
+        """
+        Send NOOP on every idle session, dropping the dead or expired ones
+        """
+        now = time.time()
+        idle, self.sessions = self.sessions, []
+        for session in idle:
+            if now - session.last_used <= self.idle_timeout and await session.is_alive():
+                self.sessions.append(session)
+            else:
+                await session.close()
+
+    # ------------------------------------------------------------ operations
+
+    async def alist_files(self, path):
+        """
+        Get ftp listed files, see FTPManager.list_files
+        """
+        if not path:
+            raise Exception("path is not defined")
+
+        async def action(session):
+            await session.settype("A")
+            reader, writer = await session.open_data("NLST")
+            try:
+                data = await asyncio.wait_for(reader.read(), self.timeout)
+            finally:
+                writer.close()
+            code, text = await session.getresp()
+            if not code.startswith("2"):
+                raise_for_reply(code, text)
+            return [line for line in data.decode("utf-8", "replace").splitlines() if line]
+
+        with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="list"):
+            return await self._run(path, action)
+
+    async def alist_entries(self, path):
+        """
+        Get ftp listed files with their metadata, see FTPManager.list_entries
+        """
+        if not path:
+            raise Exception("path is not defined")
+
+        async def retrieve(session, command):
+            await session.settype("A")
+            reader, writer = await session.open_data(command)
+            try:
+                data = await asyncio.wait_for(reader.read(), self.timeout)
+            finally:
+                writer.close()
+            code, text = await session.getresp()
+            if not code.startswith("2"):
+                raise_for_reply(code, text)
+            return data.decode("utf-8", "replace").splitlines()
+
+        async def action(session):
+            entries = {}
+            if self.mlsd:
+                try:
+                    lines = await retrieve(session, "MLSD")
+                except error_perm:
+                    log.debug("  MLSD not supported by %s, using LIST" % self.address)
+                    self.mlsd = False
+                else:
+                    for line in lines:
+                        facts_str, _, name = line.partition(" ")
+                        facts = dict(fact.split("=", 1) for fact in facts_str.split(";") if "=" in fact)
+                        facts = dict((k.lower(), v) for k, v in facts.items())
+                        if name and facts.get("type", "file") == "file":
+                            entries[name] = (int(facts.get("size", -1)), facts.get("modify"))
+                    return entries
+
+            for line in await retrieve(session, "LIST"):
+                entry = parse_list_line(line)
+                if entry is not None:
+                    entries[entry[0]] = entry[1:]
+            return entries
+
+        with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="list"):
+            return await self._run(path, action)
+
+    async def adownload(self, remote_filepath, filepointer, rest=None, consumers=None):
+        """
+        Get data from ftp to local machine, see FTPManager.download
+        """
+        remote_filename, remote_path = split_filepath(remote_filepath)
+        written = [0]
+        consumers = consumers or []
+        # rate limits wait on the loop, the rest runs in a worker thread
+        throttles = [c for c in consumers if getattr(c, "reserve", None) is not None]
+        sinks = [c for c in consumers if getattr(c, "reserve", None) is None]
+
+        def sink(chunk):
+            filepointer.write(chunk)
+            for consumer in sinks:
+                consumer.update(chunk)
+
+        async def action(session):
+            loop = asyncio.get_running_loop()
+            await session.settype("I")
+            started = time.perf_counter()
+            reader, writer = await session.open_data("RETR %s" % remote_filename, rest=rest)
+            # disk writes and hashing of a chunk overlap the read of the next
+            # one, off the loop so a slow disk does not stall other transfers
+            writing = None
+            try:
+                while True:
+                    chunk = await asyncio.wait_for(reader.read(self.blocksize), self.timeout)
+                    if writing is not None:
+                        await writing
+                        writing = None
+                    if not chunk:
+                        break
+                    if not written[0]:
+                        self.metrics.observe("ftp_retr_first_byte_seconds", time.perf_counter() - started, host=self.address)
+                    written[0] += len(chunk)
+                    writing = loop.run_in_executor(None, sink, chunk)
+                    for throttle in throttles:
+                        delay = throttle.reserve(len(chunk))
+                        if delay:
+                            await asyncio.sleep(delay)
+            finally:
+                writer.close()
+                # the caller may close the file once we return
+                if writing is not None:
+                    await asyncio.wait([writing])
+            code, text = await session.getresp()
+            if not code.startswith("2"):
+                raise_for_reply(code, text)
+
+        began = time.perf_counter()
+        try:
+            # only repeat when nothing reached the file yet
+            await self._run(remote_path, action, can_retry=lambda: written[0] == 0)
+        finally:
+            self._observe_transfer(written[0], time.perf_counter() - began)
+
+    async def asize(self, remote_filepath):
+        """
+        Remote file size, see FTPManager.size
+        """
+        remote_filename, remote_path = split_filepath(remote_filepath)
+
+        async def action(session):
+            await session.settype("I")
+            text = await session.sendcmd("SIZE %s" % remote_filename)
+            return int(text[3:].strip())
+
+        with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="size"):
+            return await self._run(remote_path, action)
+
+    async def adelete(self, remote_filepath):
+        """
+        Delete file on ftp, see FTPManager.delete
+        """
+        remote_filename, remote_path = split_filepath(remote_filepath)
+
+        async def action(session):
+            await session.sendcmd("DELE %s" % remote_filename)
+
+        with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="dele"):
+            await self._run(remote_path, action)
+
+    async def adelete_many(self, remote_filepaths):
+        """
+        Delete a batch of files over one session, see FTPManager.delete_many
+        """
+        deleted = []
+        async with self.session() as session:
+            for remote_filepath in remote_filepaths:
+                remote_filename, remote_path = split_filepath(remote_filepath)
+                await self._chdir(session, remote_path)
+                try:
+                    with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="dele"):
+                        await session.sendcmd("DELE %s" % remote_filename)
+                except error_perm as e:
+                    log.warning("  Cannot delete %s: %s" % (remote_filepath, e))
+                    continue
+                deleted.append(remote_filepath)
+
+        return deleted
+
+    async def _adownload_range(self, remote_filepath, fd, offset, length, report=None, throttle=None):
+        """
+        Fetch a byte range on its own session into its offset of fd
+        """
+        remote_filename, remote_path = split_filepath(remote_filepath)
+        received = 0
+
+        async with self.session(remote_path) as session:
+            await session.settype("I")
+            reader, writer = await session.open_data("RETR %s" % remote_filename, rest=offset)
+            try:
+                while received < length:
+                    data = await asyncio.wait_for(reader.read(min(self.blocksize, length - received)), self.timeout)
+                    if not data:
+                        break
+                    await asyncio.get_running_loop().run_in_executor(None, os.pwrite, fd, data, offset + received)
+                    received += len(data)
+                    if report is not None:
+                        report(len(data))
+                    # rate limits wait without blocking the loop
+                    delay = throttle.reserve(len(data)) if throttle is not None else 0
+                    if delay:
+                        await asyncio.sleep(delay)
+            finally:
+                writer.close()
+
+            # an early close makes the server abort the transfer (426)
+            code, text = await session.getresp()
+            if code[:1] not in "245":
+                raise_for_reply(code, text)
+
+        if received != length:
+            raise Exception("Segment at %d of %s incomplete: %d of %d bytes" % (offset, remote_filepath, received, length))
+
+        return received
+
+    async def adownload_segmented(self, remote_filepath, local_filepath, segments=4, progress=None, fsync=None,
+                                  throttle=None):
+        """
+        Download a single file in parallel byte ranges, see
+        FTPManager.download_segmented
+        """
+        remote_filename, _ = split_filepath(remote_filepath)
+        size = await self.asize(remote_filepath)
+
+        segments = max(1, min(segments, self.max_sessions, size // self.min_segment or 1))
+        step = size // segments
+        ranges = [(i * step, step) for i in range(segments - 1)]
+        ranges.append(((segments - 1) * step, size - (segments - 1) * step))
+
+        received = [0]
+
+        def report(amount):
+            received[0] += amount
+            if progress is not None:
+                progress(remote_filename, received[0])
+
+        tmp_filepath = local_filepath + ".seg"
+        fd = os.open(tmp_filepath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if size:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(fd, 0, size)
+                else:
+                    os.ftruncate(fd, size)
+
+            began = time.perf_counter()
+            results = await asyncio.gather(*[self._adownload_range(remote_filepath, fd, offset, length, report, throttle)
+                                             for offset, length in ranges])
+            self._observe_transfer(sum(results), time.perf_counter() - began)
+
+            if sum(results) != size or os.fstat(fd).st_size != size:
+                raise Exception("Size mismatch for %s: %d of %d bytes" % (remote_filepath, sum(results), size))
+        except:
+            os.close(fd)
+            os.remove(tmp_filepath)
+            raise
+
+        os.close(fd)
+        publish(tmp_filepath, local_filepath, fsync)
+
+        return size
+
+    # ------------------------------------------------------ blocking interface
+
+    def _call(self, coro):
+        if self.loop is None:
+            self.loop = shared_loop()
+        return self.loop.run(coro)
+
+    def list_files(self, path):
+        return self._call(self.alist_files(path))
+
+    def list_entries(self, path):
+        return self._call(self.alist_entries(path))
+
+    def download(self, remote_filepath, filepointer, rest=None, consumers=None):
+        return self._call(self.adownload(remote_filepath, filepointer, rest, consumers))
+
+    def size(self, remote_filepath):
+        return self._call(self.asize(remote_filepath))
+
+    def delete(self, remote_filepath):
+        return self._call(self.adelete(remote_filepath))
+
+    def delete_many(self, remote_filepaths):
+        return self._call(self.adelete_many(remote_filepaths))
+
+    def download_segmented(self, remote_filepath, local_filepath, segments=4, progress=None, fsync=None,
+                           throttle=None):
+        return self._call(self.adownload_segmented(remote_filepath, local_filepath, segments, progress, fsync,
+                                                   throttle))
+
+    def keepalive_all(self):
+        return self._call(self.akeepalive_all())
+
+    def close(self):
+        return self._call(self.aclose())
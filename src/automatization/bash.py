@@ -1,22 +1,231 @@
+"""
+Run external commands, e.g. bucle_flexpart.sh on every downloaded day.
+
+ProcessRunner starts each command in its own working directory, from an
+argument list, streaming stdout and stderr line by line, with a timeout and
+a bound on the commands running at the same time, so it is safe from
+threads:
+
+    runner = ProcessRunner(_max_processes=4, _timeout=3600)
+    future = runner.submit(["./bucle_flexpart.sh", "20140510", "1", "8"],
+                           cwd="/flexpart", on_line=log.info)
+    future.result()
+
+"""
+
 import os
+import shlex
+import signal
+import threading
 import subprocess
+import logging as log
 
-def run_bash_cmd(path, bashCommand):
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ProcessResult(object):
     """
-    Run bash command
+    Outcome of a finished command
     """
 
-    # move to directory
-    if path:
-        print("Moving to %s..." % path)
-        os.chdir(path)
-    # bashCommand = "./bucle_flexpart.sh 20140510 1 8"
+    def __init__(self, _args, _returncode, _stdout, _stderr, _timed_out=False):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _args: list of str
+            command and its arguments
+        _returncode: int
+            exit code, negative when killed by a signal
+        _stdout: list of str
+            stdout lines, empty when streamed to a callback
+        _stderr: list of str
+            last stderr lines, empty when streamed to a callback
+        _timed_out: bool
+            killed after its timeout
+        """
+        self.args = _args
+        self.returncode = _returncode
+        self.stdout = _stdout
+        self.stderr = _stderr
+        self.timed_out = _timed_out
+
+    def output(self):
+        return "\n".join(self.stdout)
+
+
+class ProcessRunner(object):
+    """
+    Run commands with a concurrency limit and timeouts
+    """
+
+    # stderr lines kept for the error message when not streamed
+    STDERR_TAIL = 50
+
+    def __init__(self, _max_processes=4, _timeout=None):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _max_processes: int
+            commands running at the same time
+        _timeout: float
+            seconds after which a command is killed, None waits forever
+        """
+        if _max_processes < 1:
+            raise Exception("At least one process is required")
+
+        self.max_processes = _max_processes
+        self.timeout = _timeout
+        self.slots = threading.BoundedSemaphore(_max_processes)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def run(self, args, cwd=None, on_line=None, on_stderr=None, stdin=None, env=None, timeout=None, check=True):
+        """
+        Run a command, waiting for a free process slot
+
+        Arguments
+        ---------
+        args: list of str
+            command and its arguments, no shell is involved
+        cwd: str
+            working directory of the command, the current one by default
+        on_line: callable
+            called with every stdout line, without the line end, as soon as
+            it is read
+        on_stderr: callable
+            same for stderr
+        stdin: file object
+            standard input of the command
+        env: dict
+            environment of the command, the current one by default
+        timeout: float
+            seconds before the command is killed, the runner one by default
+        check: bool
+            raise when the command times out or fails
+
+        Return
+        ------
+        result: object ProcessResult
+        """
+        if isinstance(args, str):
+            raise Exception("Arguments must be a list, see shlex.split")
 
-    print("Running %s..." % bashCommand)
-    # run command line
-    process = subprocess.Popen(bashCommand.split(), stdout=subprocess.PIPE)
-    output_byte = process.communicate()[0]
+        timeout = self.timeout if timeout is None else timeout
+        stdout = []
+        on_line = on_line or stdout.append
+        stderr = deque(maxlen=self.STDERR_TAIL)
+        on_stderr = on_stderr or stderr.append
 
-    output_str = output_byte.decode("utf-8")
+        with self.slots:
+            log.debug("Running %s in %s..." % (" ".join(args), cwd or os.getcwd()))
+            process = subprocess.Popen(args, cwd=cwd, env=env, stdin=stdin, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, universal_newlines=True, start_new_session=True)
+            expired = []
+
+            def kill():
+                expired.append(True)
+                # scripts leave children holding the pipes, kill the group
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+            def read_stderr():
+                for line in process.stderr:
+                    on_stderr(line.rstrip("\n"))
+
+            # both pipes are read at once so neither fills up
+            reader = threading.Thread(target=read_stderr, daemon=True)
+            reader.start()
+            # reading stdout blocks, the timer kills a hanging command
+            timer = threading.Timer(timeout, kill) if timeout else None
+            if timer is not None:
+                timer.start()
+            try:
+                for line in process.stdout:
+                    on_line(line.rstrip("\n"))
+                reader.join()
+                code = process.wait()
+            except:
+                kill()
+                process.wait()
+                raise
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                process.stdout.close()
+                process.stderr.close()
+
+        result = ProcessResult(args, code, stdout, list(stderr), bool(expired))
+
+        if check and result.timed_out:
+            raise Exception("%s timed out after %ds" % (args[0], timeout))
+
+        if check and code != 0:
+            raise Exception("%s failed with code %d: %s" % (args[0], code, "\n".join(result.stderr).strip()))
+
+        return result
+
+    def submit(self, args, **kwargs):
+        """
+        Run a command in the runner threads, see run for the arguments
+
+        Return
+        ------
+        future: concurrent.futures.Future
+            its result is the ProcessResult
+        """
+        return self.submit_call(self.run, args, **kwargs)
+
+    def submit_call(self, function, *args, **kwargs):
+        """
+        Run a function in the runner threads
+
+        Return
+        ------
+        future: concurrent.futures.Future
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_processes, thread_name_prefix="process")
+        return self.executor.submit(function, *args, **kwargs)
+
+    def close(self):
+        """
+        Wait for the submitted commands
+        """
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+def run_bash_cmd(path, bashCommand):
+    """
+    Run bash command
+
+    Arguments
+    ---------
+    path: str
+        working directory of the command
+    bashCommand: str
+        command line, split as the shell does
+
+    Return
+    ------
+    output: str
+        stdout of the command, its stderr is logged as warnings
+    """
+    # bashCommand = "./bucle_flexpart.sh 20140510 1 8"
+    log.info("Running %s..." % bashCommand)
+    result = ProcessRunner(_max_processes=1).run(shlex.split(bashCommand), cwd=path or None,
+                                                 on_stderr=log.warning, check=False)
+    if result.returncode != 0:
+        log.warning("%s failed with code %d" % (bashCommand, result.returncode))
 
-    return output_str
+    return "".join(line + "\n" for line in result.stdout)
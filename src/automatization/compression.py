@@ -0,0 +1,412 @@
+"""
+Streaming (de)compression of downloaded files.
+
+A codec transforms the data chunk by chunk between the ftp stream and the
+local file, with bounded memory, so compressed products are stored
+uncompressed, or the other way round, without a second pass over disk:
+
+    dmsites = DataManager(ftp, sitesArgs, _codec="gunzip")
+
+Codecs: gzip, gunzip, bzip2, bunzip2, and zstd, unzstd, lz4, unlz4 when the
+zstandard and lz4 packages are installed. Compressing codecs add their
+extension to the local file name, decompressing ones remove it.
+
+"""
+
+import bz2
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+
+# largest piece of output produced at once
+OUTPUT_BLOCK = 1024 * 1024
+
+
+class Compressor(object):
+    """
+    Compress a stream
+    """
+    compress = True
+
+    def __init__(self, _name, _extension, _factory):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _name: str
+            codec name
+        _extension: str
+            added to the local file name, e.g. .gz
+        _factory: callable
+            returns an object with compress(data) and flush() methods
+        """
+        self.name = _name
+        self.extension = _extension
+        self.engine = _factory()
+
+    def local_name(self, filename):
+        return filename + self.extension
+
+    def process(self, chunk):
+        """
+        Return
+        ------
+        pieces: iterable of bytes
+            output produced by the chunk
+        """
+        data = self.engine.compress(chunk)
+        if data:
+            yield data
+
+    def flush(self):
+        data = self.engine.flush()
+        if data:
+            yield data
+
+
+class Decompressor(object):
+    """
+    Decompress a stream, concatenated members included
+    """
+    compress = False
+
+    def __init__(self, _name, _extension, _factory):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _name: str
+            codec name
+        _extension: str
+            removed from the local file name when present
+        _factory: callable
+            returns a decompressor object with decompress(data, max_length),
+            eof and unused_data
+        """
+        self.name = _name
+        self.extension = _extension
+        self.factory = _factory
+        self.engine = _factory()
+        # the current member received data
+        self.fed = False
+
+    def local_name(self, filename):
+        if self.extension and filename.endswith(self.extension):
+            return filename[:-len(self.extension)]
+        return filename
+
+    def _drain(self, data):
+        # zlib returns the input left over, bz2 and lz4 keep it and tell
+        # whether they need more
+        tail = hasattr(self.engine, "unconsumed_tail")
+        while True:
+            out = self.engine.decompress(data, OUTPUT_BLOCK)
+            if out:
+                yield out
+            if self.engine.eof:
+                return
+            if tail:
+                data = self.engine.unconsumed_tail
+                if not data:
+                    return
+            elif self.engine.needs_input:
+                return
+            else:
+                data = b""
+
+    def process(self, chunk):
+        data = bytes(chunk)
+        while data:
+            self.fed = True
+            for piece in self._drain(data):
+                yield piece
+            data = b""
+
+            if getattr(self.engine, "eof", False):
+                # another member may follow
+                data = self.engine.unused_data
+                self.engine = self.factory()
+                self.fed = False
+
+    def flush(self):
+        if hasattr(self.engine, "unconsumed_tail"):
+            data = self.engine.flush()
+            if data:
+                yield data
+        if self.fed and not getattr(self.engine, "eof", True):
+            raise Exception("Truncated %s stream" % self.name)
+
+
+class StreamDecompressor(Decompressor):
+    """
+    Decompress a stream with an engine writing its output to a file
+    object, in pieces of at most OUTPUT_BLOCK bytes, e.g. zstandard
+    stream_writer. Engines of this kind decode concatenated frames by
+    themselves but do not tell where the input stops, a tracker does.
+    """
+
+    def __init__(self, _name, _extension, _factory, _tracker):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _name: str
+            codec name
+        _extension: str
+            removed from the local file name when present
+        _factory: callable
+            given a file object, returns a writer decompressing into it
+        _tracker: callable
+            returns a stream consumer of the input whose result() is True
+            when the input ends between frames
+        """
+        self.name = _name
+        self.extension = _extension
+        self.engine = _factory(PieceWriter(self._emit))
+        self.tracker = _tracker()
+        # output goes straight to the target once attached, otherwise it
+        # is kept until process returns
+        self.target = None
+        self.pieces = []
+
+    def attach(self, target):
+        """
+        Send the output to target(piece) as it is produced instead of
+        returning it from process and flush
+        """
+        self.target = target
+
+    def _emit(self, piece):
+        if self.target is not None:
+            self.target(piece)
+        else:
+            self.pieces.append(bytes(piece))
+
+    def process(self, chunk):
+        self.tracker.update(chunk)
+        self.engine.write(chunk)
+        pieces, self.pieces = self.pieces, []
+        return pieces
+
+    def flush(self):
+        self.engine.flush()
+        pieces, self.pieces = self.pieces, []
+        for piece in pieces:
+            yield piece
+        if not self.tracker.result():
+            raise Exception("Truncated %s stream" % self.name)
+
+
+class PieceWriter(object):
+    """
+    File object calling a function with every piece written
+    """
+
+    def __init__(self, _write):
+        self.write_piece = _write
+
+    def write(self, piece):
+        self.write_piece(piece)
+        return len(piece)
+
+
+ZSTD_MAGIC = 0xFD2FB528
+
+
+class ZstdFrames(object):
+    """
+    Stream consumer following the frame and block headers of a zstd
+    stream, without decoding it, to tell whether the stream ends between
+    frames
+    """
+
+    def __init__(self):
+        self.state = "magic"
+        # length of the header being read, its bytes so far, and the bytes
+        # to pass over before the next header
+        self.need = 4
+        self.header = bytearray()
+        self.skip = 0
+        self.checksum = False
+
+    def update(self, chunk):
+        view = memoryview(chunk)
+        while view:
+            if self.skip:
+                n = min(self.skip, len(view))
+                self.skip -= n
+                view = view[n:]
+                continue
+            n = min(self.need - len(self.header), len(view))
+            self.header += view[:n]
+            view = view[n:]
+            if len(self.header) == self.need:
+                header, self.header = bytes(self.header), bytearray()
+                self._header(header)
+
+    def _header(self, header):
+        if self.state == "magic":
+            magic = int.from_bytes(header, "little")
+            if magic == ZSTD_MAGIC:
+                self.state, self.need = "descriptor", 1
+            elif magic & 0xFFFFFFF0 == 0x184D2A50:
+                self.state, self.need = "skippable", 4
+            else:
+                raise Exception("Not a zstd frame")
+
+        elif self.state == "skippable":
+            self.skip = int.from_bytes(header, "little")
+            self.state, self.need = "magic", 4
+
+        elif self.state == "descriptor":
+            descriptor = header[0]
+            single_segment = descriptor >> 5 & 1
+            self.checksum = bool(descriptor >> 2 & 1)
+            # window descriptor, dictionary id and frame content size
+            self.skip = (0 if single_segment else 1) + (0, 1, 2, 4)[descriptor & 3] + \
+                (single_segment, 2, 4, 8)[descriptor >> 6]
+            self.state, self.need = "block", 3
+
+        else:
+            block = int.from_bytes(header, "little")
+            block_type = block >> 1 & 3
+            if block_type == 3:
+                raise Exception("Corrupted zstd block")
+            # a RLE block holds the byte repeated
+            self.skip = 1 if block_type == 1 else block >> 3
+            if block & 1:
+                self.skip += 4 if self.checksum else 0
+                self.state, self.need = "magic", 4
+
+    def result(self):
+        return self.state == "magic" and not self.header and not self.skip
+
+
+def _zstd_writer(target):
+    return zstandard.ZstdDecompressor().stream_writer(target, write_size=OUTPUT_BLOCK, closefd=False)
+
+
+def _lz4_compressor():
+    return Lz4Compressor()
+
+
+class Lz4Compressor(object):
+    """
+    compress/flush interface over lz4 frames
+    """
+
+    def __init__(self):
+        self.engine = lz4frame.LZ4FrameCompressor()
+        self.started = False
+
+    def compress(self, data):
+        header = b""
+        if not self.started:
+            header = self.engine.begin()
+            self.started = True
+        return header + self.engine.compress(data)
+
+    def flush(self):
+        header = b"" if self.started else self.engine.begin()
+        return header + self.engine.flush()
+
+
+def get_codec(name):
+    """
+    Fresh codec for one file
+
+    Arguments
+    ---------
+    name: str
+        gzip, gunzip, bzip2, bunzip2, zstd, unzstd, lz4 or unlz4
+
+    Return
+    ------
+    codec: Compressor or Decompressor
+    """
+    if name == "gzip":
+        return Compressor(name, ".gz", lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS))
+    if name == "gunzip":
+        return Decompressor(name, ".gz", lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+    if name == "bzip2":
+        return Compressor(name, ".bz2", bz2.BZ2Compressor)
+    if name == "bunzip2":
+        return Decompressor(name, ".bz2", bz2.BZ2Decompressor)
+
+    if name in ("zstd", "unzstd"):
+        if zstandard is None:
+            raise Exception("zstandard package is required for %s" % name)
+        if name == "zstd":
+            return Compressor(name, ".zst", lambda: zstandard.ZstdCompressor().compressobj())
+        return StreamDecompressor(name, ".zst", _zstd_writer, ZstdFrames)
+
+    if name in ("lz4", "unlz4"):
+        if lz4frame is None:
+            raise Exception("lz4 package is required for %s" % name)
+        if name == "lz4":
+            return Compressor(name, ".lz4", _lz4_compressor)
+        return Decompressor(name, ".lz4", lz4frame.LZ4FrameDecompressor)
+
+    raise Exception("Unknown codec %s" % name)
+
+
+class CodecWriter(object):
+    """
+    File object wrapper passing the data through a codec before writing
+    it. Consumers see the data as written to the file.
+    """
+
+    def __init__(self, _filepointer, _codec, _consumers=None):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _filepointer: file object
+            destination file
+        _codec: Compressor or Decompressor
+            fresh codec of this file
+        _consumers: list
+            stream consumers of the output, e.g. a GribIndexer
+        """
+        self.filepointer = _filepointer
+        self.codec = _codec
+        self.consumers = _consumers or []
+        self.written = 0
+        # codecs pushing their output write it as it is produced
+        if hasattr(_codec, "attach"):
+            _codec.attach(self._write_piece)
+
+    def _write_piece(self, piece):
+        view = memoryview(piece)
+        while view:
+            view = view[self.filepointer.write(view):]
+        self.written += len(piece)
+        for consumer in self.consumers:
+            consumer.update(piece)
+
+    def _write(self, pieces):
+        for piece in pieces:
+            self._write_piece(piece)
+
+    def write(self, chunk):
+        self._write(self.codec.process(chunk))
+        return len(chunk)
+
+    def finish(self):
+        """
+        Write what the codec still holds, once the input is over
+        """
+        self._write(self.codec.flush())
@@ -0,0 +1,280 @@
+"""
+Run DataManagers as a long lived daemon.
+
+Each site is polled on its own adaptive interval: quickly while days are
+being produced, backing off while there is nothing to do, and with an
+exponential backoff while the network is down. Cycles run in their own
+threads, so a long transfer of one site does not delay the polls of the
+others. Connection pools stay warm between cycles and SIGTERM or SIGINT
+stop the daemon once the running cycles are over.
+
+    dmsites = DataManager(ftp, sitesArgs)
+    Daemon([dmsites], _min_interval=60, _max_interval=900).run()
+
+Several sites sharing pools can be run from an Orchestrator:
+
+    Daemon(orchestrator.managers).run()
+
+"""
+
+import time
+import signal
+import socket
+import threading
+import logging as log
+
+from concurrent.futures import ThreadPoolExecutor
+
+from automatization import metrics
+
+
+class SiteSchedule(object):
+    """
+    Adaptive poll interval of one site
+    """
+
+    def __init__(self, _manager, _min_interval, _max_interval, _busy_interval, _backoff, _max_backoff):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _manager: DataManager
+            site to poll
+        _min_interval: float
+            seconds between polls after new work was found
+        _max_interval: float
+            longest interval while idle
+        _busy_interval: float
+            interval while days are being produced
+        _backoff: float
+            factor applied to the interval on every idle poll or failure
+        _max_backoff: float
+            longest interval while the network is down
+        """
+        self.manager = _manager
+        self.min_interval = _min_interval
+        self.max_interval = _max_interval
+        self.busy_interval = _busy_interval
+        self.backoff = _backoff
+        self.max_backoff = _max_backoff
+
+        self.interval = _min_interval
+        self.failures = 0
+        # poll right away
+        self.due = time.monotonic()
+
+    def done(self, finished_jobs, exec_jobs):
+        """
+        Compute the next poll after a successful cycle
+        """
+        self.failures = 0
+        if exec_jobs:
+            self.interval = self.busy_interval
+        elif finished_jobs:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, max(self.interval, self.min_interval) * self.backoff)
+        self.due = time.monotonic() + self.interval
+
+    def failed(self):
+        """
+        Compute the next poll after a failed cycle
+        """
+        self.failures += 1
+        self.interval = min(self.max_backoff, self.min_interval * self.backoff ** self.failures)
+        self.due = time.monotonic() + self.interval
+
+
+class Daemon(object):
+    """
+    Poll a set of DataManagers until stopped
+    """
+
+    def __init__(self, _managers, _min_interval=60, _max_interval=900, _busy_interval=None,
+                 _backoff=2, _max_backoff=1800, _keepalive=60, _metrics=None):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _managers: list of DataManager
+            sites to poll, possibly sharing ftp pools
+        _min_interval: float
+            seconds between polls after new work was found
+        _max_interval: float
+            longest interval while a site is idle
+        _busy_interval: float
+            interval while days are being produced, half the minimum by default
+        _backoff: float
+            factor applied to the interval on every idle poll or failure
+        _max_backoff: float
+            longest interval while the network is down
+        _keepalive: float
+            seconds between NOOPs on the idle sessions while waiting, must
+            be shorter than the pool idle timeout to keep them open
+        _metrics: object MetricsRegistry
+            registry receiving the intervals, the shared one by default
+        """
+        if not _managers:
+            raise Exception("At least one site is required")
+
+        if _backoff < 1:
+            raise Exception("Backoff factor must be at least 1")
+
+        busy = _busy_interval if _busy_interval is not None else _min_interval / 2.0
+        self.sites = [SiteSchedule(m, _min_interval, _max_interval, busy, _backoff, _max_backoff) for m in _managers]
+        self.keepalive = _keepalive
+        self.metrics = _metrics or metrics.REGISTRY
+
+        # pools shared by several sites are only handled once
+        self.pools = []
+        for manager in _managers:
+            if not any(manager.ftp is pool for pool in self.pools):
+                self.pools.append(manager.ftp)
+
+        self.stopping = threading.Event()
+        # set whenever a cycle ends, the next wake up may change
+        self.changed = threading.Event()
+        # site to the future of its running cycle
+        self.running = {}
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def _cycle(self, site, is_simulation):
+        name = site.manager.input.name
+        try:
+            finished_jobs, exec_jobs = site.manager.cycle(is_simulation)
+        except socket.gaierror:
+            site.failed()
+            log.warning("Network is down for %s, next try in %ds" % (name, site.interval))
+        except Exception as e:
+            # a failing site must not stop the others
+            site.failed()
+            log.error("Site %s failed: %s, next try in %ds" % (name, e, site.interval))
+        else:
+            site.done(finished_jobs, exec_jobs)
+            log.info("Next poll of %s in %ds" % (name, site.interval))
+
+        self.metrics.set("daemon_poll_interval_seconds", site.interval, site=name)
+
+    def run_once(self, is_simulation=False, wait=False):
+        """
+        Start a cycle of every site which is due and not running yet. Each
+        site is rescheduled when its own cycle ends.
+
+        Arguments
+        ---------
+        is_simulation: bool
+            Apply action but with no effect on real data. Test purposes.
+        wait: bool
+            return only once the cycles started are over
+
+        Return
+        ------
+        due: int
+            sites polled
+        """
+        now = time.monotonic()
+        with self.lock:
+            due = [site for site in self.sites if site.due <= now and site not in self.running]
+            if due and self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=len(self.sites), thread_name_prefix="daemon")
+            futures = []
+            for site in due:
+                future = self.executor.submit(self._cycle, site, is_simulation)
+                self.running[site] = future
+                futures.append(future)
+
+        for site, future in zip(due, futures):
+            future.add_done_callback(lambda future, site=site: self._finished(site))
+
+        if wait:
+            for future in futures:
+                future.result()
+
+        return len(due)
+
+    def _finished(self, site):
+        with self.lock:
+            self.running.pop(site, None)
+        self.changed.set()
+
+    def join(self):
+        """
+        Wait for the running cycles
+        """
+        with self.lock:
+            futures = list(self.running.values())
+        for future in futures:
+            future.result()
+
+    def _keepalive(self):
+        for pool in self.pools:
+            try:
+                pool.keepalive_all()
+            except Exception as e:
+                log.debug("Keepalive failed: %s" % e)
+
+    def _wait(self):
+        """
+        Sleep until the next idle site is due or a cycle ends, keeping the
+        pools alive meanwhile
+        """
+        while not self.stopping.is_set():
+            with self.lock:
+                idle = [site.due for site in self.sites if site not in self.running]
+                self.changed.clear()
+            if self.stopping.is_set():
+                return
+            left = (min(idle) if idle else float("inf")) - time.monotonic()
+            if left <= 0:
+                return
+            if self.changed.wait(min(left, self.keepalive)):
+                return
+            if left > self.keepalive:
+                self._keepalive()
+
+    def _handle_signal(self, signum, frame):
+        log.info("Signal %d received, stopping after the running cycles..." % signum)
+        self.stop()
+
+    def run(self, is_simulation=False, install_signals=True):
+        """
+        Poll until stop is called or SIGTERM/SIGINT is received, then close
+        the pools
+
+        Arguments
+        ---------
+        is_simulation: bool
+            Apply action but with no effect on real data. Test purposes.
+        install_signals: bool
+            handle SIGTERM and SIGINT, only possible from the main thread
+        """
+        previous = {}
+        if install_signals and threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                previous[signum] = signal.signal(signum, self._handle_signal)
+
+        log.info("Daemon started for %s" % ", ".join(s.manager.input.name for s in self.sites))
+        try:
+            while not self.stopping.is_set():
+                self.run_once(is_simulation)
+                self._wait()
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+            self.join()
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+            for pool in self.pools:
+                pool.close()
+            log.info("Daemon stopped")
+
+    def stop(self):
+        """
+        Ask the daemon to stop once the running cycles are over
+        """
+        self.stopping.set()
+        self.changed.set()
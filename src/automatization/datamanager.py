@@ -12,13 +12,27 @@ if finished -> check remote outputs (8 expected)
 
 import os
 import abc
+import errno
 import json
+import time
+import queue
 import pickle
 import socket
+import threading
 import logging as log
 
-from ftplib import FTP, error_perm
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from ftplib import FTP, error_perm, error_temp, error_reply, error_proto, all_errors
 from automatization.ecaccess import EcmwfJob, Ecaccess
+from automatization.streams import ByteCounter, HashConsumer, feed_file
+from automatization.state import DOWNLOADED, DELETED
+from automatization.scheduler import TokenBucket, Throttle, TransferScheduler, RetryQueue, CircuitBreaker, oldest_first
+from automatization import metrics
+from automatization.patterns import DEFAULT_PATTERN
+from automatization.diskio import FSYNC_POLICIES, Directories, MirrorWriter, preallocate, publish
+from automatization.grib import GribIndexer, write_index
+from automatization.compression import CodecWriter, get_codec
 
 log.basicConfig(level=log.INFO)
 
@@ -28,7 +42,9 @@ class EcmwfInput(object):
     In order to move data it is necessary to specify configuration first
     """
            
-    def __init__(self, _name, _description, _remote_path, _local_path):
+    def __init__(self, _name, _description, _remote_path, _local_path,
+                 _host=None, _user=None, _password=None, _port=21, _pattern=None,
+                 _mirrors=None):
         """
         Constructor
         
@@ -42,6 +58,20 @@ class EcmwfInput(object):
             source remote path to copy data    
         _local_path: str
             destination local path
+        _host: str
+            ftp host serving this site, used by the Orchestrator
+        _user: str
+            ftp user, defaults to the Orchestrator one
+        _password: str
+            ftp password, defaults to the Orchestrator one
+        _port: int
+            ftp port
+        _pattern: object FilenamePattern
+            names of the files of every date, EN + YYMMDD + three hourly
+            steps by default
+        _mirrors: list of str
+            more destination paths, same YEAR/MONTH/DAY templates, written
+            from the same transfer, e.g. a scratch area next to the NAS
         """
         if not isinstance(_name, str):
             raise Exception("ftpPath is not str")        
@@ -54,11 +84,20 @@ class EcmwfInput(object):
             
         if not _local_path or not isinstance(_local_path, str):
             raise Exception("OutputPath is not defined")
+
+        if any(not m or not isinstance(m, str) for m in _mirrors or []):
+            raise Exception("Mirror paths must be str")
         
         self.name = _name
         self.description = _description
         self.remote_path = _remote_path
         self.local_path = _local_path
+        self.host = _host
+        self.user = _user
+        self.password = _password
+        self.port = _port
+        self.pattern = _pattern or DEFAULT_PATTERN
+        self.mirrors = list(_mirrors or [])
                 
     #@abc.abstractmethod
     def getRemotePath(self):
@@ -80,7 +119,20 @@ class EcmwfInput(object):
             This path is generated
         
         """
-        newpath = self.local_path.replace("YEAR", dateobj.strftime("%Y"))
+        return self._expand(self.local_path, dateobj)
+
+    def getMirrorPaths(self, dateobj):
+        """
+        Generate the mirror paths of a date, see getLocalPath
+
+        Return
+        ------
+        newpaths: list of str
+        """
+        return [self._expand(path, dateobj) for path in self.mirrors]
+
+    def _expand(self, path, dateobj):
+        newpath = path.replace("YEAR", dateobj.strftime("%Y"))
         newpath = newpath.replace("MONTH", dateobj.strftime("%m"))
         newpath = newpath.replace("DAY", dateobj.strftime("%d"))
         
@@ -115,26 +167,475 @@ def split_filepath(filepath):
     filename = filepath.split("/")[-1]
 
     return filename, fullpath
+
+
+# socket errors telling the host or the network is unreachable
+NETWORK_ERRNOS = (errno.ENETDOWN, errno.ENETUNREACH, errno.EHOSTDOWN, errno.EHOSTUNREACH)
+
+
+def is_connection_error(error):
+    """
+    Tell whether a failed transfer says the ftp host is unhealthy. Refused
+    commands (5xx), verification failures and local disk errors do not.
+
+    Arguments
+    ---------
+    error: Exception
+        raised by the transfer
+
+    Return
+    ------
+    connection_error: bool
+    """
+    if isinstance(error, error_perm):
+        return False
+    if isinstance(error, (error_temp, error_reply, error_proto, EOFError, ConnectionError, TimeoutError, socket.gaierror)):
+        return True
+    return isinstance(error, OSError) and error.errno in NETWORK_ERRNOS
+
  
+def parse_list_line(line):
+    """
+    Parse a unix style LIST line
+
+    Arguments
+    ---------
+    line: str
+        e.g. "-rw-r--r-- 1 ftp ftp 1024 May 10 12:00 EN14051000"
+
+    Return
+    ------
+    entry: tuple
+        (name, size, modify) of a regular file, None otherwise
+    """
+    parts = line.split(None, 8)
+    if len(parts) < 9 or not parts[0].startswith("-"):
+        return None
+
+    try:
+        size = int(parts[4])
+    except ValueError:
+        return None
+
+    return parts[8], size, " ".join(parts[5:8])
+
+
+class ProgressWriter(object):
+    """
+    File object wrapper counting written bytes and reporting progress
+    """
+
+    def __init__(self, _filepointer, _name, _progress=None, _offset=0):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _filepointer: file object
+            destination file
+        _name: str
+            name given to the progress callback
+        _progress: callable
+            called as progress(name, received_bytes) after each chunk
+        _offset: int
+            bytes already present when resuming
+        """
+        self.filepointer = _filepointer
+        self.name = _name
+        self.progress = _progress
+        self.offset = _offset
+        self.received = _offset
+
+    def write(self, chunk):
+        # unbuffered files may take part of a chunk
+        view = memoryview(chunk)
+        while view:
+            view = view[self.filepointer.write(view):]
+        self.received += len(chunk)
+        if self.progress is not None:
+            self.progress(self.name, self.received)
+
+class Manifest(object):
+    """
+    Integrity records of the files of a day, stored as json next to the day
+    directory (e.g. /some/local/path/2014/05/10.manifest.json)
+    """
+    lock = threading.Lock()
+
+    def __init__(self, _download_path):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _download_path: str
+            local day directory
+        """
+        self.path = _download_path.rstrip("/") + ".manifest.json"
+
+    def load(self):
+        """
+        Return
+        ------
+        records: dict
+            file name to its record
+        """
+        if not os.path.exists(self.path):
+            return {}
+
+        with open(self.path) as infile:
+            return json.load(infile)
+
+    def record(self, filename, values):
+        """
+        Add or replace the record of a file
+
+        Arguments
+        ---------
+        filename: str
+            file name
+        values: dict
+            e.g. {"size": 1024, "md5": "..."}
+        """
+        with self.lock:
+            records = self.load()
+            records[filename] = values
+
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as outfile:
+                json.dump(records, outfile, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
 ###################################################################################
  
  
+class FTPSession(object):
+    """
+    Logged in FTP connection kept alive by FTPManager pool
+    """
+
+    def __init__(self, _ftp, _metrics=None):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _ftp: ftplib.FTP
+            connected and logged in ftp object
+        _metrics: object MetricsRegistry
+            registry receiving the CWD timings
+        """
+        self.ftp = _ftp
+        self.metrics = _metrics
+        # remote directory cached to avoid repeating CWD
+        self.cwd = None
+        self.last_used = time.time()
+        self.recv_buffer = None
+
+    def buffer(self, size):
+        """
+        Receive buffer reused by every transfer of the session
+
+        Arguments
+        ---------
+        size: int
+            bytes
+
+        Return
+        ------
+        buffer: memoryview
+        """
+        if self.recv_buffer is None or len(self.recv_buffer) != size:
+            self.recv_buffer = memoryview(bytearray(size))
+        return self.recv_buffer
+
+    def chdir(self, path):
+        """
+        Move to remote path only when it differs from the cached one
+
+        Arguments
+        ---------
+        path: str
+            remote directory
+        """
+        if path != self.cwd:
+            if self.metrics is not None:
+                with self.metrics.timer("ftp_phase_seconds", host=self.ftp.host, phase="cwd"):
+                    self.ftp.cwd(path)
+            else:
+                self.ftp.cwd(path)
+            self.cwd = path
+
+    def is_alive(self):
+        """
+        Health check sending a NOOP
+
+        Return
+        ------
+        alive: bool
+            True when server answered
+        """
+        try:
+            self.ftp.voidcmd("NOOP")
+        except all_errors:
+            return False
+
+        self.last_used = time.time()
+        return True
+
+    def close(self):
+        """
+        Quit politely, otherwise close the socket
+        """
+        try:
+            self.ftp.quit()
+        except all_errors:
+            self.ftp.close()
+
+
 class FTPManager(object):
     """
-    FTP basic method to connect to ftp    
+    FTP basic method to connect to ftp
+
+    Logged in sessions are kept in a bounded pool and reused by every
+    operation, so each call costs only the command itself.
     """
-    def __init__(self, _address, _user, _password):
-    
+    def __init__(self, _address, _user, _password, _port=21, _max_sessions=4,
+                 _keepalive=30, _idle_timeout=300, _timeout=60,
+                 _blocksize=256 * 1024, _min_segment=8 * 1024 * 1024, _metrics=None):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _address: str
+            ftp host
+        _user: str
+            ftp user
+        _password: str
+            ftp password
+        _port: int
+            ftp port
+        _max_sessions: int
+            maximum simultaneous sessions opened against this host
+        _keepalive: int
+            seconds idle after which a session is checked with NOOP before reuse
+        _idle_timeout: int
+            seconds idle after which a session is closed
+        _timeout: int
+            socket timeout in seconds
+        _blocksize: int
+            bytes read per call on segmented transfers
+        _min_segment: int
+            smallest byte range worth its own connection
+        _metrics: object MetricsRegistry
+            registry receiving timings, the shared one by default
+        """
+
         if not _user:
             raise Exception("user is not defined")
-            
-        if not _password:    
+
+        if not _password:
             raise Exception("user is not defined")
-    
+
+        if _max_sessions < 1:
+            raise Exception("At least one session is required")
+
         self.address = _address
         self.user = _user
         self.pwd = _password
-        
+        self.port = _port
+        self.max_sessions = _max_sessions
+        self.keepalive = _keepalive
+        self.idle_timeout = _idle_timeout
+        self.timeout = _timeout
+        self.blocksize = _blocksize
+        self.min_segment = _min_segment
+        self.metrics = _metrics or metrics.REGISTRY
+        # switched off the first time the server refuses MLSD
+        self.mlsd = True
+
+        # idle sessions, most recently used at the end
+        self.sessions = []
+        # sessions opened (idle and borrowed)
+        self.opened = 0
+        self.lock = threading.Condition()
+
+    def _connect(self):
+        """
+        Open and log in a new session
+        """
+        ftp = FTP()
+        with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="connect"):
+            ftp.connect(host=self.address, port=self.port, timeout=self.timeout)
+        with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="login"):
+            ftp.login(user=self.user, passwd=self.pwd)
+        self.metrics.inc("ftp_connections_total", host=self.address)
+        log.debug("  New FTP session to %s" % self.address)
+        return FTPSession(ftp, self.metrics)
+
+    def _evict_idle(self):
+        """
+        Remove sessions idle for too long. Lock must be held.
+
+        Return
+        ------
+        evicted: list of FTPSession
+            sessions to be closed by the caller
+        """
+        now = time.time()
+        evicted = [s for s in self.sessions if now - s.last_used > self.idle_timeout]
+        if evicted:
+            self.sessions = [s for s in self.sessions if s not in evicted]
+            self.opened -= len(evicted)
+            self.lock.notify(len(evicted))
+        return evicted
+
+    def acquire(self):
+        """
+        Borrow a logged in session, waiting if the pool is exhausted.
+        Dead sessions are transparently replaced.
+
+        Return
+        ------
+        session: FTPSession
+        """
+        with self.lock:
+            evicted = self._evict_idle()
+            while not self.sessions and self.opened >= self.max_sessions:
+                self.lock.wait()
+
+            if self.sessions:
+                session = self.sessions.pop()
+            else:
+                session = None
+                self.opened += 1
+
+        for old in evicted:
+            old.close()
+
+        if session is not None and time.time() - session.last_used > self.keepalive:
+            if not session.is_alive():
+                log.debug("  FTP session is dead, reconnecting...")
+                session.close()
+                session = None
+
+        if session is None:
+            try:
+                session = self._connect()
+            except:
+                with self.lock:
+                    self.opened -= 1
+                    self.lock.notify()
+                raise
+
+        return session
+
+    def release(self, session, discard=False):
+        """
+        Give back a session to the pool
+
+        Arguments
+        ---------
+        session: FTPSession
+            session returned by acquire
+        discard: bool
+            close it instead, e.g. after a connection error
+        """
+        with self.lock:
+            if discard:
+                self.opened -= 1
+            else:
+                session.last_used = time.time()
+                self.sessions.append(session)
+            self.lock.notify()
+
+        if discard:
+            session.close()
+
+    @contextmanager
+    def session(self, path=None):
+        """
+        Borrow a session for a block of commands
+
+        Arguments
+        ---------
+        path: str
+            remote directory to move to, if any
+        """
+        session = self.acquire()
+        try:
+            if path is not None:
+                session.chdir(path)
+            yield session
+        except error_perm:
+            # server refused the command, connection is still usable
+            self.release(session)
+            raise
+        except:
+            self.release(session, discard=True)
+            raise
+        else:
+            self.release(session)
+
+    def _run(self, path, action, can_retry=None):
+        """
+        Run an action on a pooled session, reconnecting once if the
+        session was lost.
+
+        Arguments
+        ---------
+        path: str
+            remote directory
+        action: callable
+            receives the FTPSession
+        can_retry: callable
+            tells whether it is safe to repeat the action after a failure
+        """
+        try:
+            with self.session(path) as session:
+                return action(session)
+        except error_perm:
+            raise
+        except all_errors:
+            if can_retry is not None and not can_retry():
+                raise
+            log.debug("  FTP session lost, retrying on a new one...")
+
+        with self.session(path) as session:
+            return action(session)
+
+    def keepalive_all(self):
+        """
+        Send NOOP on every idle session, dropping the dead or expired ones
+        """
+        with self.lock:
+            evicted = self._evict_idle()
+            idle = self.sessions
+            self.sessions = []
+
+        for old in evicted:
+            old.close()
+
+        for session in idle:
+            if session.is_alive():
+                self.release(session)
+            else:
+                self.release(session, discard=True)
+
+    def close(self):
+        """
+        Close every idle session
+        """
+        with self.lock:
+            idle = self.sessions
+            self.sessions = []
+            self.opened -= len(idle)
+            self.lock.notify_all()
+
+        for session in idle:
+            session.close()
+
     def list_files(self, path):
         """
         Get ftp listed files
@@ -153,18 +654,51 @@ class FTPManager(object):
         if not path:
             raise Exception("path is not defined")    
             
-        files = None    
-    
-        # connect to ic3 ftp and retrieve files
-        with FTP(host=self.address) as ftp:
-            ftp.login(user=self.user,passwd=self.pwd)
-            ftp.cwd(path)
-
-            files = ftp.nlst()
-            
-        return files  
+        with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="list"):
+            return self._run(path, lambda session: session.ftp.nlst())
             
-    def download(self, remote_filepath, filepointer):
+    def list_entries(self, path):
+        """
+        Get ftp listed files with their metadata. MLSD is used when the
+        server supports it, LIST is parsed otherwise.
+
+        Arguments
+        ---------
+        path: str
+            remote path to list ftp files
+
+        Return
+        ------
+        entries: dict
+            file name to (size, modify). Directories are left out.
+        """
+        if not path:
+            raise Exception("path is not defined")
+
+        def action(session):
+            ftp = session.ftp
+            if self.mlsd:
+                try:
+                    return dict((name, (int(facts.get("size", -1)), facts.get("modify")))
+                                for name, facts in ftp.mlsd(facts=["type", "size", "modify"])
+                                if facts.get("type", "file") == "file")
+                except error_perm:
+                    log.debug("  MLSD not supported by %s, using LIST" % self.address)
+                    self.mlsd = False
+
+            lines = []
+            ftp.retrlines('LIST', lines.append)
+            entries = {}
+            for line in lines:
+                entry = parse_list_line(line)
+                if entry is not None:
+                    entries[entry[0]] = entry[1:]
+            return entries
+
+        with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="list"):
+            return self._run(path, action)
+
+    def download(self, remote_filepath, filepointer, rest=None, consumers=None):
         """
         Get data from ftp to local machine
         
@@ -174,138 +708,965 @@ class FTPManager(object):
             Complete ftp path and filename
         filepointer: file object
             This is a local file pointers to place downloaded data
+        rest: int
+            restart the transfer at this byte offset (REST)
+        consumers: list
+            stream consumers (see automatization.streams) updated with
+            every chunk written. Chunks are memoryviews of a reused buffer,
+            only valid during the call.
         """            
-        print(remote_filepath)
         remote_filename, remote_path = split_filepath(remote_filepath)
-        print (remote_filename, remote_path)
-                        
-        with FTP(host=self.address) as ftp:
-            ftp.login(user=self.user,passwd=self.pwd)
-            ftp.cwd(remote_path)
-            ftp.retrbinary('RETR %s' % remote_filename, filepointer.write)
+        log.debug("  RETR %s from %s" % (remote_filename, remote_path))
+
+        written = [0]
+        consumers = consumers or []
+        started = [None]
+
+        def callback(chunk):
+            if not written[0]:
+                self.metrics.observe("ftp_retr_first_byte_seconds", time.perf_counter() - started[0], host=self.address)
+            written[0] += len(chunk)
+            filepointer.write(chunk)
+            for consumer in consumers:
+                consumer.update(chunk)
+
+        def action(session):
+            ftp = session.ftp
+            # receive straight into the session buffer, no allocation per chunk
+            buffer = session.buffer(self.blocksize)
+            started[0] = time.perf_counter()
+            ftp.voidcmd('TYPE I')
+            with ftp.transfercmd('RETR %s' % remote_filename, rest=rest) as conn:
+                while True:
+                    size = conn.recv_into(buffer)
+                    if not size:
+                        break
+                    callback(buffer[:size])
+            return ftp.voidresp()
+
+        began = time.perf_counter()
+        try:
+            # only repeat when nothing reached the file yet
+            self._run(remote_path, action, can_retry=lambda: written[0] == 0)
+        finally:
+            self._observe_transfer(written[0], time.perf_counter() - began)
+
+    def _observe_transfer(self, received, elapsed):
+        """
+        Record the time and throughput of a transfer
+        """
+        self.metrics.observe("ftp_phase_seconds", elapsed, host=self.address, phase="retr")
+        self.metrics.inc("ftp_bytes_total", received, host=self.address)
+        if received and elapsed > 0:
+            self.metrics.observe("ftp_transfer_bytes_per_second", received / elapsed, host=self.address)
                 
-    def delete(self, remote_filepath):
+    def size(self, remote_filepath):
         """
-        Delete file on ftp
-        
+        Remote file size
+
         Arguments
         ---------
         remote_filepath: str
             ftp full path to file
-        """    
+
+        Return
+        ------
+        size: int
+            file size in bytes
+        """
         remote_filename, remote_path = split_filepath(remote_filepath)
-        
-        # connect to ic3 ftp
-        with FTP(host=self.address) as ftp:
-            ftp.login(user=self.user,passwd=self.pwd)
-            ftp.cwd(remote_path)
-            ftp.delete(remote_filename)
 
+        def action(session):
+            # SIZE is only reliable in binary mode
+            session.ftp.voidcmd('TYPE I')
+            return session.ftp.size(remote_filename)
 
-class DataManager(object):    
-    """
-    Manage data importing from Remote site to Local machine
-    """
-    
-    def __init__(self, _ftpManager, _inputData):
+        with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="size"):
+            return self._run(remote_path, action)
+
+    def _download_range(self, remote_filepath, fd, offset, length, report=None):
         """
-        constructor
-        
+        Fetch a byte range on its own session and write it at the same
+        offset of an already opened local file.
+
         Arguments
         ---------
-        _ftpManager: object FTPManager
-            Remote connection
-        _inputData: object EcmwfData
-            Configuration Parameters for local and remote places
-        """
-        
-        self.input = _inputData
-        self.ftp = _ftpManager
-            
-    def getJobs(self):
-        """
-        Discover on ftp how many jobs have finished regarding the output files.
-        
+        remote_filepath: str
+            ftp full path to file
+        fd: int
+            local file descriptor
+        offset: int
+            first byte of the range
+        length: int
+            bytes of the range
+        report: callable
+            called with the amount of bytes written after each chunk
+
         Return
         ------
-        done_jobs: list of EcmwfJob
-            successfully finished job 
-        
-        exec_jobs: list of EcmwfJob
-            running jobs. All outputs are not yet found on ftp.
+        received: int
+            bytes written
         """
-        succ_jobs = []
-        run_jobs = []
-        ending = ["00","03","06","09","12","15", "18","21"]
-        
-        # connect to ic3 ftp and retrieve files
-        files = self.ftp.list_files(self.input.getRemotePath())
-               
-        # dates and files found
-        dates_found = {}    
-            
-        # organize each file found
-        for f in files:
-            if f.endswith(".tmp"):
-                log.debug("Skipping file, this is a temporary file: (%s)", f)
+        remote_filename, remote_path = split_filepath(remote_filepath)
+        received = 0
+
+        with self.session(remote_path) as session:
+            ftp = session.ftp
+            buffer = session.buffer(self.blocksize)
+            ftp.voidcmd('TYPE I')
+            conn = ftp.transfercmd('RETR %s' % remote_filename, rest=offset)
+            with conn:
+                while received < length:
+                    size = conn.recv_into(buffer, min(self.blocksize, length - received))
+                    if not size:
+                        break
+                    written = 0
+                    while written < size:
+                        written += os.pwrite(fd, buffer[written:size], offset + received + written)
+                    received += size
+                    if report is not None:
+                        report(size)
+
+            # an early close makes the server abort the transfer (426)
+            try:
+                ftp.voidresp()
+            except (error_temp, error_perm, error_reply):
+                pass
+
+        if received != length:
+            raise Exception("Segment at %d of %s incomplete: %d of %d bytes" % (offset, remote_filepath, received, length))
+
+        return received
+
+    def download_segmented(self, remote_filepath, local_filepath, segments=4, progress=None, fsync=None,
+                           throttle=None):
+        """
+        Download a single file splitting it in byte ranges fetched in
+        parallel, each on its own session. Segments are written in place
+        into a preallocated temporary file which is renamed once complete.
+
+        Arguments
+        ---------
+        remote_filepath: str
+            Complete ftp path and filename
+        local_filepath: str
+            Final local path
+        segments: int
+            maximum number of ranges, bounded by the sessions allowed
+        progress: callable
+            called as progress(filename, received_bytes)
+        fsync: str
+            flush policy before publishing, see automatization.diskio
+        throttle: object Throttle
+            rate limits charged with every chunk received
+
+        Return
+        ------
+        size: int
+            downloaded bytes
+        """
+        remote_filename, _ = split_filepath(remote_filepath)
+        size = self.size(remote_filepath)
+
+        # tiny files are not worth splitting
+        segments = max(1, min(segments, self.max_sessions, size // self.min_segment or 1))
+        step = size // segments
+        ranges = [(i * step, step) for i in range(segments - 1)]
+        ranges.append(((segments - 1) * step, size - (segments - 1) * step))
+
+        received = [0]
+        lock = threading.Lock()
+
+        def report(amount):
+            with lock:
+                received[0] += amount
+                if progress is not None:
+                    progress(remote_filename, received[0])
+            # each range waits in its own thread
+            delay = throttle.reserve(amount) if throttle is not None else 0
+            if delay:
+                time.sleep(delay)
+
+        tmp_filepath = local_filepath + ".seg"
+        fd = os.open(tmp_filepath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if size:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(fd, 0, size)
+                else:
+                    os.ftruncate(fd, size)
+
+            began = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=segments) as executor:
+                futures = [executor.submit(self._download_range, remote_filepath, fd, offset, length, report)
+                           for offset, length in ranges]
+                total = sum(future.result() for future in futures)
+            self._observe_transfer(total, time.perf_counter() - began)
+
+            if total != size or os.fstat(fd).st_size != size:
+                raise Exception("Size mismatch for %s: %d of %d bytes" % (remote_filepath, total, size))
+        except:
+            os.close(fd)
+            os.remove(tmp_filepath)
+            raise
+
+        os.close(fd)
+        publish(tmp_filepath, local_filepath, fsync)
+
+        return size
+
+    def delete(self, remote_filepath):
+        """
+        Delete file on ftp
+        
+        Arguments
+        ---------
+        remote_filepath: str
+            ftp full path to file
+        """    
+        remote_filename, remote_path = split_filepath(remote_filepath)
+        
+        with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="dele"):
+            self._run(remote_path, lambda session: session.ftp.delete(remote_filename))
+
+    def delete_many(self, remote_filepaths):
+        """
+        Delete a batch of files over one session
+
+        Arguments
+        ---------
+        remote_filepaths: list of str
+            ftp full paths to files
+
+        Return
+        ------
+        deleted: list of str
+            files deleted, those refused by the server are logged and skipped
+        """
+        deleted = []
+        with self.session() as session:
+            for remote_filepath in remote_filepaths:
+                remote_filename, remote_path = split_filepath(remote_filepath)
+                session.chdir(remote_path)
+                try:
+                    with self.metrics.timer("ftp_phase_seconds", host=self.address, phase="dele"):
+                        session.ftp.delete(remote_filename)
+                except error_perm as e:
+                    log.warning("  Cannot delete %s: %s" % (remote_filepath, e))
+                    continue
+                deleted.append(remote_filepath)
+
+        return deleted
+
+
+class DeletePipeline(object):
+    """
+    Background stage deleting remote files once their local copy is
+    verified. Pending files are deleted in batches over one pooled session
+    while downloads keep running.
+    """
+
+    def __init__(self, _ftpManager, _on_deleted=None):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _ftpManager: object FTPManager
+            Remote connection
+        _on_deleted: callable
+            called with the list of remote files deleted by each batch
+        """
+        self.ftp = _ftpManager
+        self.on_deleted = _on_deleted
+        self.queue = queue.Queue()
+        self.deleted = []
+        self.failed = []
+        self.thread = threading.Thread(target=self._run, name="ftp-delete", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def put(self, remote_filepath):
+        """
+        Queue a verified file for deletion
+
+        Arguments
+        ---------
+        remote_filepath: str
+            ftp full path to file
+        """
+        self.queue.put(remote_filepath)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+
+            # take whatever else is already waiting
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                stop = True
+                batch = [f for f in batch if f is not None]
+
+            if not batch:
                 continue
 
-            datestr = f[2:-2]
-            
-            if not datestr in dates_found:
-                dates_found[datestr] = []
-            
-            dates_found[datestr].append(f[-2:])
+            try:
+                deleted = self.ftp.delete_many(batch)
+            except Exception as e:
+                log.warning("  Deleting %d files failed: %s" % (len(batch), e))
+                self.failed.extend(batch)
+                continue
+
+            self.deleted.extend(deleted)
+            self.failed.extend(f for f in batch if f not in deleted)
+            if self.on_deleted is not None and deleted:
+                self.on_deleted(deleted)
+
+    def close(self):
+        """
+        Wait for the pending deletes
+
+        Return
+        ------
+        deleted: list of str
+            remote files deleted
+        """
+        self.queue.put(None)
+        self.thread.join()
+        return self.deleted
+
+
+class DataManager(object):    
+    """
+    Manage data importing from Remote site to Local machine
+    """
+    
+    def __init__(self, _ftpManager, _inputData, _workers=1, _progress=None, _segments=1, _settle_time=10,
+                 _eager=False, _verify=None, _checksum="md5", _state=None, _budget=None,
+                 _rate_limit=None, _throttles=None, _policy=oldest_first, _metrics=None,
+                 _retries=None, _breaker=None, _retry_window=30, _fsync=None, _grib_index=False,
+                 _codec=None, _on_day=None):
+        """
+        constructor
         
-        # delete repeated elements        
-        for key, value in dates_found.items():
-            dates_found[key] = set(dates_found[key])
-            
-        # searching for all expecting files for this date
-        for key, ends_found in dates_found.items():
+        Arguments
+        ---------
+        _ftpManager: object FTPManager
+            Remote connection
+        _inputData: object EcmwfData
+            Configuration Parameters for local and remote places
+        _workers: int
+            files downloaded in parallel, bounded by the ftp sessions allowed
+        _progress: callable
+            called as progress(filename, received_bytes) while downloading
+        _segments: int
+            byte ranges fetched in parallel for each file, 1 disables it
+        _settle_time: int
+            seconds between the two listings of the first poll, used to tell
+            finished files from those still being written. 0 trusts the
+            first listing.
+        _eager: bool
+            download each step as soon as it is final, without waiting for
+            the whole day
+        _verify: callable
+            extra check after the size check, called as
+            verify(remote_filepath, local_filepath) on the .part file before
+            it gets its final name. Remote files are only deleted and local
+            files only published when it returns True.
+        _checksum: str
+            hash computed while downloading and stored in the day manifest
+            (md5, sha256, xxh64, ...). None only records sizes.
+        _state: object TransferState
+            durable store of each file transfer, used to resume after a
+            crash without repeating work
+        _budget: object FairBudget
+            transfer slots shared with other sites, one is held per file
+        _rate_limit: int
+            bytes per second allowed for this site
+        _throttles: list of TokenBucket
+            other rate limits shared with more sites, e.g. the global link
+        _policy: callable
+            order of the completed jobs, see automatization.scheduler
+        _metrics: object MetricsRegistry
+            registry receiving per site counters, the shared one by default
+        _retries: object RetryQueue
+            backoff of the failed files, one with default delays if None
+        _breaker: object CircuitBreaker
+            health of the ftp host, shared by the sites using it
+        _retry_window: float
+            seconds a cycle waits for failed files to be retried before
+            leaving them to the next cycle
+        _fsync: str
+            flush policy before a file gets its final name: None, "file"
+            or "dir", see automatization.diskio
+        _grib_index: bool
+            write a sidecar index of the GRIB messages of every file,
+            built while downloading (see automatization.grib). Needs
+            sequential downloads, _segments=1.
+        _codec: str
+            (de)compress every file while it is written, e.g. "gunzip" or
+            "zstd", see automatization.compression. Needs sequential
+            downloads, _segments=1, and partial files are not resumed.
+        _on_day: callable
+            called as on_day(job, local_path) once every step of a day is
+            on local disk, e.g. to submit its FLEXPART run to a
+            ProcessRunner (see automatization.bash). It should not block.
+        """
+        if _workers < 1:
+            raise Exception("At least one worker is required")
+
+        if _segments < 1:
+            raise Exception("At least one segment is required")
+
+        if _fsync not in FSYNC_POLICIES:
+            raise Exception("Unknown fsync policy %s" % _fsync)
+
+        if _grib_index and _segments > 1:
+            raise Exception("GRIB index is built from sequential downloads, segments must be 1")
+
+        # fails early on unknown codecs or missing packages
+        codec = get_codec(_codec) if _codec else None
+        if _inputData.mirrors and _segments > 1:
+            raise Exception("Mirrors are written from sequential downloads, segments must be 1")
+
+        if codec is not None and _segments > 1:
+            raise Exception("Codecs transform sequential downloads, segments must be 1")
+
+        if codec is not None and codec.compress and _grib_index:
+            raise Exception("GRIB index needs uncompressed local files")
         
-            # count how many files related to date
-            ends_c = 0        
-            for expected_end in ending:            
-                # this should not happend
-                if not expected_end in dates_found[key]:
-                    # this should not happen, error
-                    #print("Warning: not expected file output %s" % expected_end)
-                    pass
-                    #break
-                else:    
-                    ends_c += 1
+        self.input = _inputData
+        self.ftp = _ftpManager
+        self.workers = _workers
+        self.progress = _progress
+        self.segments = _segments
+        self.settle_time = _settle_time
+        self.pattern = _inputData.pattern
+
+        # remote listing of the previous poll, name to (size, modify)
+        self.snapshot = {}
+        self.polled = False
+        # files unchanged between the last two polls, and those that changed
+        self.stable = set()
+        self.unstable = set()
+        # date to {step: filename} found on ftp
+        self.dates_found = {}
+        # date to bitmasks of the steps found and of those still growing
+        self.present = {}
+        self.growing = {}
+        self.complete_dates = set()
+        self.partial_dates = set()
+
+        self.eager = _eager
+        self.verify = _verify
+        self.checksum = _checksum
+        self.state = _state
+        self.budget = _budget
+        self.bucket = TokenBucket(_rate_limit) if _rate_limit else None
+        buckets = [self.bucket] + list(_throttles or [])
+        self.throttle = Throttle(buckets) if any(buckets) else None
+        self.scheduler = TransferScheduler(_policy)
+        self.metrics = _metrics or metrics.REGISTRY
+        # date to filenames already downloaded while the day was running
+        self.fetched = {}
+        self.retries = _retries if _retries is not None else RetryQueue()
+        self.breaker = _breaker if _breaker is not None else CircuitBreaker()
+        self.retry_window = _retry_window
+        self.fsync = _fsync
+        self.grib_index = _grib_index
+        self.codec = _codec
+        self.on_day = _on_day
+        # only asked for local names, every file gets a fresh codec
+        self.naming = codec
+        # local day directories already created
+        self.directories = Directories()
             
-            # include if the same number    
-            if ends_c == len(ending):
-                succ_jobs.append(key)
-            # less files found than expected (not finished yet)    
-            elif ends_c < len(ending):
-                # add only if not exists
-                if not key in run_jobs:
-                    run_jobs.append(key)    
+    def _update_snapshot(self, entries):
+        """
+        Compare a listing with the previous one and update only the dates
+        whose files appeared, changed, disappeared or settled.
+
+        A file is stable when its size and modification time did not
+        change between two consecutive polls. Every date keeps a bitmask of
+        its steps found and growing, so a date is classified without
+        looking at its files again.
+
+        Arguments
+        ---------
+        entries: dict
+            file name to (size, modify) as returned by FTPManager.list_entries
+        """
+        changed = set(name for name, _ in entries.items() - self.snapshot.items())
+        removed = self.snapshot.keys() - entries.keys()
+        settled = self.unstable - changed - removed
+
+        self.stable -= changed | removed
+        self.stable |= settled
+        self.unstable = changed
+        self.snapshot = entries
+
+        pattern = self.pattern
+        dirty = set()
+        listed = []
+        for f in changed | removed | settled:
+            if f.endswith(".tmp"):
+                log.debug("Skipping file, this is a temporary file: (%s)", f)
+                continue
+
+            parsed = pattern.parse(f)
+            if parsed is None:
+                continue
+
+            datestr, step = parsed
+            bit = pattern.step_bits[step]
+            dirty.add(datestr)
+
+            if f in removed:
+                self.retries.discard(f)
+                self.dates_found.get(datestr, {}).pop(step, None)
+                self.present[datestr] = self.present.get(datestr, 0) & ~bit
+                self.growing[datestr] = self.growing.get(datestr, 0) & ~bit
             else:
-                raise Exception("Output file not expected to exists")        
-            
+                self.dates_found.setdefault(datestr, {})[step] = f
+                self.present[datestr] = self.present.get(datestr, 0) | bit
+                if f in changed:
+                    self.growing[datestr] = self.growing.get(datestr, 0) | bit
+                    listed.append((f, datestr, entries[f][0]))
+                else:
+                    self.growing[datestr] = self.growing.get(datestr, 0) & ~bit
+
+        if self.state is not None and listed:
+            self.state.listed(self.input.name, listed)
+
+        # classify the dates touched
+        for datestr in dirty:
+            present = self.present.get(datestr, 0)
+            self.complete_dates.discard(datestr)
+            self.partial_dates.discard(datestr)
+
+            if not present:
+                self.dates_found.pop(datestr, None)
+                self.present.pop(datestr, None)
+                self.growing.pop(datestr, None)
+                continue
+
+            # complete when no step is still growing and every step exists,
+            # steps already deleted after a verified download still count
+            if not self.growing.get(datestr) and \
+                    (present == pattern.full_mask or
+                     all(self._is_fetched(datestr, f) for f in pattern.missing(datestr, present))):
+                self.complete_dates.add(datestr)
+            else:
+                self.partial_dates.add(datestr)
+
+    def _local_name(self, filename):
+        """
+        Return
+        ------
+        local_name: str
+            name of a remote file once downloaded, changed by the codec
+        """
+        if self.naming is None:
+            return filename
+        return self.naming.local_name(filename)
+
+    def _is_fetched(self, datestr, filename):
+        """
+        Tell whether a step was already downloaded, in this process or by a
+        previous one (final local files are only published once complete).
+
+        Arguments
+        ---------
+        datestr: str
+            date as YYMMDD
+        filename: str
+            step file name
+        """
+        if filename in self.fetched.get(datestr, ()):
+            return True
+
+        if self.state is not None and self.state.state_of(self.input.name, filename) in (DOWNLOADED, DELETED):
+            return True
+
+        dateobj = self.pattern.date(datestr)
+        return os.path.exists(self.input.getLocalPath(dateobj) + self._local_name(filename))
+
+    def _has_local_copy(self, datestr, filename, download_path):
+        """
+        Tell whether a file still on ftp was already downloaded and verified,
+        so only its deletion is pending.
+
+        Arguments
+        ---------
+        datestr: str
+            date as YYMMDD
+        filename: str
+            step file name
+        download_path: str
+            local day directory
+        """
+        if filename in self.fetched.get(datestr, ()):
+            return True
+
+        if self.state is None or self.state.state_of(self.input.name, filename) != DOWNLOADED:
+            return False
+
+        return os.path.exists(download_path + self._local_name(filename))
+
+    def getJobs(self):
+        """
+        Discover on ftp how many jobs have finished regarding the output files.
+
+        Only entries new or changed since the previous poll are processed.
+        On the first poll the directory is listed twice, _settle_time
+        seconds apart, to have sizes to compare with.
+        
+        Return
+        ------
+        done_jobs: list of EcmwfJob
+            successfully finished job 
+        
+        exec_jobs: list of EcmwfJob
+            running jobs. All outputs are not yet found on ftp.
+        """
+        site = self.input.name
+        self.metrics.inc("datamanager_polls_total", site=site)
+
+        # connect to ic3 ftp and retrieve files
+        started = time.perf_counter()
+        entries = self.ftp.list_entries(self.input.getRemotePath())
+
+        if not self.polled:
+            self.polled = True
+            self._update_snapshot(entries)
+            if self.settle_time:
+                time.sleep(self.settle_time)
+                started = time.perf_counter()
+                entries = self.ftp.list_entries(self.input.getRemotePath())
+
+        self._update_snapshot(entries)
+        self.metrics.observe("datamanager_poll_seconds", time.perf_counter() - started, site=site)
+        self.metrics.set("datamanager_jobs", len(self.complete_dates), site=site, state="complete")
+        self.metrics.set("datamanager_jobs", len(self.partial_dates), site=site, state="running")
+
         # create ecmwf done jobs        
         done_jobs = []
-        for x in succ_jobs:
-            job = EcmwfJob.from_date(x)
+        for x in sorted(self.complete_dates):
+            job = EcmwfJob.from_date(x, self.pattern)
             done_jobs.append(job)
         
         # create ecmwf exec jobs    
         exec_jobs = []
-        for x in run_jobs:
-            job = EcmwfJob.from_date(x)
+        for x in sorted(self.partial_dates):
+            job = EcmwfJob.from_date(x, self.pattern)
             job.job_status = "EXEC"
             exec_jobs.append(job)
             
         return done_jobs, exec_jobs
             
-    def _download_ftp_data(self, filenames, download_path):
+    def _remote_size(self, filename, remote_filepath):
+        """
+        Size of a remote file, from the last listing when it is stable
+        there, which saves a SIZE command. Listings without sizes (e.g.
+        MLSD without the size fact) store -1, asked with SIZE instead.
+
+        Return
+        ------
+        size: int
+        """
+        entry = self.snapshot.get(filename)
+        if entry is not None and entry[0] >= 0 and filename in self.stable:
+            return entry[0]
+        return self.ftp.size(remote_filepath)
+
+    def _download_resumable(self, filename, remote_filepath, local_filepath, consumers=None, outputs=None):
+        """
+        Download into local_filepath + ".part", continuing a previous
+        partial transfer with REST when possible. The .part file is left
+        for the caller to verify and publish once its size matches the
+        remote one, or with a codec, once all the remote bytes went
+        through it.
+
+        Arguments
+        ---------
+        filename: str
+            remote file name
+        remote_filepath: str
+            Complete ftp path and filename
+        local_filepath: str
+            Final local path, the file is written next to it
+        consumers: list
+            stream consumers updated with the whole file content
+        outputs: list
+            stream consumers updated with the codec output
+
+        Return
+        ------
+        received: int
+            bytes transferred in this call
+        """
+        part_filepath = local_filepath + ".part"
+        codec = get_codec(self.codec) if self.codec else None
+
+        remote_size = self._remote_size(filename, remote_filepath)
+
+        # the codec state of a partial file is lost, codecs start again
+        offset = 0
+        if codec is None and os.path.exists(part_filepath):
+            offset = os.path.getsize(part_filepath)
+            if offset > remote_size:
+                log.debug("  Partial %s bigger than remote, starting again" % part_filepath)
+                offset = 0
+            elif offset:
+                log.debug("  Resuming %s at %d of %d bytes" % (filename, offset, remote_size))
+
+        # bytes already on disk are read once, only when resuming. The rate
+        # limits only see what crosses the network.
+        feed_file(consumers, part_filepath, offset)
+        network = list(consumers or [])
+        if self.throttle is not None:
+            network.append(self.throttle)
+
+        if self.state is not None:
+            self.state.downloading(self.input.name, filename, offset)
+
+        if codec is not None or offset < remote_size or not os.path.exists(part_filepath):
+            # chunks are large already, skip the buffered layer copy
+            with open(part_filepath, 'ab' if offset else 'wb', buffering=0) as outfile:
+                log.debug("  Writing to %s..." % (part_filepath))
+                if codec is not None:
+                    output = CodecWriter(outfile, codec, outputs)
+                else:
+                    output = outfile
+                    preallocate(outfile.fileno(), offset, remote_size - offset)
+                writer = ProgressWriter(output, filename, self.progress, offset)
+                try:
+                    self.ftp.download(remote_filepath, writer, rest=offset or None, consumers=network)
+                    if codec is not None:
+                        output.finish()
+                except:
+                    if self.state is not None:
+                        self.state.downloading(self.input.name, filename, writer.received)
+                    raise
+
+            if codec is not None and writer.received != remote_size:
+                raise Exception("Incomplete download of %s: %d of %d bytes" % (filename, writer.received, remote_size))
+
+        local_size = os.path.getsize(part_filepath)
+        if codec is None and local_size != remote_size:
+            # keep the partial file for the next chance
+            raise Exception("Incomplete download of %s: %d of %d bytes" % (filename, local_size, remote_size))
+
+        return remote_size - offset
+
+    def _verify_file(self, filename, remote_filepath, local_filepath):
+        """
+        Check a downloaded file against the remote one
+
+        Arguments
+        ---------
+        filename: str
+            remote file name
+        remote_filepath: str
+            Complete ftp path and filename
+        local_filepath: str
+            local path, the .part file before it is published
+
+        Return
+        ------
+        valid: bool
+            True when the local copy can replace the remote file
+        """
+        # transformed files differ in size, _download_resumable counted
+        # the bytes received instead
+        if not self.codec:
+            remote_size = self._remote_size(filename, remote_filepath)
+
+            local_size = os.path.getsize(local_filepath)
+            if local_size != remote_size:
+                log.warning("  Size mismatch for %s: %d local, %d remote" % (filename, local_size, remote_size))
+                return False
+
+        if self.verify is not None and not self.verify(remote_filepath, local_filepath):
+            log.warning("  Verification failed for %s" % filename)
+            return False
+
+        return True
+
+    def _download_file(self, filename, download_path, deleter=None, mirror_paths=()):
+        """
+        Download a single file from ftp into download_path
+
+        Arguments
+        ---------
+        filename: str
+            remote file name
+        download_path: str
+            local full path to place download
+        deleter: DeletePipeline
+            receives the remote file once the local copy is verified
+        mirror_paths: list of str
+            more local directories receiving a copy
+
+        Return
+        ------
+        filename: str
+            downloaded file, None if it failed or the host circuit is open
+        """
+        if not self.breaker.allow():
+            # not a failure of the file, it waits for the circuit
+            self.retries.postpone(filename, self.breaker.remaining())
+            log.debug("  Host circuit open, %s waits" % filename)
+            return None
+
+        log.debug("  Download %s..." % (filename))
+
+        try:
+            if self.budget is not None:
+                with self.budget.slot(self.input.name):
+                    self._transfer_file(filename, download_path, deleter, mirror_paths)
+            else:
+                self._transfer_file(filename, download_path, deleter, mirror_paths)
+        except Exception as e:
+            self.metrics.inc("datamanager_errors_total", site=self.input.name)
+            # a refused, wrong or unwritable file says nothing about the
+            # host health
+            if is_connection_error(e):
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            delay = self.retries.failed(filename)
+            log.warning("  Download of %s failed (%s), attempt %d, retry in %.1fs" %
+                        (filename, e, self.retries.attempts(filename), delay))
+            return None
+
+        self.breaker.success()
+        self.retries.succeeded(filename)
+        return filename
+
+    def _transfer_file(self, filename, download_path, deleter=None, mirror_paths=()):
+        """
+        Transfer, record and verify a single file, see _download_file
+        """
+        local_name = self._local_name(filename)
+        local_filepath = download_path + local_name
+        remote_filepath = self.input.getRemotePath() + "/" + filename
+
+        # published only once verified, readers never see a bad file
+        part_filepath = local_filepath + ".part"
+
+        started = time.time()
+        mirrors = []
+        indexer = None
+        if self.segments > 1:
+            log.debug("  Writing to %s in %d segments..." % (part_filepath, self.segments))
+            received = self.ftp.download_segmented(remote_filepath, part_filepath, self.segments,
+                                                   self.progress, None, self.throttle)
+            # segments arrive out of order, no stream to hash
+            record = {"size": received}
+        else:
+            counter = ByteCounter()
+            consumers = [counter]
+            if self.checksum:
+                consumers.append(HashConsumer(self.checksum))
+
+            # stages whose results are not part of the manifest
+            stages = []
+            # the index describes the local file, after the codec if any
+            indexer = GribIndexer() if self.grib_index else None
+            # copies for the other destinations, also of the local content
+            mirrors = [MirrorWriter(path + local_name, self.fsync) for path in mirror_paths]
+            local = ([indexer] if indexer is not None else []) + mirrors
+            outputs = local if self.codec else []
+            if not self.codec:
+                stages.extend(local)
+
+            try:
+                received = self._download_resumable(filename, remote_filepath, local_filepath,
+                                                    consumers + stages, outputs)
+            except:
+                for mirror in mirrors:
+                    mirror.abort()
+                raise
+            record = dict((consumer.name, consumer.result()) for consumer in consumers)
+            record["size"] = record.pop(counter.name)
+            if self.codec:
+                record["codec"] = self.codec
+                record["stored_size"] = os.path.getsize(part_filepath)
+
+        elapsed = max(time.time() - started, 1e-6)
+        log.debug("  Downloaded %s (%d bytes, %.1f KiB/s)" % (filename, received, received / elapsed / 1024))
+
+        try:
+            if not self._verify_file(filename, remote_filepath, part_filepath):
+                # a complete but wrong file would be resumed as is
+                os.remove(part_filepath)
+                raise Exception("Downloaded %s does not match the remote file" % filename)
+
+            publish(part_filepath, local_filepath, self.fsync)
+
+            if indexer is not None:
+                messages = indexer.result()
+                write_index(local_filepath, messages)
+                record["messages"] = len(messages)
+
+            Manifest(download_path).record(filename, record)
+        except:
+            # the copies of a file not recorded are dropped
+            for mirror in mirrors:
+                mirror.abort()
+            raise
+
+        self._publish_mirrors(mirrors, local_filepath)
+
+        if self.state is not None:
+            self.state.downloaded(self.input.name, filename, record["size"], record.get(self.checksum))
+
+        self.metrics.inc("datamanager_files_downloaded_total", site=self.input.name)
+        self.metrics.inc("datamanager_bytes_downloaded_total", received, site=self.input.name)
+
+        if deleter is not None:
+            deleter.put(remote_filepath)
+
+        return filename
+
+    def _publish_mirrors(self, mirrors, local_filepath):
+        """
+        Publish the copies of a verified file. A failed copy is made again
+        from the local file, and only logged if that fails too: the first
+        destination is the reference, the remote file is deleted anyway.
+
+        Arguments
+        ---------
+        mirrors: list of MirrorWriter
+            copies written while downloading
+        local_filepath: str
+            published file
+        """
+        for mirror in mirrors:
+            if mirror.publish():
+                continue
+            self.metrics.inc("datamanager_mirror_errors_total", site=self.input.name)
+            if mirror.repair(local_filepath):
+                log.info("  Mirror %s copied from %s" % (mirror.filepath, local_filepath))
+
+    def _download_ftp_data(self, filenames, download_path, deleter=None, mirror_paths=None):
         """
         Download data from ic3 ftp server and place it
         in climadat nas in the right folder.
+
+        With more than one worker, files are transferred in parallel, each
+        worker on its own pooled session. Concurrency never exceeds the
+        sessions allowed for the host. A failed file goes to the retry
+        queue without stopping the others.
         
         Arguments
         ---------
@@ -313,6 +1674,10 @@ class DataManager(object):
             complete full path with files to download
         download_path: str
             local full path to place download    
+        deleter: DeletePipeline
+            deletes each remote file once its local copy is verified
+        mirror_paths: list of str
+            more local directories receiving a copy of every file
 
         Return
         ------
@@ -322,30 +1687,34 @@ class DataManager(object):
         if not filenames:
             raise Exception("Specify a list of names")
 
-        # files download
-        downloaded_files = []
+        # create intermediate folders once per day
+        self.directories.ensure(download_path)
+
+        # an unavailable mirror does not stop the download
+        mirrors = []
+        for path in mirror_paths or []:
+            try:
+                self.directories.ensure(path)
+            except OSError as e:
+                self.metrics.inc("datamanager_mirror_errors_total", site=self.input.name)
+                log.warning(" Mirror %s unavailable: %s" % (path, e))
+            else:
+                mirrors.append(path)
+
+        workers = min(self.workers, len(filenames), getattr(self.ftp, "max_sessions", 1))
 
         # there is a set of files
-        for filename in filenames:
-            log.debug("  Download %s..." % (filename))
-            
-            # create intermediate folders if not exists
-            if not os.path.exists(os.path.dirname(download_path)):
-                os.makedirs(os.path.dirname(download_path))            
-                log.debug("  Folder created %s" % download_path)
-
-            # download and write file to disk
-            local_filepath = download_path + filename
-            with open(local_filepath, 'wb') as outfile:
-                log.debug("  Writing to %s..." % (local_filepath))
-                outfile = open(local_filepath, 'wb')
-                remote_filepath = self.input.getRemotePath() + "/" + filename
-                #log.debug("%s %s" % (remote_filepath, outfile))
-                self.ftp.download(remote_filepath, outfile)
-                
-                downloaded_files.append(filename)
+        if workers <= 1:
+            results = [self._download_file(filename, download_path, deleter, mirrors) for filename in filenames]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # keep the requested order
+                results = list(executor.map(lambda f: self._download_file(f, download_path, deleter, mirrors),
+                                            filenames))
 
-        return downloaded_files      
+        downloaded_files = [f for f in results if f is not None]
+        self.metrics.set("datamanager_retry_queue", len(self.retries), site=self.input.name)
+        return downloaded_files
         
     def _delete_ftp_data(self, filenames):
         """
@@ -359,9 +1728,8 @@ class DataManager(object):
         if not filenames:
             raise Exception("Specify a list of names")
 
-        for filename in filenames:            
-            remote_path = self.input.getRemotePath() + "/" + filename
-            self.ftp.delete(remote_path)
+        remote_paths = [self.input.getRemotePath() + "/" + filename for filename in filenames]
+        return self.ftp.delete_many(remote_paths)
        
     def download(self, is_simulation=False):
         """        
@@ -375,13 +1743,34 @@ class DataManager(object):
         is_simulation: bool
             Apply action but with no effect on real data. Test purposes.
         """
-
-        log.info("Analyzing FTP outputs...")
         try:
-            finished_jobs, exec_jobs = self.getJobs()
+            self.cycle(is_simulation)
         except socket.gaierror:
             log.debug("Internet/local network is down. Skipping check...")
-            return
+
+    def cycle(self, is_simulation=False):
+        """
+        One polling and transfer cycle, see download. Network errors are
+        raised, the caller decides when to try again.
+
+        Arguments
+        ---------
+        is_simulation: bool
+            Apply action but with no effect on real data. Test purposes.
+
+        Return
+        ------
+        finished_jobs: list of EcmwfJob
+            days found complete on this poll
+        exec_jobs: list of EcmwfJob
+            days still being produced
+        """
+        with self.metrics.timer("datamanager_cycle_seconds", site=self.input.name):
+            return self._download_cycle(is_simulation)
+
+    def _download_cycle(self, is_simulation=False):
+        log.info("Analyzing FTP outputs...")
+        finished_jobs, exec_jobs = self.getJobs()
         
         log.info("---------------------------")
         log.info("")
@@ -393,23 +1782,176 @@ class DataManager(object):
 
         log.debug(os.getcwd())
 
-        print("Checking completed jobs...")
-        for job in finished_jobs:    
-            pattern = self.input.getRemotePath() + "/EN" + job.simulation_date.strftime("%y%m%d") + "*"
-            
-            climanas_path = self.input.getLocalPath(job.simulation_date)
-            
-            log.info(" Downloading from remote %s to %s ..." % (pattern, climanas_path))        
+        if self.eager:
+            log.info("Checking running jobs...")
+            for job in exec_jobs:
+                self._download_ready_steps(job, is_simulation)
+
+        log.info("Checking completed jobs...")
+        # deletes run while the next files are downloaded
+        deleter = None if is_simulation else DeletePipeline(self.ftp, self._on_deleted).start()
+
+        self.scheduler.clear()
+        for job in finished_jobs:
+            self.scheduler.push(job)
+
+        # remote files already handed to the deleter in this cycle
+        queued = set()
+        # jobs with files waiting for a retry
+        pending = []
+        deadline = time.monotonic() + self.retry_window
+
+        try:
+            while True:
+                job = self.scheduler.pop()
+                if job is None:
+                    # healthy days went first, now wait for the failed files
+                    # when they are due before the retry window closes. A host
+                    # refusing transfers is tried again on the next cycle.
+                    if not pending or self.breaker.is_open():
+                        break
+                    waiting = set(f for pending_job in pending for f in pending_job.get_outputs_filenames())
+                    delay = self.retries.due_in(waiting)
+                    if delay is None or time.monotonic() + delay > deadline:
+                        break
+                    time.sleep(delay)
+                    for job in pending:
+                        self.scheduler.push(job)
+                    pending = []
+                    continue
+
+                if not self._download_job(job, deleter, queued, is_simulation):
+                    pending.append(job)
+
+            for job in pending:
+                log.info(" Day %s incomplete, failed files are retried later" % self.pattern.datestr(job.date))
+        finally:
+            # the delete thread must not outlive a failed cycle
+            if deleter is not None:
+                log.debug(" Waiting for pending deletes on FTP...")
+                deleted = deleter.close()
+                log.info(" Deleted %d files from FTP" % len(deleted))
+
+        return finished_jobs, exec_jobs
+
+    def _download_job(self, job, deleter, queued, is_simulation=False):
+        """
+        Transfer the steps of a completed job not fetched yet. Files waiting
+        for a retry are skipped and failures do not stop the other files.
+
+        Arguments
+        ---------
+        job: EcmwfJob
+            completed job
+        deleter: DeletePipeline
+            deletes the verified remote files
+        queued: set of str
+            remote files already given to the deleter in this cycle
+        is_simulation: bool
+            Apply action but with no effect on real data. Test purposes.
+
+        Return
+        ------
+        complete: bool
+            True when every step is on local disk
+        """
+        pattern = self.input.getRemotePath() + "/" + self.pattern.glob(job.simulation_date)
+
+        climanas_path = self.input.getLocalPath(job.simulation_date)
+        datestr = self.pattern.datestr(job.date)
+
+        # steps already fetched are not downloaded again
+        on_server = set(self.dates_found.get(datestr, {}).values())
+        fetched = set(f for f in on_server if self._has_local_copy(datestr, f, climanas_path))
+        filenames = [f for f in job.get_outputs_filenames() if f in on_server and f not in fetched]
+        ready = [f for f in filenames if self.retries.ready(f)]
+
+        log.info(" Downloading from remote %s to %s ..." % (pattern, climanas_path))
+        if is_simulation:
+            return True
+
+        try:
+            self.directories.ensure(climanas_path)
+        except OSError as e:
+            # e.g. the NAS is not mounted, the other days still go
+            log.error(" Cannot create %s for day %s: %s" % (climanas_path, datestr, e))
+            return False
+
+        downloaded = []
+        if ready:
+            downloaded = self._download_ftp_data(ready, climanas_path, deleter,
+                                                 self.input.getMirrorPaths(job.simulation_date))
+            queued.update(self.input.getRemotePath() + "/" + f for f in downloaded)
+
+        # eager or previous runs left these on ftp
+        for f in sorted(fetched):
+            remote_filepath = self.input.getRemotePath() + "/" + f
+            if remote_filepath not in queued:
+                deleter.put(remote_filepath)
+                queued.add(remote_filepath)
+
+        if len(downloaded) < len(filenames):
+            # keep track of the steps done until the rest succeeds
+            self.fetched.setdefault(datestr, set()).update(fetched, downloaded)
+            return False
+
+        self.fetched.pop(datestr, None)
+        log.info(" Day %s done" % datestr)
+
+        if self.on_day is not None:
             try:
-                if not is_simulation:
-                    self._download_ftp_data(job.get_outputs_filenames(), climanas_path)
-            except error_perm:
-                log.debug("Error downloading file, skipping for next chance...")
-                lob.debug(traceback.print_exc())
-                break
-       
-            log.debug(" Deleting files from FTP...")
+                self.on_day(job, climanas_path)
+            except Exception as e:
+                log.error(" Post-processing of day %s failed: %s" % (datestr, e))
+        return True
+
+    def queue_depth(self):
+        """
+        Return
+        ------
+        depth: int
+            completed jobs still waiting for their transfer
+        """
+        return self.scheduler.queue_depth()
+
+    def _on_deleted(self, remote_filepaths):
+        """
+        Record files removed by the delete pipeline
+        """
+        self.metrics.inc("datamanager_files_deleted_total", len(remote_filepaths), site=self.input.name)
+
+        if self.state is not None:
+            self.state.deleted(self.input.name, [split_filepath(f)[0] for f in remote_filepaths])
+
+    def _download_ready_steps(self, job, is_simulation=False):
+        """
+        Eager mode: download the steps of a running job which are already
+        final on ftp, so a day does not wait for its last step.
+
+        Arguments
+        ---------
+        job: EcmwfJob
+            running job
+        is_simulation: bool
+            Apply action but with no effect on real data. Test purposes.
+        """
+        datestr = self.pattern.datestr(job.date)
+        climanas_path = self.input.getLocalPath(job.simulation_date)
+        fetched = self.fetched.setdefault(datestr, set())
+        ready = sorted(f for f in self.dates_found.get(datestr, {}).values()
+                       if f in self.stable and not self._has_local_copy(datestr, f, climanas_path))
+
+        ready = [f for f in ready if self.retries.ready(f)]
+
+        if ready:
+            log.info(" Early download of %s to %s ..." % (", ".join(ready), climanas_path))
             if not is_simulation:
-                self._delete_ftp_data(job.get_outputs_filenames())   
-        
-    
+                try:
+                    self.directories.ensure(climanas_path)
+                except OSError as e:
+                    log.error(" Cannot create %s for day %s: %s" % (climanas_path, datestr, e))
+                    return
+                fetched.update(self._download_ftp_data(ready, climanas_path,
+                                                       mirror_paths=self.input.getMirrorPaths(job.simulation_date)))
+
+        log.info("  Day %s: %d of %d steps downloaded" % (datestr, len(fetched), len(self.pattern.steps)))
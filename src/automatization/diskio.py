@@ -0,0 +1,231 @@
+"""
+Local disk helpers of the download path.
+
+Files are written into a temporary name, with their space reserved up
+front, and published under their final name with an atomic rename. How
+much is flushed to disk before publishing is a policy:
+
+    None    rely on the page cache (fastest)
+    "file"  fsync the file before renaming it
+    "dir"   also fsync the directory after the rename, so the new name
+            survives a crash
+
+    dmsites = DataManager(ftp, sitesArgs, _fsync="file")
+
+MirrorWriter tees the stream of a download into another destination, which
+is published on its own.
+
+"""
+
+import os
+import shutil
+import threading
+import logging as log
+
+try:
+    import ctypes
+    import ctypes.util
+
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _fallocate = _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+except (OSError, AttributeError, TypeError):
+    _fallocate = None
+
+
+FSYNC_POLICIES = (None, "file", "dir")
+
+# fallocate mode reserving blocks without changing the file size
+FALLOC_FL_KEEP_SIZE = 1
+
+
+def preallocate(fd, offset, length):
+    """
+    Reserve disk blocks for a file about to be written, keeping its size,
+    so a partial file still tells how much was received. Does nothing
+    where the system or the file system does not support it.
+
+    Arguments
+    ---------
+    fd: int
+        file descriptor
+    offset: int
+        first byte to reserve
+    length: int
+        bytes to reserve
+
+    Return
+    ------
+    reserved: bool
+    """
+    if length <= 0 or _fallocate is None:
+        return False
+
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        log.debug("  Preallocation not supported: %s" % os.strerror(ctypes.get_errno()))
+        return False
+
+    return True
+
+
+def fsync_path(path):
+    """
+    Flush a file or directory to disk
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def publish(tmp_filepath, final_filepath, fsync=None):
+    """
+    Give a complete file its final name atomically
+
+    Arguments
+    ---------
+    tmp_filepath: str
+        complete file
+    final_filepath: str
+        name readers look for
+    fsync: str
+        one of FSYNC_POLICIES
+    """
+    if fsync not in FSYNC_POLICIES:
+        raise Exception("Unknown fsync policy %s" % fsync)
+
+    if fsync:
+        fsync_path(tmp_filepath)
+
+    os.replace(tmp_filepath, final_filepath)
+
+    if fsync == "dir":
+        fsync_path(os.path.dirname(os.path.abspath(final_filepath)))
+
+
+class Directories(object):
+    """
+    Local directories known to exist, created at most once
+    """
+
+    def __init__(self):
+        self.known = set()
+        self.lock = threading.Lock()
+
+    def ensure(self, path):
+        """
+        Create a directory and its parents unless already done
+
+        Arguments
+        ---------
+        path: str
+            directory, a trailing slash is ignored
+        """
+        path = os.path.dirname(path) if path.endswith("/") else path
+        if path in self.known:
+            return
+
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            self.known.add(path)
+
+
+class MirrorWriter(object):
+    """
+    Stream consumer writing a copy of the file being downloaded under
+    another name, e.g. a scratch area next to the NAS. A failing copy stops
+    receiving data without affecting the download.
+    """
+    name = "mirror"
+
+    def __init__(self, _filepath, _fsync=None):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _filepath: str
+            final name of the copy, its directory must exist
+        _fsync: str
+            one of FSYNC_POLICIES
+        """
+        self.filepath = _filepath
+        self.part_filepath = _filepath + ".part"
+        self.fsync = _fsync
+        self.error = None
+        self.outfile = None
+        try:
+            self.outfile = open(self.part_filepath, "wb", buffering=0)
+        except OSError as e:
+            self._fail(e)
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+            log.warning("  Mirror %s failed: %s" % (self.filepath, error))
+        self.abort()
+
+    def update(self, chunk):
+        if self.error is not None:
+            return
+        try:
+            view = memoryview(chunk)
+            while view:
+                view = view[self.outfile.write(view):]
+        except OSError as e:
+            self._fail(e)
+
+    def result(self):
+        return self.error is None
+
+    def publish(self):
+        """
+        Give the complete copy its final name
+
+        Return
+        ------
+        published: bool
+        """
+        if self.error is not None:
+            return False
+        try:
+            self.outfile.close()
+            publish(self.part_filepath, self.filepath, self.fsync)
+        except OSError as e:
+            self._fail(e)
+            return False
+        return True
+
+    def repair(self, source_filepath):
+        """
+        Copy a failed mirror from the published file instead, the only case
+        the file is read back
+
+        Return
+        ------
+        published: bool
+        """
+        try:
+            shutil.copyfile(source_filepath, self.part_filepath)
+            publish(self.part_filepath, self.filepath, self.fsync)
+        except OSError as e:
+            log.error("  Mirror %s not repaired: %s" % (self.filepath, e))
+            self.abort()
+            return False
+        self.error = None
+        return True
+
+    def abort(self):
+        """
+        Drop the partial copy, when the download fails
+        """
+        if self.outfile is not None:
+            try:
+                self.outfile.close()
+            except OSError:
+                pass
+        try:
+            os.remove(self.part_filepath)
+        except OSError:
+            pass
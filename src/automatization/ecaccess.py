@@ -1,10 +1,480 @@
 """
+Interface to the ecaccess command line tools.
+
+Every command runs through an EcaccessRunner: a bounded number of
+processes at a time, a timeout per command, stdout parsed line by line
+while it arrives and read-only listings cached for a few seconds.
+
+    ecaccess = Ecaccess(_max_processes=4, _cache_ttl=60)
+    jobs = ecaccess.get_list_jobs()
+    future = ecaccess.run_async("files_list", "ec:/user/data")
+
+Whole date ranges are submitted or deleted in bulk, skipping the dates
+which already have a job:
+
+    job_ids = ecaccess.submit_range("flexpart_local_%Y%m%d.sh", date(2014, 1, 1), date(2014, 3, 31))
 
 """
 
+import os
+import re
+import time
+import bisect
+import threading
 import subprocess
+import logging as log
+
+from enum import IntEnum
+from array import array
+from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from automatization.scheduler import TokenBucket
+from automatization.patterns import DEFAULT_PATTERN
+from automatization.bash import ProcessRunner
+
+
+class JobStatus(IntEnum):
+    """
+    ecaccess job states, see EcmwfJob.jobs_status
+    """
+    INIT = 1
+    STDBY = 2
+    EXEC = 3
+    WAIT = 4
+    RETR = 5
+    STOP = 6
+    DONE = 7
+
+
+# jobs in these states are not submitted again
+ACTIVE_STATUSES = ("INIT", "WAIT", "EXEC", "DONE")
+
+MONTHS = dict((name, number + 1) for number, name in
+              enumerate(["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]))
+
+
+def date_range(start, end):
+    """
+    Days from start to end, both included
+
+    Arguments
+    ---------
+    start: date
+        first day
+    end: date
+        last day
+
+    Return
+    ------
+    days: list of date
+    """
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+
+def script_date(script_name):
+    """
+    Simulated date of a script, written in its name as YYYYMMDD
+    (e.g. SOMETHING_local_20140201.sh)
+
+    Return
+    ------
+    simulation_date: date
+        None when the name has no date
+    """
+    found = re.findall(r"(?<!\d)(\d{8})(?!\d)", os.path.basename(script_name))
+    if not found:
+        return None
+    return datetime.strptime(found[-1], "%Y%m%d").date()
+
+
+def submit_datetime(month, day, hour, now=None):
+    """
+    Submission time of a job as shown by ecaccess-job-list, which has no
+    year: the latest one not in the future is taken.
+
+    Arguments
+    ---------
+    month: str
+        month abbreviation, e.g. May
+    day: str
+        day of the month
+    hour: str
+        HH:MM
+    now: datetime
+        reference time, the current one by default
+
+    Return
+    ------
+    submitted: datetime
+    """
+    now = now or datetime.now()
+    hh, mm = hour.split(":")
+    month, day, hh, mm = MONTHS[month], int(day), int(hh), int(mm)
+
+    # a day of margin for clock and time zone differences
+    year = now.year
+    if (month, day) > (now.month, now.day + 1):
+        year -= 1
+    if month == 2 and day == 29:
+        # leap day, go back to a leap year
+        while year % 4 or (year % 100 == 0 and year % 400):
+            year -= 1
+    return datetime(year, month, day, hh, mm)
+
+
+class JobTable(object):
+    """
+    Columnar table of the jobs listed by ecaccess-job-list.
+
+    Every column is an array indexed by row, statuses are JobStatus codes
+    and rows are indexed by status, gateway and simulated date, so
+    filtering thousands of jobs is a few set operations. Tables are not
+    modified once parsed and may be shared.
+
+        table = ecaccess.get_job_table()
+        rows = table.select(status=["EXEC", "WAIT"], start=date(2014, 1, 1))
+        jobs = table.jobs(rows)
+
+    """
+    __slots__ = ("job_ids", "statuses", "gateways", "gateway_names", "run_numbers", "submitted",
+                 "simulated", "scripts", "by_status", "by_gateway", "by_date", "dates")
+
+    def __init__(self):
+        self.job_ids = array("q")
+        self.statuses = array("b")
+        # gateway codes and their names
+        self.gateways = array("h")
+        self.gateway_names = []
+        self.run_numbers = array("l")
+        # submission posix time
+        self.submitted = array("d")
+        # simulated date ordinal, 0 when unknown
+        self.simulated = array("l")
+        self.scripts = []
+
+        # JobStatus to rows, gateway code to rows, date ordinal to rows
+        self.by_status = {}
+        self.by_gateway = {}
+        self.by_date = {}
+        # sorted known date ordinals
+        self.dates = []
+
+    @classmethod
+    def parse(cls, lines, now=None):
+        """
+        Build a table from ecaccess-job-list output
+
+        Arguments
+        ---------
+        lines: iterable of str
+            output lines, headers and malformed lines are skipped
+        now: datetime
+            reference time to find the submission year
+
+        Return
+        ------
+        table: JobTable
+        """
+        parser = JobTableParser(now)
+        for line in lines:
+            parser.update(line)
+        return parser.result()
+
+    def __len__(self):
+        return len(self.job_ids)
+
+    def select(self, status=None, gateway=None, start=None, end=None):
+        """
+        Rows matching every given filter
+
+        Arguments
+        ---------
+        status: str, JobStatus or list of them
+            job states
+        gateway: str or list of str
+            gateway names
+        start: date
+            first simulated date
+        end: date
+            last simulated date, included
+
+        Return
+        ------
+        rows: list of int
+            sorted row numbers
+        """
+        selected = None
+
+        if status is not None:
+            statuses = [status] if isinstance(status, (str, JobStatus)) else status
+            codes = [s if isinstance(s, JobStatus) else JobStatus[s] for s in statuses]
+            selected = set().union(*[self.by_status.get(code, ()) for code in codes])
+
+        if gateway is not None:
+            names = [gateway] if isinstance(gateway, str) else gateway
+            codes = [self.gateway_names.index(n) for n in names if n in self.gateway_names]
+            rows = set().union(*[self.by_gateway[code] for code in codes])
+            selected = rows if selected is None else selected & rows
+
+        if start is not None or end is not None:
+            low = bisect.bisect_left(self.dates, start.toordinal()) if start is not None else 0
+            high = bisect.bisect_right(self.dates, end.toordinal()) if end is not None else len(self.dates)
+            rows = set().union(*[self.by_date[d] for d in self.dates[low:high]])
+            selected = rows if selected is None else selected & rows
+
+        if selected is None:
+            return list(range(len(self)))
+        return sorted(selected)
+
+    def status(self, row):
+        return JobStatus(self.statuses[row])
+
+    def simulation_date(self, row):
+        return date.fromordinal(self.simulated[row]) if self.simulated[row] else None
+
+    def statuses_of(self, day):
+        """
+        Return
+        ------
+        statuses: set of JobStatus
+            states of the jobs of a simulated date
+        """
+        return set(JobStatus(self.statuses[row]) for row in self.by_date.get(day.toordinal(), ()))
+
+    def latest_by_date(self, status=None):
+        """
+        Return
+        ------
+        rows: dict
+            simulated date to the row of its highest job id, among the rows
+            in the given states
+        """
+        latest = {}
+        for row in self.select(status=status):
+            ordinal = self.simulated[row]
+            if ordinal and (ordinal not in latest or self.job_ids[row] > self.job_ids[latest[ordinal]]):
+                latest[ordinal] = row
+        return dict((date.fromordinal(o), row) for o, row in latest.items())
+
+    def job(self, row):
+        """
+        Return
+        ------
+        job: EcmwfJob
+            full object of a row
+        """
+        return EcmwfJob(_job_id=self.job_ids[row], _gateway=self.gateway_names[self.gateways[row]],
+                        _job_status=self.status(row).name,
+                        _run_number=self.run_numbers[row] if self.run_numbers[row] >= 0 else None,
+                        _date=datetime.fromtimestamp(self.submitted[row]),
+                        _simulation_date=self.simulation_date(row), _scriptName=self.scripts[row])
+
+    def jobs(self, rows=None):
+        """
+        Return
+        ------
+        jobs: list of EcmwfJob
+            of the given rows, all by default
+        """
+        if rows is None:
+            rows = range(len(self))
+        return [self.job(row) for row in rows]
+
+
+class JobTableParser(object):
+    """
+    Build a JobTable line by line, while ecaccess-job-list is still
+    writing its output
+    """
+
+    def __init__(self, _now=None):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _now: datetime
+            reference time to find the submission year
+        """
+        self.table = JobTable()
+        self.now = _now or datetime.now()
+        self.gateway_codes = {}
+        self.date_cache = {}
+
+    def update(self, line):
+        """
+        Add a line, headers and malformed lines are skipped
+        """
+        params = line.split()
+        if len(params) != 9 or not params[0].isdigit():
+            return
+
+        status = JobStatus.__members__.get(params[2])
+        if status is None or params[4] not in MONTHS:
+            log.debug("Skipping job line %s" % line)
+            return
+
+        table = self.table
+        row = len(table.job_ids)
+        gateway = self.gateway_codes.get(params[1])
+        if gateway is None:
+            gateway = self.gateway_codes[params[1]] = len(table.gateway_names)
+            table.gateway_names.append(params[1])
+
+        script_name = params[8]
+        if script_name not in self.date_cache:
+            simulation_date = script_date(script_name)
+            self.date_cache[script_name] = simulation_date.toordinal() if simulation_date else 0
+        ordinal = self.date_cache[script_name]
+
+        table.job_ids.append(int(params[0]))
+        table.statuses.append(status)
+        table.gateways.append(gateway)
+        table.run_numbers.append(int(params[3]) if params[3].isdigit() else -1)
+        table.submitted.append(submit_datetime(params[4], params[5], params[6], self.now).timestamp())
+        table.simulated.append(ordinal)
+        table.scripts.append(script_name)
+
+        table.by_status.setdefault(status, set()).add(row)
+        table.by_gateway.setdefault(gateway, set()).add(row)
+        if ordinal:
+            table.by_date.setdefault(ordinal, set()).add(row)
+
+    def result(self):
+        self.table.dates = sorted(self.table.by_date)
+        return self.table
+
+
+class LineParser(object):
+    """
+    Collect the non empty output lines
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def update(self, line):
+        if line:
+            self.lines.append(line)
+
+    def result(self):
+        return self.lines
+
+
+class EcaccessRunner(object):
+    """
+    Run ecaccess commands with a concurrency limit, timeouts and a TTL
+    cache of read-only results
+    """
+
+    def __init__(self, _max_processes=4, _timeout=300, _cache_ttl=60):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _max_processes: int
+            commands running at the same time
+        _timeout: float
+            seconds after which a command is killed
+        _cache_ttl: float
+            seconds a cached result is reused, 0 disables the cache
+        """
+        if _max_processes < 1:
+            raise Exception("At least one process is required")
+
+        self.max_processes = _max_processes
+        self.timeout = _timeout
+        self.cache_ttl = _cache_ttl
+        self.processes = ProcessRunner(_max_processes, _timeout)
+        # command to (expiry, result)
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def run(self, args, on_line=None, stdin=None, timeout=None):
+        """
+        Run a command, waiting for a free process slot
+
+        Arguments
+        ---------
+        args: list of str
+            command and its arguments
+        on_line: callable
+            called with every stdout line, without the line end, as soon as
+            it is read
+        stdin: file object
+            standard input of the command
+        timeout: float
+            seconds before the command is killed, the runner one by default
+
+        Return
+        ------
+        lines: list of str
+            stdout lines when on_line is not given
+        """
+        return self.processes.run(args, on_line=on_line, stdin=stdin, timeout=timeout).stdout
+
+    def cached(self, args, parser):
+        """
+        Run a read-only command, reusing a recent result
+
+        Arguments
+        ---------
+        args: list of str
+            command and its arguments
+        parser: callable
+            returns an object with update(line), fed every stdout line
+            while the command runs, and result()
+
+        Return
+        ------
+        result: object
+            parsed result, shared with other callers
+        """
+        key = tuple(args)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        stream = parser()
+        self.run(args, on_line=stream.update)
+        result = stream.result()
+        if self.cache_ttl:
+            with self.lock:
+                self.cache[key] = (time.monotonic() + self.cache_ttl, result)
+        return result
+
+    def invalidate(self, command=None):
+        """
+        Forget cached results
 
-from datetime import datetime, date
+        Arguments
+        ---------
+        command: str
+            only those of this command, e.g. ecaccess-job-list
+        """
+        with self.lock:
+            if command is None:
+                self.cache.clear()
+            else:
+                for key in [k for k in self.cache if k[0] == command]:
+                    del self.cache[key]
+
+    def submit(self, function, *args):
+        """
+        Run a function in the runner threads
+
+        Return
+        ------
+        future: concurrent.futures.Future
+        """
+        return self.processes.submit_call(function, *args)
+
+    def close(self):
+        self.processes.close()
 
 
 class Ecaccess(object):
@@ -12,38 +482,52 @@ class Ecaccess(object):
     ecacccess interface to ecaccess package
     """
 
-    def get_list_jobs(self):
+    def __init__(self, _max_processes=4, _timeout=300, _cache_ttl=60, _runner=None):
         """
-        ecaccess-job-list
+        Constructor
+
+        Arguments
+        ---------
+        _max_processes: int
+            ecaccess commands running at the same time
+        _timeout: float
+            seconds after which a command is killed
+        _cache_ttl: float
+            seconds job and file listings are reused, 0 disables the cache
+        _runner: object EcaccessRunner
+            runner shared with other instances, replaces the other arguments
         """
-        # get jobs
-        bashCommand = "ecaccess-job-list"
-        jobs_list = []
+        self.runner = _runner or EcaccessRunner(_max_processes, _timeout, _cache_ttl)
 
-        # run command line
-        process = subprocess.Popen(bashCommand.split(), stdout=subprocess.PIPE)
-        output_byte = process.communicate()[0]
+    def run_async(self, method, *args):
+        """
+        Call one of the methods below without waiting for it
 
-        output_str = output_byte.decode("utf-8")
-        
-        # process output
-        for line in output_str.split('\n'):
-            splitted = line.split(" ")
-            params = [i for i in splitted if i != '']
-            # debug purpose
-            # print(params)
+        Arguments
+        ---------
+        method: str
+            method name, e.g. get_list_jobs or submit_job
 
-            # empty line    
-            if not params:
-                continue
+        Return
+        ------
+        future: concurrent.futures.Future
+            with the method result
+        """
+        return self.runner.submit(getattr(self, method), *args)
 
-            new_job = EcmwfJob(params)
-            jobs_list.append(new_job)
-            #print(new_job)
-            #print("")
+    def get_job_table(self):
+        """
+        ecaccess-job-list as a JobTable
+        """
+        return self.runner.cached(["ecaccess-job-list"], JobTableParser)
 
-        # print(jobs_list)
-        return jobs_list
+    def get_list_jobs(self):
+        """
+        ecaccess-job-list
+
+        return: list of EcmwfJob
+        """
+        return self.get_job_table().jobs()
 
     def submit_job(self, script_name):
         """
@@ -51,31 +535,19 @@ class Ecaccess(object):
 
         return: assigned job id
         """
-        # get jobs
-        bashCommand = "ecaccess-job-submit %s" % (script_name)
-
-        # run command line
-        process = subprocess.Popen(bashCommand.split(), stdout=subprocess.PIPE)
-        output_byte = process.communicate()[0]
+        output = self.runner.run(["ecaccess-job-submit", script_name])
+        self.runner.invalidate("ecaccess-job-list")
 
-        job_id = output_byte.decode("utf-8")
+        job_id = "".join(output)
         return int(job_id)
 
-
     def delete_job(self, job_id):
         """
-        ecaccess-job-delete script_name
-
-        return: assigned job id
+        ecaccess-job-delete job_id
         """
-        # get jobs
-        bashCommand = "ecaccess-job-delete %s" % (job_id)
+        self.runner.run(["ecaccess-job-delete", str(job_id)])
+        self.runner.invalidate("ecaccess-job-list")
 
-        # run command line
-        process = subprocess.Popen(bashCommand.split(), stdout=subprocess.PIPE)
-        process.communicate()[0]
-
-        
     def files_list(self, pattern):
         """
         List ecmwf files
@@ -85,32 +557,162 @@ class Ecaccess(object):
         if not pattern:
             raise Exception("A folder is required")
 
-        # get jobs
-        bashCommand = "ecaccess-file-dir %s" % (pattern)
+        return list(self.runner.cached(["ecaccess-file-dir", pattern], LineParser))
 
-        # run command line
-        process = subprocess.Popen(bashCommand.split(), stdout=subprocess.PIPE)
-        output_byte = process.communicate()[0]
+    def download_data(self, remote_source, destination):
+        """
+        Data to download, answering yes to every overwrite question
+        """
+        log.debug("ecaccess-file-mget %s %s" % (remote_source, destination))
 
-        files_raw = output_byte.decode("utf-8")
-        files = files_raw.split('\n')
-        # removing empty positions
-        clean = [i for i in files if i != '']
-        return clean
+        yes = subprocess.Popen(["yes"], stdout=subprocess.PIPE)
+        try:
+            self.runner.run(["ecaccess-file-mget", remote_source, destination], stdin=yes.stdout)
+        finally:
+            yes.kill()
+            yes.wait()
+            yes.stdout.close()
 
-    def download_data(self, remote_source, destination):
+    def _bulk(self, function, items, max_parallel, rate):
         """
-        Data to download
+        Apply function to every item with bounded parallelism and at most
+        rate calls per second
+
+        Return
+        ------
+        results: dict
+            item to its result, failed items are logged and left out
         """
-        # get jobs
-        bashCommand = "yes | ecaccess-file-mget %s %s" % (remote_source, destination)
-        print("DEBUG: %s" % bashCommand)
+        bucket = TokenBucket(rate, 1) if rate else None
 
-        # run command line
-        process = subprocess.Popen(bashCommand.split(), stdout=subprocess.PIPE)
-        process.communicate()[0]
+        def call(item):
+            if bucket is not None:
+                bucket.consume(1)
+            return function(item)
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(items) or 1))) as executor:
+            futures = [(item, executor.submit(call, item)) for item in items]
+            for item, future in futures:
+                try:
+                    results[item] = future.result()
+                except Exception as e:
+                    log.error("ecaccess failed for %s: %s" % (item, e))
+
+        return results
+
+    def jobs_by_date(self, statuses=None):
+        """
+        Return
+        ------
+        jobs: dict
+            simulation date to the latest job of the date, only jobs in the
+            given statuses when set
+        """
+        table = self.get_job_table()
+        rows = table.latest_by_date(statuses or None)
+        return dict((day, table.job(row)) for day, row in rows.items())
+
+    def submit_jobs(self, scripts, max_parallel=4, rate=None, skip_active=True):
+        """
+        Submit many scripts, one per simulated date
+
+        Arguments
+        ---------
+        scripts: dict or list
+            date to script name, or script names with their date in the
+            name (see script_date)
+        max_parallel: int
+            submissions running at the same time
+        rate: float
+            submissions started per second, no limit if None
+        skip_active: bool
+            do not submit the dates with a job in ACTIVE_STATUSES
+
+        Return
+        ------
+        job_ids: dict
+            date to its job id, the existing one for skipped dates. Failed
+            submissions are logged and left out.
+        """
+        if not isinstance(scripts, dict):
+            named = [(script_date(script), script) for script in scripts]
+            undated = [script for day, script in named if day is None]
+            if undated:
+                raise Exception("No date found in script names: %s" % ", ".join(undated))
+            scripts = dict(named)
+
+        job_ids = {}
+        if skip_active:
+            for day, job in self.jobs_by_date(ACTIVE_STATUSES).items():
+                if day in scripts:
+                    log.info("Skipping %s, job %s is %s" % (day, job.job_id, job.job_status))
+                    job_ids[day] = job.job_id
+
+        pending = sorted(day for day in scripts if day not in job_ids)
+        submitted = self._bulk(lambda day: self.submit_job(scripts[day]), pending, max_parallel, rate)
+        log.info("Submitted %d of %d jobs" % (len(submitted), len(pending)))
+
+        job_ids.update(submitted)
+        return job_ids
+
+    def submit_range(self, template, start, end, **kwargs):
+        """
+        Submit one script per day of a date range
+
+        Arguments
+        ---------
+        template: str
+            script name with strftime codes, e.g. flexpart_local_%Y%m%d.sh
+        start: date
+            first day
+        end: date
+            last day, included
+
+        Other arguments are those of submit_jobs.
+
+        Return
+        ------
+        job_ids: dict
+            date to its job id
+        """
+        scripts = dict((day, day.strftime(template)) for day in date_range(start, end))
+        return self.submit_jobs(scripts, **kwargs)
+
+    def delete_jobs(self, start, end, statuses=None, max_parallel=4, rate=None):
+        """
+        Delete the jobs of a date range
+
+        Arguments
+        ---------
+        start: date
+            first simulated day
+        end: date
+            last simulated day, included
+        statuses: list of str
+            only delete jobs in these statuses, all by default
+        max_parallel: int
+            deletions running at the same time
+        rate: float
+            deletions started per second, no limit if None
+
+        Return
+        ------
+        job_ids: dict
+            date to the deleted job id
+        """
+        table = self.get_job_table()
+        rows = table.select(status=statuses or None, start=start, end=end)
+        targets = dict((table.job_ids[row], table.simulation_date(row)) for row in rows)
+
+        deleted = self._bulk(self.delete_job, sorted(targets), max_parallel, rate)
+        log.info("Deleted %d of %d jobs" % (len(deleted), len(targets)))
+
+        return dict((targets[job_id], job_id) for job_id in deleted)
+
+    def close(self):
+        self.runner.close()
 
-        
 
 class EcmwfJob(object):
     """
@@ -126,8 +728,10 @@ class EcmwfJob(object):
     "STOP": "Jobs have NOT completed (error)",
     "DONE": "Jobs have successfully completed"}
 
-    def __init__(self, _job_id=None, _gateway=None, _job_status="DONE", _scriptName=None, _date=None, _simulation_date=None, _run_number=None):
+    def __init__(self, _job_id=None, _gateway=None, _job_status="DONE", _scriptName=None, _date=None, _simulation_date=None, _run_number=None,
+                 _pattern=None):
         """
+        _pattern: FilenamePattern of the outputs, EN + YYMMDD + three hourly steps by default
         """
         if _date and not isinstance(_date, datetime):
             raise Exception("Experiment's date must be datetime type")
@@ -145,6 +749,7 @@ class EcmwfJob(object):
         self.date = _date
         self.simulation_date = _simulation_date
         self.run_number = _run_number       
+        self.pattern = _pattern or DEFAULT_PATTERN
         
     @classmethod
     def from_vector(cls, vect):        
@@ -162,39 +767,37 @@ class EcmwfJob(object):
         unknown,
         script name
         """
-        if len(toParse) is not 9:
+        if len(vect) != 9:
             raise Exception("9 Params expected")
 
-        job_id = int(toParse[0])
-        gateway = toParse[1]
-        job_status = toParse[2]
-        run_number = toParse[3]
+        job_id = int(vect[0])
+        gateway = vect[1]
+        job_status = vect[2]
+        run_number = vect[3]
 
-        # include current year
-        str_date = toParse[4:7] + ["2014"]
-        date = datetime.strptime(' '.join(str_date), "%b %d %H:%M %Y" )
+        # the listing has no year, take the latest one not in the future
+        submit_date = submit_datetime(vect[4], vect[5], vect[6])
 
-        script_name = toParse[8]
+        script_name = vect[8]
 
-        # convert filename to date in string (e.g (SOMETHING_local_20140201.sh) to 20140201)
-        str_date = script_name.split("_")[2].split(".")[0]
-        # set to date object
-                
-        print(str_date)
-        simulation_date = date(int(str_date[0:4]), int(str_date[4:6]), int(str_date[6:8]))
-        return cls(_job_id = job_id, _gateway = gateway, _job_status = job_status, _run_number=run_number, _date = date,
+        # convert filename to date (e.g (SOMETHING_local_20140201.sh) to 2014-02-01)
+        simulation_date = script_date(script_name)
+        return cls(_job_id = job_id, _gateway = gateway, _job_status = job_status, _run_number=run_number, _date = submit_date,
              _simulation_date=simulation_date, _scriptName=script_name)
         
     @classmethod
-    def from_date(cls, str_date):
+    def from_date(cls, str_date, pattern=None):
         """
         Initialize EcmJob with only its generated outputs
+
+        str_date is written in the date format of pattern
         """        
+        pattern = pattern or DEFAULT_PATTERN
         job_status = "DONE"
-        date = datetime.strptime(str_date, "%y%m%d")
-        simulation_date = date.strptime(str_date, "%y%m%d")
+        date = datetime.strptime(str_date, pattern.date_format)
+        simulation_date = date
         
-        return cls(_job_status = job_status, _date = date, _simulation_date=simulation_date)   
+        return cls(_job_status = job_status, _date = date, _simulation_date=simulation_date, _pattern=pattern)   
 
     def __repr__(self):
         output="Job id: %s\n" % str(self.job_id)
@@ -220,11 +823,4 @@ class EcmwfJob(object):
         """
         return a list with those expected file names
         """
-        output=[]
-        steps=["00","03","06","09","12","15","18","21"]
-        name = self.date.strftime("%y%m%d")
-        
-        for step in steps:
-            output.append("EN%s%s" % (name, step))
-
-        return output
+        return self.pattern.filenames(self.date)
@@ -0,0 +1,245 @@
+"""
+GRIB message index built while a file is downloaded.
+
+GribIndexer is a stream consumer (see automatization.streams) reading only
+the section headers of every GRIB edition 1 or 2 message as chunks go by.
+Its result is written as a sidecar index next to the file, so readers seek
+straight to a field instead of scanning the file:
+
+    dmsites = DataManager(ftp, sitesArgs, _grib_index=True)
+
+    for message in load_index("/some/local/path/2014/05/10/EN14051000.idx"):
+        infile.seek(message["offset"])
+        data = infile.read(message["length"])
+
+"""
+
+import os
+import json
+
+
+INDEX_SUFFIX = ".idx"
+INDEX_FIELDS = ["offset", "length", "edition", "param", "level_type", "level", "step"]
+
+# bytes searched at once while looking for the next message
+SCAN_BLOCK = 4096
+
+
+class GribIndexer(object):
+    """
+    Stream consumer listing the GRIB messages of a file with their
+    parameter, level and step
+    """
+    name = "grib_index"
+
+    def __init__(self):
+        # absolute stream offset of the next chunk
+        self.position = 0
+        # current request: absolute offset, length and whether a short
+        # answer is accepted at the end of the stream
+        self.request = None
+        self.pending = bytearray()
+        # last bytes received by the parser and their offset, so it can
+        # read again the end of its previous request
+        self.window = b""
+        self.window_offset = 0
+        self.messages = []
+        self.parser = self._parse()
+        self.request = next(self.parser)
+
+    def update(self, chunk):
+        start = self.position
+        self.position += len(chunk)
+
+        while self.request is not None:
+            offset, length, _ = self.request
+            # first byte still missing of the request
+            needed = offset + len(self.pending)
+            if needed >= self.position:
+                return
+            begin = max(needed, start) - start
+            end = min(offset + length, self.position) - start
+            self.pending += chunk[begin:end]
+            if len(self.pending) < length:
+                return
+            self._answer()
+
+    def _answer(self):
+        data, self.pending = bytes(self.pending), bytearray()
+        try:
+            self.request = self.parser.send(data)
+        except StopIteration:
+            self.request = None
+
+    def result(self):
+        """
+        Return
+        ------
+        messages: list of list
+            values of INDEX_FIELDS for each complete message
+        """
+        # the stream is over, a scan may end with less than a block
+        if self.request is not None and self.request[2] and self.pending:
+            self._answer()
+        return [m for m in self.messages if m[0] + m[1] <= self.position]
+
+    def _read(self, offset, length):
+        """
+        Generator returning length bytes at offset, from the window when
+        possible, otherwise asking only for the bytes after it
+        """
+        window_end = self.window_offset + len(self.window)
+        if offset < self.window_offset:
+            raise Exception("GRIB parser went back before offset %d" % self.window_offset)
+
+        if offset < window_end:
+            if offset + length > window_end:
+                more = yield (window_end, offset + length - window_end, False)
+                self.window = self.window[offset - self.window_offset:] + more
+                self.window_offset = offset
+            start = offset - self.window_offset
+            return self.window[start:start + length]
+
+        data = yield (offset, length, False)
+        self.window, self.window_offset = data, offset
+        return data
+
+    def _parse(self):
+        """
+        Generator yielding the (offset, length, partial) byte ranges it
+        needs, in increasing order, and receiving their content
+        """
+        offset = 0
+        while True:
+            # look for the start of the next message
+            while True:
+                window_end = self.window_offset + len(self.window)
+                if self.window_offset <= offset < window_end:
+                    found = self.window.find(b"GRIB", offset - self.window_offset)
+                    if found >= 0:
+                        offset = self.window_offset + found
+                        break
+                    # the magic may straddle two blocks
+                    offset = max(offset, window_end - 3)
+                    keep = self.window[offset - self.window_offset:]
+                    start = window_end
+                else:
+                    keep = b""
+                    start = offset
+
+                block = yield (start, SCAN_BLOCK, True)
+                if not block:
+                    return
+                self.window, self.window_offset = keep + block, offset
+
+            header = yield from self._read(offset, 16)
+            edition = header[7]
+
+            if edition == 1:
+                message = yield from self._parse_grib1(offset, header)
+            elif edition == 2:
+                message = yield from self._parse_grib2(offset, header)
+            else:
+                message = None
+
+            if message is None or message[1] < 8:
+                # not a real message, keep looking after the magic
+                offset += 4
+                continue
+
+            self.messages.append(message)
+            offset += message[1]
+
+    def _parse_grib1(self, offset, header):
+        length = int.from_bytes(header[4:7], "big")
+
+        pds = yield from self._read(offset + 8, 28)
+        pds_length = int.from_bytes(pds[0:3], "big")
+        flags = pds[7]
+        param = pds[8]
+        level_type = pds[9]
+        level = int.from_bytes(pds[10:12], "big")
+        p1, p2, time_range = pds[18], pds[19], pds[20]
+        if time_range == 10:
+            step = p1 * 256 + p2
+        elif time_range in (0, 1):
+            step = p1
+        else:
+            step = p2
+
+        if length & 0x800000:
+            # ECMWF large message: length counted in 120 byte units,
+            # corrected with the length of the data section
+            position = offset + 8 + pds_length
+            if flags & 0x80:
+                section = yield from self._read(position, 3)
+                position += int.from_bytes(section, "big")
+            if flags & 0x40:
+                section = yield from self._read(position, 3)
+                position += int.from_bytes(section, "big")
+            section = yield from self._read(position, 3)
+            data_length = int.from_bytes(section, "big")
+            if data_length < 120:
+                length = (length & 0x7fffff) * 120 - data_length + 4
+
+        return [offset, length, 1, str(param), level_type, level, step]
+
+    def _parse_grib2(self, offset, header):
+        length = int.from_bytes(header[8:16], "big")
+        discipline = header[6]
+        end = offset + length
+        position = offset + 16
+
+        # walk the sections up to the first product definition
+        while position + 5 <= end:
+            section = yield from self._read(position, 5)
+            if section[:4] == b"7777":
+                break
+            section_length = int.from_bytes(section[0:4], "big")
+            if section_length < 5:
+                return None
+
+            if section[4] == 4:
+                product = yield from self._read(position, min(section_length, 34))
+                param = "%d.%d.%d" % (discipline, product[9], product[10])
+                step = int.from_bytes(product[18:22], "big") if len(product) >= 22 else 0
+                level_type = product[22] if len(product) > 22 else 255
+                level = int.from_bytes(product[24:28], "big") if len(product) >= 28 else 0
+                return [offset, length, 2, param, level_type, level, step]
+
+            position += section_length
+
+        return [offset, length, 2, "%d" % discipline, 255, 0, 0]
+
+
+def write_index(filepath, messages):
+    """
+    Write the sidecar index of a GRIB file, atomically
+
+    Arguments
+    ---------
+    filepath: str
+        local GRIB file, the index is filepath + INDEX_SUFFIX
+    messages: list of list
+        GribIndexer result
+    """
+    index_filepath = filepath + INDEX_SUFFIX
+    tmp_filepath = index_filepath + ".tmp"
+    with open(tmp_filepath, "w") as outfile:
+        json.dump({"file": os.path.basename(filepath), "fields": INDEX_FIELDS, "messages": messages},
+                  outfile, separators=(",", ":"))
+    os.replace(tmp_filepath, index_filepath)
+
+
+def load_index(index_filepath):
+    """
+    Read a sidecar index
+
+    Return
+    ------
+    messages: list of dict
+        INDEX_FIELDS of every message, in file order
+    """
+    with open(index_filepath) as infile:
+        index = json.load(infile)
+    return [dict(zip(index["fields"], message)) for message in index["messages"]]
@@ -0,0 +1,246 @@
+"""
+Metrics of the transfer stack in Prometheus text format.
+
+FTPManager, AsyncFTPManager and DataManager record their phase timings and
+per site counters in the module REGISTRY unless given their own one. The
+registry can be served locally or dumped to a file, e.g. for the node
+exporter textfile collector:
+
+    from automatization import metrics
+
+    metrics.REGISTRY.serve(9108)
+    metrics.REGISTRY.dump("/var/lib/node_exporter/ecmwf.prom")
+
+"""
+
+import os
+import time
+import bisect
+import threading
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# seconds, from a LAN round trip to a slow transfer
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# bytes per second, from 64 KiB/s to 1 GiB/s
+RATE_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(8))
+
+
+class Metric(object):
+    """
+    Family of samples sharing a name, one per set of label values
+    """
+
+    def __init__(self, _name, _kind, _help, _buckets=None):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _name: str
+            metric name
+        _kind: str
+            counter, gauge or histogram
+        _help: str
+            description
+        _buckets: tuple of float
+            upper bounds of histogram buckets
+        """
+        if _kind not in ("counter", "gauge", "histogram"):
+            raise Exception("Unknown metric type %s" % _kind)
+
+        self.name = _name
+        self.kind = _kind
+        self.help = _help
+        self.buckets = tuple(_buckets or TIME_BUCKETS)
+        # sorted label items to value, or to [bucket counts, sum, count]
+        self.samples = {}
+
+    def update(self, labels, value, mode):
+        key = tuple(sorted(labels.items()))
+
+        if self.kind == "histogram":
+            sample = self.samples.get(key)
+            if sample is None:
+                sample = self.samples[key] = [[0] * len(self.buckets), 0.0, 0]
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                sample[0][position] += 1
+            sample[1] += value
+            sample[2] += 1
+        elif mode == "set":
+            self.samples[key] = value
+        else:
+            self.samples[key] = self.samples.get(key, 0) + value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+
+        for key, sample in sorted(self.samples.items()):
+            if self.kind != "histogram":
+                lines.append("%s%s %s" % (self.name, format_labels(key), format_value(sample)))
+                continue
+
+            counts, total, count = sample
+            cumulative = 0
+            for bound, amount in zip(self.buckets, counts):
+                cumulative += amount
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(key + (("le", format_value(bound)),)), cumulative))
+            lines.append("%s_bucket%s %d" % (self.name, format_labels(key + (("le", "+Inf"),)), count))
+            lines.append("%s_sum%s %s" % (self.name, format_labels(key), format_value(total)))
+            lines.append("%s_count%s %d" % (self.name, format_labels(key), count))
+
+        return "\n".join(lines)
+
+
+def format_labels(items):
+    if not items:
+        return ""
+    escaped = ('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in items)
+    return "{%s}" % ",".join(escaped)
+
+
+def format_value(value):
+    if float(value).is_integer():
+        return "%d" % value
+    return repr(float(value))
+
+
+class MetricsRegistry(object):
+    """
+    Thread safe set of metrics
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, kind, help, buckets=None):
+        """
+        Declare a metric, doing nothing if it already exists
+        """
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Metric(name, kind, help, buckets)
+            return self.metrics[name]
+
+    def _update(self, name, value, mode, labels):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                raise Exception("Metric %s is not registered" % name)
+            metric.update(labels, value, mode)
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase a counter or gauge
+        """
+        self._update(name, value, "inc", labels)
+
+    def set(self, name, value, **labels):
+        """
+        Set a gauge
+        """
+        self._update(name, value, "set", labels)
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value to a histogram
+        """
+        self._update(name, value, "observe", labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the seconds spent in a block, also when it fails
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def render(self):
+        """
+        Return
+        ------
+        text: str
+            every metric in Prometheus text exposition format
+        """
+        with self.lock:
+            return "\n".join(m.render() for _, m in sorted(self.metrics.items())) + "\n"
+
+    def dump(self, path):
+        """
+        Write the metrics to a file, atomically
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as outfile:
+            outfile.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serve the metrics over http in a daemon thread
+
+        Arguments
+        ---------
+        port: int
+            tcp port, 0 picks a free one
+        host: str
+            address to bind
+
+        Return
+        ------
+        server: ThreadingHTTPServer
+            call shutdown() to stop it
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+        thread.start()
+        return server
+
+
+def register_defaults(registry):
+    """
+    Declare the metrics recorded by the ftp managers, DataManager and Daemon
+    """
+    registry.register("ftp_phase_seconds", "histogram", "FTP command time by phase (connect, login, cwd, list, size, retr, dele)")
+    registry.register("ftp_retr_first_byte_seconds", "histogram", "Time from RETR to the first data byte")
+    registry.register("ftp_transfer_bytes_per_second", "histogram", "Throughput of each file transfer", RATE_BUCKETS)
+    registry.register("ftp_bytes_total", "counter", "Bytes received")
+    registry.register("ftp_connections_total", "counter", "Sessions opened")
+    registry.register("datamanager_polls_total", "counter", "getJobs calls")
+    registry.register("datamanager_poll_seconds", "histogram", "getJobs time")
+    registry.register("datamanager_cycle_seconds", "histogram", "Whole download cycle time")
+    registry.register("datamanager_jobs", "gauge", "Days found on the last poll by state")
+    registry.register("datamanager_files_downloaded_total", "counter", "Files downloaded and verified")
+    registry.register("datamanager_bytes_downloaded_total", "counter", "Bytes downloaded")
+    registry.register("datamanager_files_deleted_total", "counter", "Remote files deleted")
+    registry.register("datamanager_errors_total", "counter", "Failed transfers")
+    registry.register("datamanager_retry_queue", "gauge", "Files waiting for a retry")
+    registry.register("datamanager_mirror_errors_total", "counter", "Copies not written to a mirror destination")
+    registry.register("daemon_poll_interval_seconds", "gauge", "Current poll interval of each site")
+    return registry
+
+
+REGISTRY = register_defaults(MetricsRegistry())
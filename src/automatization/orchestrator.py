@@ -0,0 +1,225 @@
+"""
+Run many sites at once.
+
+Sites (EcmwfInput) are grouped by ftp host so they share one pool of
+sessions per host, and every transfer takes a slot from a global budget
+handed out in turn to each site, so a slow or huge site cannot starve the
+others.
+
+    sites = [EcmwfInput("climasites", "input data for climasites", "/remote_path", "/some/local/path/YEAR/MONTH/DAY/"),
+             EcmwfInput("other", "other site", "/other_path", "/other/local/path/YEAR/MONTH/DAY/")]
+
+    orchestrator = Orchestrator(sites, "ftp.site.com", "user", "password", _max_transfers=8)
+    orchestrator.download()
+
+"""
+
+import threading
+import logging as log
+
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from automatization.datamanager import FTPManager, DataManager
+from automatization.scheduler import TokenBucket, CircuitBreaker
+
+
+class FairBudget(object):
+    """
+    Global number of transfer slots, granted round robin between the sites
+    waiting for one.
+    """
+
+    def __init__(self, _slots):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _slots: int
+            transfers allowed at the same time over all sites
+        """
+        if _slots < 1:
+            raise Exception("At least one slot is required")
+
+        self.slots = _slots
+        self.free = _slots
+        self.cond = threading.Condition()
+        # sites with pending requests, in turn order
+        self.turn = deque()
+        self.waiting = {}
+
+    def acquire(self, site):
+        """
+        Wait for a slot on behalf of a site
+
+        Arguments
+        ---------
+        site: str
+            site name
+        """
+        with self.cond:
+            if not self.waiting.get(site):
+                self.turn.append(site)
+            self.waiting[site] = self.waiting.get(site, 0) + 1
+
+            while not (self.free and self.turn[0] == site):
+                self.cond.wait()
+
+            self.free -= 1
+            self.waiting[site] -= 1
+            # go to the back of the line
+            self.turn.popleft()
+            if self.waiting[site]:
+                self.turn.append(site)
+
+            self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.free += 1
+            self.cond.notify_all()
+
+    @contextmanager
+    def slot(self, site):
+        """
+        Hold a slot for a block of work
+        """
+        self.acquire(site)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def queue_depth(self):
+        """
+        Return
+        ------
+        waiting: dict
+            site name to transfers waiting for a slot
+        """
+        with self.cond:
+            return dict((site, count) for site, count in self.waiting.items() if count)
+
+
+class Orchestrator(object):
+    """
+    Manage several EcmwfInput sites sharing connection pools and circuit
+    breakers per host and a global transfer budget
+    """
+
+    def __init__(self, _inputs, _address=None, _user=None, _password=None, _port=21,
+                 _max_sessions=4, _max_transfers=8, _ftp_class=FTPManager, _options=None,
+                 _max_rate=None):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _inputs: list of EcmwfInput
+            sites to manage. Their own host and credentials, when set, take
+            precedence over the default ones.
+        _address: str
+            default ftp host
+        _user: str
+            default ftp user
+        _password: str
+            default ftp password
+        _port: int
+            default ftp port
+        _max_sessions: int
+            sessions allowed per host, shared by the sites of the host
+        _max_transfers: int
+            files transferred at the same time over all sites
+        _ftp_class: class
+            FTPManager or AsyncFTPManager
+        _options: dict
+            extra DataManager arguments applied to every site, e.g.
+            {"_workers": 4, "_eager": True, "_rate_limit": 10 * 1024 * 1024}
+        _max_rate: int
+            bytes per second allowed over all sites
+        """
+        if not _inputs:
+            raise Exception("At least one site is required")
+
+        names = [i.name for i in _inputs]
+        if len(set(names)) != len(names):
+            raise Exception("Site names must be unique")
+
+        self.budget = FairBudget(_max_transfers)
+        self.bucket = TokenBucket(_max_rate) if _max_rate else None
+        # (host, port, user) to its manager
+        self.pools = {}
+        # (host, port, user) to the health of the host, shared by its sites
+        self.breakers = {}
+        self.managers = []
+
+        options = dict(_options or {})
+        if self.bucket is not None:
+            options["_throttles"] = list(options.get("_throttles", [])) + [self.bucket]
+
+        for site in _inputs:
+            host = site.host or _address
+            user = site.user or _user
+            password = site.password or _password
+            port = site.port if site.host else _port
+
+            if not host:
+                raise Exception("No ftp host defined for %s" % site.name)
+
+            key = (host, port, user)
+            if key not in self.pools:
+                self.pools[key] = _ftp_class(host, user, password, _port=port, _max_sessions=_max_sessions)
+                self.breakers[key] = CircuitBreaker()
+
+            self.managers.append(DataManager(self.pools[key], site, _budget=self.budget,
+                                             _breaker=self.breakers[key], **options))
+
+    def _run_site(self, manager, is_simulation):
+        try:
+            manager.download(is_simulation)
+        except Exception as e:
+            # a failing site must not stop the others
+            log.error("Site %s failed: %s" % (manager.input.name, e))
+            return e
+
+    def download(self, is_simulation=False):
+        """
+        Run getJobs and transfers of every site concurrently
+
+        Arguments
+        ---------
+        is_simulation: bool
+            Apply action but with no effect on real data. Test purposes.
+
+        Return
+        ------
+        errors: dict
+            site name to the exception which stopped it, empty if all went fine
+        """
+        with ThreadPoolExecutor(max_workers=len(self.managers)) as executor:
+            results = list(executor.map(lambda m: self._run_site(m, is_simulation), self.managers))
+
+        return dict((m.input.name, e) for m, e in zip(self.managers, results) if e is not None)
+
+    def queue_depth(self):
+        """
+        Live view of the pending work
+
+        Return
+        ------
+        depth: dict
+            site name to {"jobs": completed jobs not transferred yet,
+            "transfers": files waiting for a budget slot}
+        """
+        waiting = self.budget.queue_depth()
+        return dict((m.input.name, {"jobs": m.queue_depth(), "transfers": waiting.get(m.input.name, 0)})
+                    for m in self.managers)
+
+    def close(self):
+        """
+        Close the idle sessions of every pool
+        """
+        for ftp in self.pools.values():
+            ftp.close()
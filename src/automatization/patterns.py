@@ -0,0 +1,130 @@
+"""
+Names of the files produced for every date.
+
+A product writes one file per step and date, named prefix + date + step +
+suffix, e.g. EN14051000 to EN14051021 for the 8 three hourly FLEXPART input
+steps. Steps are numbered by their position so a date keeps the steps found
+as a bitmask.
+
+    hourly = FilenamePattern("EA", "%Y%m%d", ["%02d" % h for h in range(24)])
+    sitesArgs = EcmwfInput("era", "hourly input", "/remote_path", "/some/local/path/YEAR/MONTH/DAY/", _pattern=hourly)
+
+"""
+
+from datetime import datetime
+
+
+THREE_HOURLY = ["00", "03", "06", "09", "12", "15", "18", "21"]
+SIX_HOURLY = ["00", "06", "12", "18"]
+HOURLY = ["%02d" % h for h in range(24)]
+
+
+class FilenamePattern(object):
+    """
+    prefix + date + step + suffix file names
+    """
+
+    def __init__(self, _prefix="EN", _date_format="%y%m%d", _steps=None, _suffix=""):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _prefix: str
+            start of every name
+        _date_format: str
+            strftime format of the date, fixed width
+        _steps: list of str
+            step suffixes expected every date, three hourly by default
+        _suffix: str
+            end of every name, e.g. an extension
+        """
+        steps = list(_steps or THREE_HOURLY)
+        if len(set(steps)) != len(steps):
+            raise Exception("Steps must be unique")
+
+        self.prefix = _prefix
+        self.suffix = _suffix
+        self.date_format = _date_format
+        self.steps = steps
+        self.step_bits = dict((step, 1 << i) for i, step in enumerate(steps))
+        self.full_mask = (1 << len(steps)) - 1
+        self.date_width = len(datetime(2000, 12, 31).strftime(_date_format))
+        # date strings already validated, to their date or None
+        self.dates = {}
+
+    def parse(self, filename):
+        """
+        Split a file name
+
+        Arguments
+        ---------
+        filename: str
+            remote file name
+
+        Return
+        ------
+        parsed: tuple
+            (date string, step), None when the name does not match
+        """
+        if not filename.startswith(self.prefix) or not filename.endswith(self.suffix):
+            return None
+
+        start = len(self.prefix)
+        split = start + self.date_width
+        datestr, step = filename[start:split], filename[split:len(filename) - len(self.suffix)]
+        if step not in self.step_bits:
+            return None
+
+        # cheap lookup of the dates already seen
+        dateobj = self.dates.get(datestr, False)
+        if dateobj is False:
+            dateobj = self.date(datestr)
+        if dateobj is None:
+            return None
+        return datestr, step
+
+    def date(self, datestr):
+        """
+        Return
+        ------
+        dateobj: datetime
+            date of a date string, None if it is not valid
+        """
+        if datestr not in self.dates:
+            try:
+                self.dates[datestr] = datetime.strptime(datestr, self.date_format)
+            except ValueError:
+                self.dates[datestr] = None
+        return self.dates[datestr]
+
+    def datestr(self, dateobj):
+        return dateobj.strftime(self.date_format)
+
+    def filename(self, datestr, step):
+        return self.prefix + datestr + step + self.suffix
+
+    def filenames(self, dateobj):
+        """
+        Return
+        ------
+        filenames: list of str
+            every file expected for a date, in step order
+        """
+        datestr = self.datestr(dateobj)
+        return [self.filename(datestr, step) for step in self.steps]
+
+    def missing(self, datestr, mask):
+        """
+        Return
+        ------
+        filenames: list of str
+            files of a date whose step bit is not set in mask
+        """
+        return [self.filename(datestr, step) for step in self.steps if not mask & self.step_bits[step]]
+
+    def glob(self, dateobj):
+        return self.prefix + self.datestr(dateobj) + "*" + self.suffix
+
+
+DEFAULT_PATTERN = FilenamePattern()
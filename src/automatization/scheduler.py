@@ -0,0 +1,425 @@
+"""
+Transfer scheduling: bandwidth shaping and priority policies.
+
+Rate limits are token buckets charged with every chunk received. A Throttle
+groups the buckets applying to one transfer (e.g. its site and the global
+link) and is passed as a stream consumer to FTPManager.download.
+
+Priority policies turn a job into a sort key, smallest first:
+
+    dmsites = DataManager(ftp, sitesArgs, _rate_limit=20 * 1024 * 1024, _policy=newest_first)
+
+Failed files wait in a RetryQueue with jittered exponential backoff, and a
+CircuitBreaker per host stops new transfers while the host keeps failing.
+
+"""
+
+import time
+import heapq
+import random
+import itertools
+import threading
+
+from datetime import datetime, timedelta
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter, thread safe. Tokens are bytes.
+    """
+
+    def __init__(self, _rate, _burst=None):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _rate: float
+            bytes per second
+        _burst: float
+            bucket capacity, one second of traffic by default
+        """
+        if not _rate or _rate <= 0:
+            raise Exception("Rate must be positive")
+
+        self.rate = float(_rate)
+        self.burst = float(_burst or _rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Take tokens, possibly going in debt
+
+        Arguments
+        ---------
+        amount: int
+            bytes
+
+        Return
+        ------
+        delay: float
+            seconds to wait before using them
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def consume(self, amount):
+        """
+        Take tokens, sleeping until they are available
+        """
+        delay = self.reserve(amount)
+        if delay:
+            time.sleep(delay)
+
+
+class Throttle(object):
+    """
+    Stream consumer slowing a transfer down to the rate of several buckets
+    """
+    name = "throttle"
+
+    def __init__(self, _buckets):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _buckets: list of TokenBucket
+            every bucket is charged with each chunk
+        """
+        self.buckets = [b for b in _buckets if b is not None]
+
+    def reserve(self, amount):
+        """
+        Return
+        ------
+        delay: float
+            seconds to wait, used by the asyncio backend
+        """
+        return max([b.reserve(amount) for b in self.buckets] or [0.0])
+
+    def update(self, chunk):
+        delay = self.reserve(len(chunk))
+        if delay:
+            time.sleep(delay)
+
+    def result(self):
+        return None
+
+
+###################################################################################
+#
+#       Priority policies, smallest key first
+#
+###################################################################################
+
+
+def oldest_first(job):
+    return job.simulation_date
+
+
+def newest_first(job):
+    return -job.simulation_date.toordinal()
+
+
+def earliest_deadline(deadline):
+    """
+    Deadline driven policy, e.g. the next FLEXPART run needing each date
+
+    Arguments
+    ---------
+    deadline: callable
+        returns the datetime a job's data is needed at
+
+    Return
+    ------
+    policy: callable
+    """
+    def policy(job):
+        return deadline(job.simulation_date)
+    return policy
+
+
+def flexpart_deadline(hour=6, delay_days=1):
+    """
+    Deadline of a date for a daily FLEXPART run started at a fixed hour,
+    delay_days after the simulated date
+
+    Arguments
+    ---------
+    hour: int
+        hour of the day the run starts
+    delay_days: int
+        days between the simulated date and the run
+    """
+    def deadline(dateobj):
+        return datetime(dateobj.year, dateobj.month, dateobj.day, hour) + timedelta(days=delay_days)
+    return earliest_deadline(deadline)
+
+
+class TransferScheduler(object):
+    """
+    Priority queue of jobs waiting to be transferred
+    """
+
+    def __init__(self, _policy=oldest_first):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _policy: callable
+            returns the sort key of a job, smallest first
+        """
+        self.policy = _policy
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def push(self, job):
+        with self.lock:
+            heapq.heappush(self.heap, (self.policy(job), next(self.counter), job))
+
+    def pop(self):
+        """
+        Return
+        ------
+        job: EcmwfJob
+            next job by priority, None when empty
+        """
+        with self.lock:
+            if not self.heap:
+                return None
+            return heapq.heappop(self.heap)[2]
+
+    def clear(self):
+        with self.lock:
+            self.heap = []
+
+    def queue_depth(self):
+        """
+        Return
+        ------
+        depth: int
+            jobs waiting
+        """
+        with self.lock:
+            return len(self.heap)
+
+
+###################################################################################
+#
+#       Failure handling
+#
+###################################################################################
+
+
+class RetryQueue(object):
+    """
+    Files waiting for another attempt, with jittered exponential backoff
+    """
+
+    def __init__(self, _base=5, _max_delay=600, _factor=2, _jitter=0.5):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _base: float
+            seconds to wait after the first failure
+        _max_delay: float
+            longest wait
+        _factor: float
+            growth of the wait on every failure
+        _jitter: float
+            fraction of the wait randomized, so retries of many files do not
+            hit the host at the same time
+        """
+        if not 0 <= _jitter <= 1:
+            raise Exception("Jitter must be between 0 and 1")
+
+        self.base = _base
+        self.max_delay = _max_delay
+        self.factor = _factor
+        self.jitter = _jitter
+        # key to (attempts, due time)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def failed(self, key):
+        """
+        Record a failure
+
+        Arguments
+        ---------
+        key: str
+            failed item, e.g. a file name
+
+        Return
+        ------
+        delay: float
+            seconds until the next attempt
+        """
+        with self.lock:
+            attempts = self.entries.get(key, (0, 0))[0] + 1
+            delay = min(self.max_delay, self.base * self.factor ** (attempts - 1))
+            delay = delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
+            self.entries[key] = (attempts, time.monotonic() + delay)
+            return delay
+
+    def postpone(self, key, delay):
+        """
+        Wait before the next attempt without counting a failure, e.g. while
+        the host circuit is open
+
+        Arguments
+        ---------
+        key: str
+            item, e.g. a file name
+        delay: float
+            seconds until the next attempt
+        """
+        with self.lock:
+            attempts, due = self.entries.get(key, (0, 0))
+            self.entries[key] = (attempts, max(due, time.monotonic() + delay))
+
+    def succeeded(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def discard(self, key):
+        """
+        Forget an item which will not be retried, e.g. a file gone from ftp
+        """
+        self.succeeded(key)
+
+    def ready(self, key):
+        """
+        Return
+        ------
+        ready: bool
+            True when the item never failed or its wait is over
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        return entry is None or entry[1] <= time.monotonic()
+
+    def attempts(self, key):
+        with self.lock:
+            return self.entries.get(key, (0, 0))[0]
+
+    def due_in(self, keys=None):
+        """
+        Arguments
+        ---------
+        keys: iterable of str
+            items to consider, all by default
+
+        Return
+        ------
+        delay: float
+            seconds until the first of them can be retried, None if none is waiting
+        """
+        now = time.monotonic()
+        with self.lock:
+            dues = [due for key, (_, due) in self.entries.items() if keys is None or key in keys]
+        if not dues:
+            return None
+        return max(0.0, min(dues) - now)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker(object):
+    """
+    Stop using a host after consecutive failures. Once _reset_timeout has
+    passed a single trial transfer is allowed: success closes the circuit,
+    failure opens it again.
+    """
+
+    def __init__(self, _threshold=5, _reset_timeout=60):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _threshold: int
+            consecutive failures opening the circuit
+        _reset_timeout: float
+            seconds the circuit stays open before a trial
+        """
+        if _threshold < 1:
+            raise Exception("Threshold must be at least 1")
+
+        self.threshold = _threshold
+        self.reset_timeout = _reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Return
+        ------
+        allowed: bool
+            True when a new transfer may start
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened >= self.reset_timeout:
+                # only one trial at a time
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def is_open(self):
+        """
+        Return
+        ------
+        open: bool
+            True when transfers are refused or only a trial is allowed
+        """
+        with self.lock:
+            return self.state != CLOSED
+
+    def remaining(self):
+        """
+        Return
+        ------
+        delay: float
+            seconds until a trial transfer is allowed, 0 when closed
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return 0.0
+            if self.state == HALF_OPEN:
+                # the trial decides, check again after a full timeout
+                return float(self.reset_timeout)
+            return max(0.0, self.opened + self.reset_timeout - time.monotonic())
+
+    def success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.state = OPEN
+                self.opened = time.monotonic()
@@ -0,0 +1,209 @@
+"""
+Durable transfer state, kept in a local SQLite database.
+
+Every remote file goes through these states:
+
+    LISTED -> DOWNLOADING (offset) -> DOWNLOADED (checksum) -> DELETED
+
+DataManager consults it so that after a crash or a kill it resumes exactly
+where it stopped, e.g. only deleting files already downloaded.
+
+    state = TransferState("/var/lib/ecmwf-tools/state.db")
+    dmsites = DataManager(ftp, sitesArgs, _state=state)
+
+"""
+
+import time
+import sqlite3
+import threading
+
+
+LISTED = "LISTED"
+DOWNLOADING = "DOWNLOADING"
+DOWNLOADED = "DOWNLOADED"
+DELETED = "DELETED"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    site TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    day TEXT,
+    state TEXT NOT NULL,
+    offset INTEGER NOT NULL DEFAULT 0,
+    size INTEGER,
+    checksum TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (site, filename)
+);
+CREATE INDEX IF NOT EXISTS transfers_day ON transfers (site, day);
+CREATE INDEX IF NOT EXISTS transfers_state ON transfers (site, state);
+"""
+
+
+class TransferState(object):
+    """
+    Per site and file transfer state store
+    """
+
+    def __init__(self, _path):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _path: str
+            database file, ":memory:" keeps it in memory
+        """
+        if not _path:
+            raise Exception("State database path is not defined")
+
+        self.path = _path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(_path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+
+        with self.lock, self.db:
+            if _path != ":memory:":
+                self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+
+    def listed(self, site, entries):
+        """
+        Record files seen on the remote listing. Files already known keep
+        their state unless they were deleted or their size changed, meaning
+        a new file was produced with the same name.
+
+        Arguments
+        ---------
+        site: str
+            configuration name
+        entries: list of tuple
+            (filename, day, size)
+        """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany("""
+                INSERT INTO transfers (site, filename, day, state, size, updated)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (site, filename) DO UPDATE SET
+                    state = excluded.state, offset = 0, checksum = NULL,
+                    size = excluded.size, updated = excluded.updated
+                WHERE transfers.state = ? OR transfers.size IS NOT excluded.size
+                """, [(site, filename, day, LISTED, size, now, DELETED) for filename, day, size in entries])
+
+    def downloading(self, site, filename, offset=0):
+        """
+        Record a transfer in progress
+
+        Arguments
+        ---------
+        site: str
+            configuration name
+        filename: str
+            remote file name
+        offset: int
+            bytes already on local disk
+        """
+        self._set(site, filename, DOWNLOADING, offset=offset)
+
+    def downloaded(self, site, filename, size, checksum=None):
+        """
+        Record a verified local copy
+
+        Arguments
+        ---------
+        site: str
+            configuration name
+        filename: str
+            remote file name
+        size: int
+            file size
+        checksum: str
+            digest computed while downloading
+        """
+        self._set(site, filename, DOWNLOADED, offset=size, size=size, checksum=checksum)
+
+    def deleted(self, site, filenames):
+        """
+        Record files removed from the remote site
+
+        Arguments
+        ---------
+        site: str
+            configuration name
+        filenames: list of str
+            remote file names
+        """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany("UPDATE transfers SET state = ?, updated = ? WHERE site = ? AND filename = ?",
+                                [(DELETED, now, site, filename) for filename in filenames])
+
+    def _set(self, site, filename, state, **values):
+        values["state"] = state
+        values["updated"] = time.time()
+        columns = sorted(values)
+
+        with self.lock, self.db:
+            cursor = self.db.execute("UPDATE transfers SET %s WHERE site = ? AND filename = ?" %
+                                     ", ".join("%s = ?" % c for c in columns),
+                                     [values[c] for c in columns] + [site, filename])
+            if not cursor.rowcount:
+                columns = columns + ["site", "filename"]
+                values.update(site=site, filename=filename)
+                self.db.execute("INSERT INTO transfers (%s) VALUES (%s)" %
+                                (", ".join(columns), ", ".join("?" * len(columns))),
+                                [values[c] for c in columns])
+
+    def get(self, site, filename):
+        """
+        Return
+        ------
+        record: dict
+            stored columns of the file, None if unknown
+        """
+        with self.lock:
+            row = self.db.execute("SELECT * FROM transfers WHERE site = ? AND filename = ?",
+                                  (site, filename)).fetchone()
+        return dict(row) if row is not None else None
+
+    def state_of(self, site, filename):
+        """
+        Return
+        ------
+        state: str
+            current state of the file, None if unknown
+        """
+        with self.lock:
+            row = self.db.execute("SELECT state FROM transfers WHERE site = ? AND filename = ?",
+                                  (site, filename)).fetchone()
+        return row[0] if row is not None else None
+
+    def day(self, site, day):
+        """
+        Return
+        ------
+        states: dict
+            file name to state of every file of a day
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT filename, state FROM transfers WHERE site = ? AND day = ?",
+                                   (site, day)).fetchall()
+        return dict((row[0], row[1]) for row in rows)
+
+    def files(self, site, state):
+        """
+        Return
+        ------
+        filenames: list of str
+            files of a site in the given state
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT filename FROM transfers WHERE site = ? AND state = ? ORDER BY filename",
+                                   (site, state)).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,102 @@
+"""
+Stream consumers fed chunk by chunk while a file is downloaded.
+
+A consumer has an update(chunk) method called after every block written to
+disk and a result() method returning its value once the transfer ends. They
+are passed to FTPManager.download so no second pass over the data is needed.
+
+    counter = ByteCounter()
+    digest = HashConsumer("sha256")
+    ftp.download(remote_filepath, outfile, consumers=[counter, digest])
+
+"""
+
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+class ByteCounter(object):
+    """
+    Count bytes seen by the stream
+    """
+    name = "bytes"
+
+    def __init__(self):
+        self.count = 0
+
+    def update(self, chunk):
+        self.count += len(chunk)
+
+    def result(self):
+        return self.count
+
+
+class HashConsumer(object):
+    """
+    Compute a digest of the stream
+
+    Any hashlib algorithm is accepted (md5, sha1, sha256, ...), as well as
+    xxh32, xxh64 and xxh3_64 when the xxhash package is installed.
+    """
+
+    def __init__(self, _algorithm="md5"):
+        """
+        Constructor
+
+        Arguments
+        ---------
+        _algorithm: str
+            hash algorithm name
+        """
+        if _algorithm.startswith("xxh"):
+            if xxhash is None:
+                raise Exception("xxhash package is required for %s" % _algorithm)
+            if not hasattr(xxhash, _algorithm):
+                raise Exception("Unknown xxhash algorithm %s" % _algorithm)
+            self.hash = getattr(xxhash, _algorithm)()
+        else:
+            if _algorithm not in hashlib.algorithms_available:
+                raise Exception("Unknown hash algorithm %s" % _algorithm)
+            self.hash = hashlib.new(_algorithm)
+
+        self.name = _algorithm
+
+    def update(self, chunk):
+        self.hash.update(chunk)
+
+    def result(self):
+        return self.hash.hexdigest()
+
+
+def feed_file(consumers, filepath, length, blocksize=1024 * 1024):
+    """
+    Feed the first bytes of an existing file to consumers, used when a
+    transfer is resumed and the consumers must see the data already on disk.
+
+    Arguments
+    ---------
+    consumers: list
+        stream consumers
+    filepath: str
+        local file
+    length: int
+        amount of bytes to feed
+    blocksize: int
+        bytes read per call
+    """
+    if not consumers or not length:
+        return
+
+    with open(filepath, "rb") as infile:
+        remaining = length
+        while remaining > 0:
+            chunk = infile.read(min(blocksize, remaining))
+            if not chunk:
+                break
+            for consumer in consumers:
+                consumer.update(chunk)
+            remaining -= len(chunk)
@@ -0,0 +1,77 @@
+"""
+Shared fixtures: a stand-in FTP server per test, both ftp backends and
+DataManagers on top of them.
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from ftpserver import StandInFTPServer
+from automatization.datamanager import FTPManager, EcmwfInput, DataManager
+from automatization.asyncftp import AsyncFTPManager, EventLoopThread
+from automatization.metrics import MetricsRegistry, register_defaults
+
+
+BACKENDS = {"sync": FTPManager, "async": AsyncFTPManager}
+
+
+@pytest.fixture
+def server():
+    srv = StandInFTPServer().start()
+    yield srv
+    srv.stop()
+
+
+@pytest.fixture
+def registry():
+    return register_defaults(MetricsRegistry())
+
+
+@pytest.fixture
+def loop():
+    loop = EventLoopThread()
+    yield loop
+    loop.stop()
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def make_manager(request, server, registry, loop):
+    """
+    Build managers of the parametrized backend against the server
+    """
+    managers = []
+
+    def make(**kwargs):
+        kwargs.setdefault("_min_segment", 1024)
+        kwargs.setdefault("_metrics", registry)
+        if request.param == "async":
+            kwargs.setdefault("_loop", loop)
+        manager = BACKENDS[request.param]("127.0.0.1", "user", "password", _port=server.port, **kwargs)
+        managers.append(manager)
+        return manager
+
+    make.backend = request.param
+    yield make
+    for manager in managers:
+        manager.close()
+
+
+@pytest.fixture
+def make_datamanager(make_manager, registry, tmp_path):
+    """
+    Build DataManagers of the parametrized backend downloading /r to
+    tmp_path, or with the given EcmwfInput
+    """
+    def make(ftp=None, sitesArgs=None, **kwargs):
+        kwargs.setdefault("_settle_time", 0)
+        kwargs.setdefault("_metrics", registry)
+        sitesArgs = sitesArgs or EcmwfInput("test", "test site", "/r", str(tmp_path) + "/YEAR/MONTH/DAY/")
+        return DataManager(ftp or make_manager(), sitesArgs, **kwargs)
+
+    return make
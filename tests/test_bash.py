@@ -0,0 +1,40 @@
+"""
+Commands run through ProcessRunner and run_bash_cmd.
+"""
+
+import time
+import logging
+
+import pytest
+
+from automatization.bash import ProcessRunner, run_bash_cmd
+
+
+def test_run_bash_cmd_logs_stderr(tmp_path, caplog):
+    script = tmp_path / "bucle_flexpart.sh"
+    script.write_text("#!/bin/sh\npwd\necho \"$1 $2\"\necho \"no input for $1\" >&2\nexit 2\n")
+    script.chmod(0o755)
+
+    with caplog.at_level(logging.INFO):
+        output = run_bash_cmd(str(tmp_path), "./bucle_flexpart.sh 20140510 '1 8'")
+
+    assert output == "%s\n20140510 1 8\n" % tmp_path
+    messages = [(record.levelno, record.getMessage()) for record in caplog.records]
+    assert (logging.INFO, "Running ./bucle_flexpart.sh 20140510 '1 8'...") in messages
+    assert (logging.WARNING, "no input for 20140510") in messages
+    assert (logging.WARNING, "./bucle_flexpart.sh 20140510 '1 8' failed with code 2") in messages
+
+
+def test_failure_raises_with_stderr():
+    with pytest.raises(Exception) as raised:
+        ProcessRunner().run(["sh", "-c", "echo broken >&2; exit 1"])
+
+    assert str(raised.value) == "sh failed with code 1: broken"
+
+
+def test_timeout():
+    started = time.monotonic()
+    result = ProcessRunner(_timeout=0.5).run(["sh", "-c", "sleep 30 & sleep 30"], check=False)
+
+    assert result.timed_out
+    assert time.monotonic() - started < 3
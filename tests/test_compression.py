@@ -0,0 +1,216 @@
+"""
+Codecs fed in chunks, on their own, through CodecWriter and in DataManager.
+"""
+
+import io
+import os
+import bz2
+import gzip
+import json
+import random
+
+import pytest
+
+from ftpserver import synthetic_chunk
+from automatization.compression import get_codec, CodecWriter, OUTPUT_BLOCK, ZstdFrames
+
+
+def compressors():
+    """
+    Reference compress functions of the codecs available here
+    """
+    pack = {"gunzip": gzip.compress, "bunzip2": bz2.compress}
+    try:
+        import zstandard
+    except ImportError:
+        pass
+    else:
+        pack["unzstd"] = zstandard.ZstdCompressor(write_checksum=True).compress
+    try:
+        import lz4.frame
+    except ImportError:
+        pass
+    else:
+        pack["unlz4"] = lz4.frame.compress
+    return pack
+
+
+PACK = compressors()
+UNPACK = {"gzip": gzip.decompress, "bzip2": bz2.decompress}
+if "unzstd" in PACK:
+    import zstandard
+    UNPACK["zstd"] = lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data)
+if "unlz4" in PACK:
+    import lz4.frame
+    UNPACK["lz4"] = lz4.frame.decompress
+
+
+def chunks(data, seed=0):
+    rnd = random.Random(seed)
+    position = 0
+    while position < len(data):
+        size = rnd.choice([1, 10, 1000, 65536])
+        yield data[position:position + size]
+        position += size
+
+
+class Recorder(io.BytesIO):
+    """
+    File keeping the size of the largest write
+    """
+    largest = 0
+
+    def write(self, data):
+        self.largest = max(self.largest, len(data))
+        return io.BytesIO.write(self, data)
+
+
+def run(name, data, seed=0):
+    out = Recorder()
+    seen = []
+
+    class Consumer(object):
+        def update(self, piece):
+            seen.append(bytes(piece))
+
+    writer = CodecWriter(out, get_codec(name), [Consumer()])
+    for chunk in chunks(data, seed):
+        assert writer.write(chunk) == len(chunk)
+    writer.finish()
+
+    assert writer.written == len(out.getvalue())
+    assert b"".join(seen) == out.getvalue()
+    return out
+
+
+PAYLOAD = synthetic_chunk("EN14051000", 0, 300000) + bytes(200000)
+
+
+@pytest.mark.parametrize("name", sorted(PACK))
+def test_decompress(name):
+    assert run(name, PACK[name](PAYLOAD)).getvalue() == PAYLOAD
+
+
+@pytest.mark.parametrize("name", sorted(PACK))
+def test_decompress_members(name):
+    # concatenated members, e.g. files appended to each other
+    data = PACK[name](PAYLOAD[:1000]) + PACK[name](b"") + PACK[name](PAYLOAD)
+
+    assert run(name, data, seed=1).getvalue() == PAYLOAD[:1000] + PAYLOAD
+
+
+@pytest.mark.parametrize("name", sorted(PACK))
+def test_truncated_stream(name):
+    data = PACK[name](PAYLOAD)
+
+    for cut in (1, 4, len(data) // 2):
+        with pytest.raises(Exception) as raised:
+            run(name, data[:-cut])
+        assert "Truncated" in str(raised.value)
+
+
+@pytest.mark.parametrize("name", sorted(PACK))
+def test_empty_stream(name):
+    assert run(name, b"").getvalue() == b""
+
+
+@pytest.mark.parametrize("name", sorted(PACK))
+def test_output_is_bounded(name):
+    # a few KB expanding to 40 MB
+    out = run(name, PACK[name](bytes(40 * OUTPUT_BLOCK)))
+
+    assert len(out.getvalue()) == 40 * OUTPUT_BLOCK
+    assert out.largest <= OUTPUT_BLOCK
+
+
+@pytest.mark.parametrize("name", sorted(UNPACK))
+def test_compress(name):
+    out = run(name, PAYLOAD)
+
+    # finish wrote the end of the stream
+    assert UNPACK[name](out.getvalue()) == PAYLOAD
+
+
+def test_local_names():
+    assert get_codec("gunzip").local_name("EN14051000.gz") == "EN14051000"
+    assert get_codec("gunzip").local_name("EN14051000") == "EN14051000"
+    assert get_codec("bzip2").local_name("EN14051000") == "EN14051000.bz2"
+
+
+def test_unknown_codec():
+    with pytest.raises(Exception):
+        get_codec("rar")
+
+
+def test_zstd_frames():
+    zstandard = pytest.importorskip("zstandard")
+    compressor = zstandard.ZstdCompressor(write_checksum=True, write_content_size=False)
+    stream = compressor.compressobj()
+    # a streamed frame, a skippable frame and a frame of one RLE block
+    data = stream.compress(PAYLOAD) + stream.flush() + \
+        (0x184D2A5A).to_bytes(4, "little") + (6).to_bytes(4, "little") + b"skipme" + \
+        zstandard.ZstdCompressor().compress(bytes(1000))
+
+    frames = ZstdFrames()
+    for chunk in chunks(data, seed=2):
+        frames.update(chunk)
+    assert frames.result()
+
+    frames = ZstdFrames()
+    frames.update(data[:-1])
+    assert not frames.result()
+
+    with pytest.raises(Exception):
+        ZstdFrames().update(b"GRIB")
+
+    assert run("unzstd", data).getvalue() == PAYLOAD + bytes(1000)
+
+
+@pytest.fixture
+def codec_datamanager(make_datamanager, tmp_path):
+    def make(codec, **kwargs):
+        return make_datamanager(_codec=codec, _checksum="md5", **kwargs)
+    return make
+
+
+def manifest(tmp_path):
+    with open(str(tmp_path) + "/2014/05/10.manifest.json") as infile:
+        return json.load(infile)
+
+
+def test_datamanager_gunzip(server, codec_datamanager, tmp_path):
+    data = gzip.compress(PAYLOAD)
+    server.add_file("/r/EN14051000.gz", data=data)
+    dm = codec_datamanager("gunzip")
+    day = str(tmp_path) + "/2014/05/10/"
+    os.makedirs(day)
+
+    dm._transfer_file("EN14051000.gz", day)
+
+    assert os.listdir(day) == ["EN14051000"]
+    with open(day + "EN14051000", "rb") as infile:
+        assert infile.read() == PAYLOAD
+    record = manifest(tmp_path)["EN14051000.gz"]
+    assert record["size"] == len(data)
+    assert record["stored_size"] == len(PAYLOAD)
+    assert record["codec"] == "gunzip"
+
+
+def test_datamanager_gzip_restarts(server, codec_datamanager, tmp_path):
+    server.add_file("/r/EN14051000", data=PAYLOAD)
+    dm = codec_datamanager("gzip")
+    day = str(tmp_path) + "/2014/05/10/"
+    os.makedirs(day)
+    # left by an interrupted transfer, the codec state is lost with it
+    with open(day + "EN14051000.gz.part", "wb") as outfile:
+        outfile.write(b"stale")
+
+    dm._transfer_file("EN14051000", day)
+
+    assert os.listdir(day) == ["EN14051000.gz"]
+    with open(day + "EN14051000.gz", "rb") as infile:
+        stored = infile.read()
+    assert gzip.decompress(stored) == PAYLOAD
+    assert server.counters["bytes"] == len(PAYLOAD)
+    assert manifest(tmp_path)["EN14051000"]["stored_size"] == len(stored)
+    assert dm._is_fetched("140510", "EN14051000")
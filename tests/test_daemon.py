@@ -0,0 +1,68 @@
+"""
+Daemon scheduling with stand-in sites.
+"""
+
+import time
+import threading
+
+from automatization.daemon import Daemon
+
+
+class Pool(object):
+
+    def keepalive_all(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Input(object):
+
+    def __init__(self, _name):
+        self.name = _name
+
+
+class Site(object):
+    """
+    DataManager stand-in whose cycles take a while
+    """
+
+    def __init__(self, _name, _duration, _pool):
+        self.input = Input(_name)
+        self.ftp = _pool
+        self.duration = _duration
+        self.cycles = []
+
+    def cycle(self, is_simulation=False):
+        self.cycles.append(time.monotonic())
+        time.sleep(self.duration)
+        return [], []
+
+
+def test_slow_site_does_not_hold_back_the_others(registry):
+    pool = Pool()
+    slow, fast = Site("slow", 2.0, pool), Site("fast", 0.0, pool)
+    daemon = Daemon([slow, fast], _min_interval=0.2, _max_interval=0.2, _keepalive=0.1, _metrics=registry)
+
+    runner = threading.Thread(target=daemon.run, kwargs={"install_signals": False})
+    runner.start()
+    time.sleep(1.5)
+    daemon.stop()
+    runner.join(5)
+
+    assert not runner.is_alive()
+    assert len(slow.cycles) == 1
+    # polled every 0.2 s while the slow site was still running
+    assert len(fast.cycles) >= 5
+
+
+def test_run_once_waits(registry):
+    pool = Pool()
+    sites = [Site("a", 0.2, pool), Site("b", 0.2, pool)]
+    daemon = Daemon(sites, _metrics=registry)
+
+    assert daemon.run_once(wait=True) == 2
+    assert not daemon.running
+    # not due again before the minimum interval
+    assert daemon.run_once(wait=True) == 0
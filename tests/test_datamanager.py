@@ -0,0 +1,273 @@
+"""
+DataManager transfers against the in-process stand-in server.
+"""
+
+import os
+import json
+import time
+import errno
+import random
+import threading
+import datetime
+
+import pytest
+
+from ftplib import error_perm, error_temp
+
+from ftpserver import FTPHandler, synthetic_chunk
+from automatization.datamanager import FTPManager, is_connection_error
+from automatization.scheduler import CircuitBreaker, RetryQueue
+from automatization.patterns import THREE_HOURLY
+from automatization.grib import INDEX_SUFFIX, load_index
+from test_grib import grib1, grib2
+
+
+def day_path(tmp_path):
+    return str(tmp_path) + "/2014/05/10/"
+
+
+def test_resume_is_not_throttled(server, make_datamanager, tmp_path):
+    size, offset = 510 * 1000, 500 * 1000
+    server.add_file("/r/EN14051000", size=size)
+    os.makedirs(day_path(tmp_path))
+    with open(day_path(tmp_path) + "EN14051000.part", "wb") as outfile:
+        outfile.write(synthetic_chunk("EN14051000", 0, offset))
+    dm = make_datamanager(_rate_limit=100000)
+
+    started = time.monotonic()
+    dm._transfer_file("EN14051000", day_path(tmp_path))
+
+    # only the 10 KB left cross the network and count against the limit
+    assert time.monotonic() - started < 2
+    assert server.counters["bytes"] == size - offset
+    with open(day_path(tmp_path) + "EN14051000", "rb") as infile:
+        assert infile.read() == synthetic_chunk("EN14051000", 0, size)
+
+
+@pytest.mark.parametrize("segments", [1, 2])
+def test_failed_verification_is_not_published(server, make_datamanager, tmp_path, segments):
+    server.add_file("/r/EN14051000", size=5000)
+    checked = []
+
+    def verify(remote_filepath, local_filepath):
+        checked.append(local_filepath)
+        return False
+
+    dm = make_datamanager(_verify=verify, _segments=segments)
+    os.makedirs(day_path(tmp_path))
+
+    with pytest.raises(Exception):
+        dm._transfer_file("EN14051000", day_path(tmp_path))
+
+    assert checked == [day_path(tmp_path) + "EN14051000.part"]
+    assert os.listdir(day_path(tmp_path)) == []
+    assert not os.path.exists(str(tmp_path) + "/2014/05/10.manifest.json")
+    assert not dm._is_fetched("140510", "EN14051000")
+    assert [f.name for f in server.list_dir("/r")] == ["EN14051000"]
+
+
+def test_verified_file_is_published(server, make_datamanager, tmp_path):
+    server.add_file("/r/EN14051000", size=5000)
+    dm = make_datamanager(_verify=lambda remote_filepath, local_filepath: True)
+    os.makedirs(day_path(tmp_path))
+
+    dm._transfer_file("EN14051000", day_path(tmp_path))
+
+    assert sorted(os.listdir(day_path(tmp_path))) == ["EN14051000"]
+    assert dm._is_fetched("140510", "EN14051000")
+    with open(str(tmp_path) + "/2014/05/10.manifest.json") as infile:
+        assert json.load(infile)["EN14051000"]["size"] == 5000
+
+
+@pytest.mark.parametrize("error, counted", [
+    (error_temp("421 too many connections"), True),
+    (ConnectionResetError(errno.ECONNRESET, "reset"), True),
+    (TimeoutError("timed out"), True),
+    (EOFError(), True),
+    (OSError(errno.EHOSTUNREACH, "no route to host"), True),
+    (error_perm("550 no such file"), False),
+    (OSError(errno.ENOSPC, "no space left on device"), False),
+    (Exception("Downloaded EN14051000 does not match the remote file"), False),
+])
+def test_is_connection_error(error, counted):
+    assert is_connection_error(error) == counted
+
+
+def test_bad_file_does_not_open_circuit(server, make_datamanager, tmp_path):
+    server.add_file("/r/EN14051000", size=100)
+    breaker = CircuitBreaker(_threshold=3)
+    dm = make_datamanager(_verify=lambda remote_filepath, local_filepath: False, _breaker=breaker)
+    os.makedirs(day_path(tmp_path))
+
+    for attempt in range(6):
+        assert dm._download_file("EN14051000", day_path(tmp_path)) is None
+
+    assert breaker.allow()
+    assert dm.retries.attempts("EN14051000") == 6
+
+
+def test_connection_failures_open_circuit(make_datamanager, tmp_path):
+    breaker = CircuitBreaker(_threshold=3)
+    # nothing listens on the port
+    dm = make_datamanager(ftp=FTPManager("127.0.0.1", "user", "password", _port=1), _breaker=breaker)
+    os.makedirs(day_path(tmp_path))
+
+    for attempt in range(3):
+        assert dm._download_file("EN14051000", day_path(tmp_path)) is None
+
+    assert not breaker.allow()
+
+
+class NoSizeHandler(FTPHandler):
+    """
+    MLSD without the size fact
+    """
+
+    def ftp_MLSD(self, arg):
+        self.listing(arg, lambda e: "type=file;modify=20140510000000; %s\r\n" % e.name)
+
+
+def test_listing_without_sizes(server, make_datamanager, tmp_path):
+    server.RequestHandlerClass = NoSizeHandler
+    server.populate("/r", 1, 3000, start=datetime.date(2014, 5, 10))
+    dm = make_datamanager()
+
+    dm.download()
+
+    assert sorted(os.listdir(day_path(tmp_path))) == ["EN140510" + step for step in THREE_HOURLY]
+    assert server.list_dir("/r") == []
+
+
+def count_jobs(dm):
+    """
+    Count the _download_job calls of dm
+    """
+    calls = []
+    download_job = dm._download_job
+
+    def counted(*args, **kwargs):
+        calls.append(args[0])
+        return download_job(*args, **kwargs)
+
+    dm._download_job = counted
+    return calls
+
+
+def test_open_circuit_does_not_spin(server, make_datamanager):
+    server.populate("/r", 1, 100, start=datetime.date(2014, 5, 10))
+    breaker = CircuitBreaker(_threshold=1, _reset_timeout=60)
+    breaker.failure()
+    dm = make_datamanager(_breaker=breaker, _retry_window=3)
+    calls = count_jobs(dm)
+
+    started = time.monotonic()
+    dm.cycle()
+
+    assert time.monotonic() - started < 1
+    assert len(calls) == 1
+    # skipped files wait for the circuit, without counting an attempt
+    assert not dm.retries.ready("EN14051000")
+    assert dm.retries.attempts("EN14051000") == 0
+
+
+def test_stale_retry_does_not_spin(server, make_datamanager):
+    server.add_file("/r/EN14050900", size=100)
+    server.populate("/r", 1, 100, start=datetime.date(2014, 5, 10))
+    # one step of a day still running
+    server.add_file("/r/EN14051100", size=100)
+    retries = RetryQueue(_base=10, _jitter=0)
+    dm = make_datamanager(_verify=lambda remote_filepath, local_filepath: False, _retries=retries,
+                          _retry_window=3)
+    dm.getJobs()
+    # due failures of a file the producer then removed and of the running day
+    retries.entries["EN14050900"] = (1, time.monotonic())
+    retries.entries["EN14051100"] = (1, time.monotonic())
+    server.remove_file("/r/EN14050900")
+    calls = count_jobs(dm)
+
+    started = time.monotonic()
+    dm.cycle()
+
+    # the failed files of 05/10 are due after the window, nothing to wait for
+    assert time.monotonic() - started < 2
+    assert len(calls) == 1
+    assert retries.attempts("EN14050900") == 0
+    assert retries.attempts("EN14051000") == 1
+
+
+def delete_threads():
+    return [t for t in threading.enumerate() if t.name == "ftp-delete" and t.is_alive()]
+
+
+def test_bad_day_directory_does_not_stop_the_cycle(server, make_datamanager, tmp_path):
+    server.populate("/r", 2, 100, start=datetime.date(2014, 5, 10))
+    os.makedirs(str(tmp_path) + "/2014/05")
+    # a file where the directory of 05/10 goes
+    (tmp_path / "2014" / "05" / "10").write_text("")
+    dm = make_datamanager()
+
+    finished, running = dm.cycle()
+
+    assert len(finished) == 2
+    assert sorted(os.listdir(str(tmp_path) + "/2014/05/11")) == ["EN140511" + step for step in THREE_HOURLY]
+    assert sorted(f.name for f in server.list_dir("/r")) == ["EN140510" + step for step in THREE_HOURLY]
+    assert delete_threads() == []
+
+
+def test_failed_cycle_closes_the_deleter(server, make_datamanager):
+    server.populate("/r", 1, 100, start=datetime.date(2014, 5, 10))
+    dm = make_datamanager()
+
+    def broken(*args, **kwargs):
+        raise Exception("broken")
+
+    dm._download_job = broken
+    for attempt in range(3):
+        with pytest.raises(Exception):
+            dm.cycle()
+
+    assert delete_threads() == []
+
+
+def test_grib_index_is_published(server, make_datamanager, tmp_path):
+    random.seed(3)
+    first = grib1(130, 100, 500, 3, data_size=40000)
+    data = first + grib2(0, 2, 2, 103, 10, 6)
+    server.add_file("/r/EN14051000", data=data)
+    dm = make_datamanager(_grib_index=True)
+    os.makedirs(day_path(tmp_path))
+
+    dm._transfer_file("EN14051000", day_path(tmp_path))
+
+    messages = load_index(day_path(tmp_path) + "EN14051000" + INDEX_SUFFIX)
+    assert [(m["offset"], m["param"], m["step"]) for m in messages] == [(0, "130", 3), (len(first), "0.2.2", 6)]
+
+
+def test_eager_steps_are_deleted_once(server, make_datamanager, tmp_path):
+    early, late = THREE_HOURLY[:4], THREE_HOURLY[4:]
+    for step in early:
+        server.add_file("/r/EN140510" + step, size=3000)
+    dm = make_datamanager(_eager=True)
+
+    # the stable steps of the running day are fetched and stay on ftp
+    finished, running = dm.cycle()
+    assert (len(finished), len(running)) == (0, 1)
+    assert sorted(os.listdir(day_path(tmp_path))) == ["EN140510" + step for step in early]
+    assert (server.counters["RETR"], server.counters.get("DELE", 0)) == (len(early), 0)
+
+    for step in late:
+        server.add_file("/r/EN140510" + step, size=3000)
+    # the new steps are listed once before they are stable
+    finished, running = dm.cycle()
+    assert server.counters.get("DELE", 0) == 0
+    finished, running = dm.cycle()
+
+    assert len(finished) == 1
+    assert sorted(os.listdir(day_path(tmp_path))) == ["EN140510" + step for step in THREE_HOURLY]
+    assert server.counters["RETR"] == len(THREE_HOURLY)
+    assert server.counters["DELE"] == len(THREE_HOURLY)
+    assert server.list_dir("/r") == []
+    assert dm.fetched == {}
+
+    dm.cycle()
+    assert server.counters["DELE"] == len(THREE_HOURLY)
@@ -0,0 +1,197 @@
+"""
+Ecaccess commands against fake ecaccess-* executables put first on PATH.
+"""
+
+import os
+import time
+import stat
+import datetime
+
+import pytest
+
+from automatization.ecaccess import Ecaccess, EcaccessRunner, JobTableParser
+
+
+JOB_LIST = """\
+Job-Id  Queue  Status  Run  Submitted  Tries  Script
+  100 ecgate DONE 1 May 10 12:00 x flex_local_20140102.sh
+  101 ecgate STOP 1 May 10 12:00 x flex_local_20140103.sh
+  102 ecgate EXEC 1 May 10 12:00 x flex_local_20140104.sh
+"""
+
+
+@pytest.fixture
+def fakebin(tmp_path, monkeypatch):
+    """
+    Directory of fake tools on PATH, write them with fakebin.tool(name, body)
+    """
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    monkeypatch.setenv("PATH", str(bindir) + os.pathsep + os.environ["PATH"])
+
+    def tool(name, body):
+        path = bindir / name
+        path.write_text("#!/bin/sh\n" + body)
+        path.chmod(path.stat().st_mode | stat.S_IXUSR)
+
+    class FakeBin(object):
+        pass
+
+    fake = FakeBin()
+    fake.tool = tool
+    fake.path = bindir
+    # every call of a tool appends its arguments here
+    fake.calls = tmp_path / "calls"
+    return fake
+
+
+@pytest.fixture
+def ecaccess():
+    e = Ecaccess(_max_processes=3, _timeout=5, _cache_ttl=60)
+    yield e
+    e.close()
+
+
+def calls(fakebin):
+    if not fakebin.calls.exists():
+        return []
+    return fakebin.calls.read_text().splitlines()
+
+
+def is_running(pid):
+    """
+    Whether pid is alive, killed orphans may linger as zombies
+    """
+    try:
+        with open("/proc/%d/stat" % pid) as infile:
+            return infile.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except IOError:
+        return False
+
+
+def test_job_list(fakebin, ecaccess):
+    fakebin.tool("ecaccess-job-list", "echo list >> %s\ncat <<EOF\n%sEOF\n" % (fakebin.calls, JOB_LIST))
+
+    jobs = ecaccess.get_list_jobs()
+
+    assert [(job.job_id, job.job_status, job.simulation_date) for job in jobs] == [
+        (100, "DONE", datetime.date(2014, 1, 2)),
+        (101, "STOP", datetime.date(2014, 1, 3)),
+        (102, "EXEC", datetime.date(2014, 1, 4))]
+    # the listing is cached
+    ecaccess.get_job_table()
+    assert calls(fakebin) == ["list"]
+
+
+def test_job_list_parsed_while_streaming(fakebin):
+    fakebin.tool("ecaccess-job-list", "echo '  100 ecgate DONE 1 May 10 12:00 x flex_local_20140102.sh'\n"
+                                      "sleep 1\n"
+                                      "echo '  101 ecgate EXEC 1 May 10 12:00 x flex_local_20140103.sh'\n")
+    seen = []
+
+    class Recorder(JobTableParser):
+
+        def update(self, line):
+            seen.append(time.monotonic())
+            JobTableParser.update(self, line)
+
+    started = time.monotonic()
+    table = EcaccessRunner().cached(["ecaccess-job-list"], Recorder)
+
+    assert len(table) == 2
+    assert seen[0] - started < 0.8
+    assert seen[1] - started >= 0.9
+
+
+def test_submit_and_delete(fakebin, ecaccess):
+    fakebin.tool("ecaccess-job-list", "echo list >> %s\n" % fakebin.calls)
+    fakebin.tool("ecaccess-job-submit", "echo submit $1 >> %s\necho 4242\n" % fakebin.calls)
+    fakebin.tool("ecaccess-job-delete", "echo delete $1 >> %s\n" % fakebin.calls)
+
+    ecaccess.get_job_table()
+    assert ecaccess.submit_job("flex_local_20140105.sh") == 4242
+    ecaccess.delete_job(4242)
+    # both changed the jobs, the listing is read again
+    ecaccess.get_job_table()
+
+    assert calls(fakebin) == ["list", "submit flex_local_20140105.sh", "delete 4242", "list"]
+
+
+def test_submit_range_skips_active(fakebin, ecaccess):
+    fakebin.tool("ecaccess-job-list", "cat <<EOF\n%sEOF\n" % JOB_LIST)
+    fakebin.tool("ecaccess-job-submit", "echo submit $1 >> %s\nday=${1%%.sh}\necho 9${day#flex_local_2014010}\n" % fakebin.calls)
+
+    job_ids = ecaccess.submit_range("flex_local_%Y%m%d.sh", datetime.date(2014, 1, 2), datetime.date(2014, 1, 5))
+
+    # 01/02 is done and 01/04 running, 01/03 stopped is submitted again
+    assert sorted(calls(fakebin)) == ["submit flex_local_20140103.sh", "submit flex_local_20140105.sh"]
+    assert job_ids[datetime.date(2014, 1, 2)] == 100
+    assert job_ids[datetime.date(2014, 1, 3)] == 93
+    assert job_ids[datetime.date(2014, 1, 4)] == 102
+    assert job_ids[datetime.date(2014, 1, 5)] == 95
+
+
+def test_delete_jobs(fakebin, ecaccess):
+    fakebin.tool("ecaccess-job-list", "cat <<EOF\n%sEOF\n" % JOB_LIST)
+    fakebin.tool("ecaccess-job-delete", "echo delete $1 >> %s\n" % fakebin.calls)
+
+    deleted = ecaccess.delete_jobs(datetime.date(2014, 1, 3), datetime.date(2014, 1, 4), statuses=["STOP"])
+
+    assert deleted == {datetime.date(2014, 1, 3): 101}
+    assert calls(fakebin) == ["delete 101"]
+
+
+def test_files_list(fakebin, ecaccess):
+    fakebin.tool("ecaccess-file-dir", "echo $1 >> %s\necho EN14051000\necho\necho EN14051003\n" % fakebin.calls)
+
+    assert ecaccess.files_list("ec:/x") == ["EN14051000", "EN14051003"]
+    assert ecaccess.files_list("ec:/x") == ["EN14051000", "EN14051003"]
+    assert calls(fakebin) == ["ec:/x"]
+
+
+def test_download_answers_yes(fakebin, ecaccess):
+    fakebin.tool("ecaccess-file-mget", "read a\nread b\necho \"$a$b $1 $2\" >> %s\n" % fakebin.calls)
+
+    ecaccess.download_data("ec:/x/EN14051000", "/tmp/out")
+
+    assert calls(fakebin) == ["yy ec:/x/EN14051000 /tmp/out"]
+
+
+def test_timeout_kills_the_process_group(fakebin, tmp_path):
+    # the child holds stdout open after its parent is gone
+    fakebin.tool("ecaccess-file-mget", "sleep 30 &\necho $! >> %s\nsleep 30\n" % fakebin.calls)
+    e = Ecaccess(_timeout=1)
+
+    started = time.monotonic()
+    with pytest.raises(Exception) as raised:
+        e.download_data("ec:/x", "/tmp/out")
+
+    assert "timed out" in str(raised.value)
+    assert time.monotonic() - started < 3
+    child = int(calls(fakebin)[0])
+    time.sleep(0.2)
+    assert not is_running(child)
+
+
+def test_failure_raises_with_stderr(fakebin, ecaccess):
+    fakebin.tool("ecaccess-job-delete", "echo 'job 7 not found' >&2\nexit 3\n")
+
+    with pytest.raises(Exception) as raised:
+        ecaccess.delete_job(7)
+
+    assert "code 3" in str(raised.value)
+    assert "job 7 not found" in str(raised.value)
+
+
+def test_concurrency_is_bounded(fakebin):
+    fakebin.tool("ecaccess-file-dir", "sleep 0.5\necho $1\n")
+    e = Ecaccess(_max_processes=2, _cache_ttl=0)
+
+    started = time.monotonic()
+    futures = [e.run_async("files_list", "ec:/x%d" % i) for i in range(4)]
+    results = [future.result() for future in futures]
+    elapsed = time.monotonic() - started
+    e.close()
+
+    assert results == [["ec:/x%d" % i] for i in range(4)]
+    assert 0.9 < elapsed < 2
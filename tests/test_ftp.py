@@ -0,0 +1,261 @@
+"""
+Both ftp backends against the in-process stand-in server. The async
+coroutines are exercised through the blocking interface of
+AsyncFTPManager, and directly where they are awaited by callers.
+"""
+
+import io
+import time
+import asyncio
+import hashlib
+
+import pytest
+
+from ftplib import error_perm, error_temp, error_reply
+
+from ftpserver import FTPHandler, synthetic_chunk
+from automatization.asyncftp import AsyncFTPManager, raise_for_reply
+from automatization.streams import ByteCounter, HashConsumer
+from automatization.scheduler import Throttle, TokenBucket
+
+
+class BusyHandler(FTPHandler):
+    """
+    Refuses to delete files named busy* with a transient reply
+    """
+
+    def ftp_DELE(self, arg):
+        if arg.startswith("busy"):
+            self.reply("450 file busy")
+            return
+        FTPHandler.ftp_DELE(self, arg)
+
+
+def test_list_files(server, make_manager):
+    server.add_file("/r/EN14051000", size=10)
+    server.add_file("/r/EN14051003", size=20)
+
+    assert sorted(make_manager().list_files("/r")) == ["EN14051000", "EN14051003"]
+
+
+@pytest.mark.parametrize("mlsd", [True, False])
+def test_list_entries(server, make_manager, mlsd):
+    server.mlsd = mlsd
+    server.add_file("/r/EN14051000", size=10, mtime=1400000000)
+    server.add_file("/r/EN14051003", size=20, mtime=1400000000)
+    ftp = make_manager()
+
+    entries = ftp.list_entries("/r")
+
+    assert dict((name, entry[0]) for name, entry in entries.items()) == {"EN14051000": 10, "EN14051003": 20}
+    assert ftp.mlsd == mlsd
+    assert server.counters.get("LIST", 0) == (0 if mlsd else 1)
+    # the fallback is remembered
+    ftp.list_entries("/r")
+    assert server.counters.get("MLSD", 0) == (2 if mlsd else 1)
+
+
+def test_download(server, make_manager):
+    server.add_file("/r/EN14051000", size=700000)
+    counter, digest = ByteCounter(), HashConsumer("md5")
+    out = io.BytesIO()
+
+    make_manager(_blocksize=4096).download("/r/EN14051000", out, consumers=[counter, digest])
+
+    expected = synthetic_chunk("EN14051000", 0, 700000)
+    assert out.getvalue() == expected
+    assert counter.result() == 700000
+    assert digest.result() == hashlib.md5(expected).hexdigest()
+
+
+def test_download_rest(server, make_manager):
+    server.add_file("/r/EN14051000", size=100000)
+    out = io.BytesIO()
+
+    make_manager().download("/r/EN14051000", out, rest=12345)
+
+    assert out.getvalue() == synthetic_chunk("EN14051000", 12345, 100000 - 12345)
+    assert server.counters["bytes"] == 100000 - 12345
+
+
+def test_size(server, make_manager):
+    server.add_file("/r/EN14051000", size=4321)
+
+    assert make_manager().size("/r/EN14051000") == 4321
+
+
+def test_delete(server, make_manager):
+    server.add_file("/r/EN14051000", size=1)
+    server.add_file("/r/EN14051003", size=1)
+    ftp = make_manager()
+
+    ftp.delete("/r/EN14051000")
+
+    assert [f.name for f in server.list_dir("/r")] == ["EN14051003"]
+
+
+def test_delete_many(server, make_manager):
+    for step in ("00", "03", "06"):
+        server.add_file("/r/EN140510" + step, size=1)
+    server.add_file("/s/EN14051100", size=1)
+
+    deleted = make_manager().delete_many(["/r/EN14051000", "/r/missing", "/s/EN14051100", "/r/EN14051006"])
+
+    # refused files are skipped, the others still go
+    assert deleted == ["/r/EN14051000", "/s/EN14051100", "/r/EN14051006"]
+    assert [f.name for f in server.list_dir("/r")] == ["EN14051003"]
+    assert server.list_dir("/s") == []
+    assert server.counters["connections"] == 1
+
+
+@pytest.mark.parametrize("size", [0, 1000, 100003])
+def test_download_segmented(server, make_manager, tmp_path, size):
+    server.add_file("/r/EN14051000", size=size)
+    local = str(tmp_path / "EN14051000")
+    seen = []
+
+    received = make_manager(_blocksize=1000).download_segmented("/r/EN14051000", local, segments=4,
+                                                                 progress=lambda name, amount: seen.append(amount))
+
+    assert received == size
+    with open(local, "rb") as infile:
+        assert infile.read() == synthetic_chunk("EN14051000", 0, size)
+    assert not (tmp_path / "EN14051000.seg").exists()
+    if size:
+        assert seen[-1] == size
+
+
+def test_missing_file_is_permanent(server, make_manager):
+    server.add_file("/r/EN14051000", size=1)
+    ftp = make_manager()
+
+    with pytest.raises(error_perm):
+        ftp.size("/r/missing")
+    with pytest.raises(error_perm):
+        ftp.download("/r/missing", io.BytesIO())
+    with pytest.raises(error_perm):
+        ftp.delete("/r/missing")
+
+
+def test_transient_reply(server, make_manager):
+    server.RequestHandlerClass = BusyHandler
+    server.add_file("/r/busy1", size=1)
+
+    with pytest.raises(error_temp):
+        make_manager().delete("/r/busy1")
+    assert server.list_dir("/r")[0].name == "busy1"
+
+
+@pytest.mark.parametrize("code, error", [("450", error_temp), ("421", error_temp), ("550", error_perm),
+                                         ("500", error_perm), ("150", error_reply), ("331", error_reply)])
+def test_raise_for_reply(code, error):
+    with pytest.raises(error) as raised:
+        raise_for_reply(code, "%s text" % code)
+    assert str(raised.value) == "%s text" % code
+
+
+def test_coroutines(server):
+    server.add_file("/r/EN14051000", size=5000)
+    server.add_file("/r/EN14051003", size=10)
+
+    async def main():
+        ftp = AsyncFTPManager("127.0.0.1", "user", "password", _port=server.port)
+        try:
+            entries = await ftp.alist_entries("/r")
+            out = io.BytesIO()
+            await ftp.adownload("/r/EN14051000", out, rest=1000)
+            await ftp.adelete("/r/EN14051003")
+            deleted = await ftp.adelete_many(["/r/EN14051000", "/r/missing"])
+        finally:
+            await ftp.aclose()
+        return entries, out.getvalue(), deleted
+
+    entries, data, deleted = asyncio.run(main())
+
+    assert entries["EN14051000"][0] == 5000
+    assert data == synthetic_chunk("EN14051000", 1000, 4000)
+    assert deleted == ["/r/EN14051000"]
+    assert server.list_dir("/r") == []
+
+
+def test_segmented_throttle_does_not_block_loop(server, tmp_path):
+    server.add_file("/r/EN14051000", size=600000)
+    local = str(tmp_path / "EN14051000")
+
+    async def main():
+        ftp = AsyncFTPManager("127.0.0.1", "user", "password", _port=server.port, _min_segment=1024,
+                              _blocksize=16384)
+        throttle = Throttle([TokenBucket(300000)])
+        gaps = []
+
+        async def ticker():
+            while True:
+                before = time.monotonic()
+                await asyncio.sleep(0.02)
+                gaps.append(time.monotonic() - before)
+
+        task = asyncio.ensure_future(ticker())
+        try:
+            started = time.monotonic()
+            await ftp.adownload_segmented("/r/EN14051000", local, segments=4, throttle=throttle)
+            elapsed = time.monotonic() - started
+        finally:
+            task.cancel()
+            await ftp.aclose()
+        return elapsed, max(gaps)
+
+    elapsed, gap = asyncio.run(main())
+
+    # limited to about 1 s, other coroutines kept running meanwhile
+    assert elapsed > 0.7
+    assert gap < 0.3
+    with open(local, "rb") as infile:
+        assert infile.read() == synthetic_chunk("EN14051000", 0, 600000)
+
+
+class SlowFile(io.BytesIO):
+    """
+    File taking 0.2 s to write every chunk, e.g. a busy NAS
+    """
+
+    def write(self, data):
+        time.sleep(0.2)
+        return io.BytesIO.write(self, data)
+
+
+def test_slow_writer_does_not_block_other_transfers(server):
+    server.add_file("/r/EN14051000", size=5 * 16384)
+    server.add_file("/r/EN14051003", size=5 * 16384)
+
+    async def main():
+        ftp = AsyncFTPManager("127.0.0.1", "user", "password", _port=server.port, _blocksize=16384)
+        slow, fast = SlowFile(), io.BytesIO()
+        done = {}
+        gaps = []
+
+        async def ticker():
+            while True:
+                before = time.monotonic()
+                await asyncio.sleep(0.02)
+                gaps.append(time.monotonic() - before)
+
+        async def fetch(remote_filepath, out):
+            await ftp.adownload(remote_filepath, out, consumers=[HashConsumer("md5")])
+            done[remote_filepath] = time.monotonic() - started
+
+        task = asyncio.ensure_future(ticker())
+        try:
+            started = time.monotonic()
+            await asyncio.gather(fetch("/r/EN14051000", slow), fetch("/r/EN14051003", fast))
+        finally:
+            task.cancel()
+            await ftp.aclose()
+        return done, max(gaps), slow.getvalue(), fast.getvalue()
+
+    done, gap, slow, fast = asyncio.run(main())
+
+    assert done["/r/EN14051003"] < 0.5
+    assert done["/r/EN14051000"] >= 0.9
+    assert gap < 0.15
+    assert slow == synthetic_chunk("EN14051000", 0, 5 * 16384)
+    assert fast == synthetic_chunk("EN14051003", 0, 5 * 16384)
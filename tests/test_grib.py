@@ -0,0 +1,163 @@
+"""
+GribIndexer against synthetic GRIB edition 1 and 2 messages fed in chunks.
+"""
+
+import os
+import random
+
+import pytest
+
+from automatization.grib import GribIndexer, SCAN_BLOCK, INDEX_SUFFIX, write_index, load_index
+
+
+def grib1(param, level_type, level, step, data_size=20, large=False):
+    """
+    GRIB edition 1 message without grid nor bitmap section
+
+    With large, the length is coded as an ECMWF large message: in 120 byte
+    units, corrected by a data section length below 120.
+    """
+    pds = bytearray(28)
+    pds[0:3] = (28).to_bytes(3, "big")
+    pds[8] = param
+    pds[9] = level_type
+    pds[10:12] = level.to_bytes(2, "big")
+    # forecast time in p1, time range indicator 0
+    pds[18] = step
+    length = 8 + 28 + 3 + data_size + 4
+
+    if large:
+        units = (length - 4 + 119) // 120
+        coded_length = 0x800000 | units
+        bds_length = units * 120 - (length - 4)
+    else:
+        coded_length = length
+        bds_length = 3 + data_size
+    bds = bds_length.to_bytes(3, "big") + bytes(random.getrandbits(8) for _ in range(data_size))
+
+    message = b"GRIB" + coded_length.to_bytes(3, "big") + b"\x01" + bytes(pds) + bds + b"7777"
+    assert len(message) == length
+    return message
+
+
+def grib2(discipline, category, number, level_type, level, step, data_size=30):
+    """
+    GRIB edition 2 message with one field
+    """
+    identification = (21).to_bytes(4, "big") + b"\x01" + bytes(16)
+    grid = (15).to_bytes(4, "big") + b"\x03" + bytes(10)
+    product = bytearray(34)
+    product[0:4] = (34).to_bytes(4, "big")
+    product[4] = 4
+    product[9] = category
+    product[10] = number
+    product[18:22] = step.to_bytes(4, "big")
+    product[22] = level_type
+    product[24:28] = level.to_bytes(4, "big")
+    data = (5 + data_size).to_bytes(4, "big") + b"\x07" + bytes(data_size)
+    body = identification + grid + bytes(product) + data + b"7777"
+
+    length = 16 + len(body)
+    return b"GRIB\x00\x00" + bytes([discipline]) + b"\x02" + length.to_bytes(8, "big") + body
+
+
+def index(data, chunk_sizes):
+    """
+    Feed data to a GribIndexer in chunks of the given sizes, cycled
+    """
+    indexer = GribIndexer()
+    position = 0
+    sizes = iter(chunk_sizes)
+    while position < len(data):
+        size = next(sizes)
+        indexer.update(memoryview(data)[position:position + size])
+        position += size
+    return indexer.result()
+
+
+def random_sizes(seed):
+    rnd = random.Random(seed)
+    while True:
+        yield rnd.choice([1, 2, 3, 7, 100, 4095, 4097, 10000])
+
+
+def expected(parts):
+    """
+    Index expected for a list of (bytes, fields) parts, fields None for junk
+    """
+    messages, offset = [], 0
+    for data, fields in parts:
+        if fields is not None:
+            messages.append([offset, len(data)] + fields)
+        offset += len(data)
+    return messages
+
+
+@pytest.fixture
+def parts():
+    random.seed(1)
+    return [
+        (grib1(130, 100, 500, 3), [1, "130", 100, 500, 3]),
+        (grib1(167, 1, 0, 6, data_size=5000), [1, "167", 1, 0, 6]),
+        # padding between messages
+        (bytes(100), None),
+        (grib2(0, 0, 0, 100, 85000, 12), [2, "0.0.0", 100, 85000, 12]),
+        # a magic without a message, an unknown edition
+        (b"junkGRIB\x00\x00\x00\x09junk", None),
+        (grib1(131, 100, 850, 9, large=True), [1, "131", 100, 850, 9]),
+        # the next magic straddles two scan blocks
+        (b"x" * (SCAN_BLOCK - 2), None),
+        (grib2(10, 3, 1, 1, 0, 24, data_size=9000), [2, "10.3.1", 1, 0, 24]),
+    ]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_chunks(parts, seed):
+    data = b"".join(part for part, _ in parts)
+
+    assert index(data, random_sizes(seed)) == expected(parts)
+
+
+@pytest.mark.parametrize("size", [1, 16, 4096, 1 << 20])
+def test_fixed_chunks(parts, size):
+    data = b"".join(part for part, _ in parts)
+
+    assert index(data, iter(lambda: size, None)) == expected(parts)
+
+
+def test_large_message_length():
+    random.seed(2)
+    message = grib1(130, 100, 500, 3, data_size=1000, large=True)
+
+    assert index(message, [len(message)]) == [[0, len(message), 1, "130", 100, 500, 3]]
+
+
+def test_truncated_last_message(parts):
+    data = b"".join(part for part, _ in parts)
+
+    messages = index(data[:-10], random_sizes(0))
+
+    assert messages == expected(parts)[:-1]
+
+
+def test_no_messages():
+    assert index(b"", [1]) == []
+    assert index(b"no grib here" * 1000, random_sizes(0)) == []
+
+
+def test_index_round_trip(parts, tmp_path):
+    data = b"".join(part for part, _ in parts)
+    filepath = str(tmp_path / "EN14051000")
+    with open(filepath, "wb") as outfile:
+        outfile.write(data)
+
+    write_index(filepath, index(data, random_sizes(0)))
+    messages = load_index(filepath + INDEX_SUFFIX)
+
+    assert sorted(os.listdir(str(tmp_path))) == ["EN14051000", "EN14051000" + INDEX_SUFFIX]
+    assert [m["param"] for m in messages] == ["130", "167", "0.0.0", "131", "10.3.1"]
+    with open(filepath, "rb") as infile:
+        for message, (part, fields) in zip(messages, [p for p in parts if p[1] is not None]):
+            infile.seek(message["offset"])
+            assert infile.read(message["length"]) == part
+            assert [message[k] for k in ("edition", "param", "level_type", "level", "step")] == fields
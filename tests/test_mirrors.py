@@ -0,0 +1,202 @@
+"""
+Copies of every download written to more destinations, see MirrorWriter.
+"""
+
+import os
+import errno
+import datetime
+
+import pytest
+
+from ftpserver import synthetic_chunk
+from automatization import datamanager
+from automatization.datamanager import EcmwfInput
+from automatization.diskio import MirrorWriter
+from automatization.patterns import THREE_HOURLY
+
+
+class FullDisk(object):
+    """
+    File whose writes fail, e.g. a full scratch area
+    """
+    closed = False
+
+    def write(self, data):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def close(self):
+        self.closed = True
+
+
+def test_publish(tmp_path):
+    filepath = str(tmp_path / "EN14051000")
+    mirror = MirrorWriter(filepath)
+
+    mirror.update(b"abc")
+    mirror.update(memoryview(b"def"))
+    # nothing under the final name until published
+    assert os.listdir(str(tmp_path)) == ["EN14051000.part"]
+
+    assert mirror.publish()
+    assert mirror.result()
+    assert os.listdir(str(tmp_path)) == ["EN14051000"]
+    with open(filepath, "rb") as infile:
+        assert infile.read() == b"abcdef"
+
+
+def test_failed_write_and_repair(tmp_path):
+    source = str(tmp_path / "source")
+    with open(source, "wb") as outfile:
+        outfile.write(b"abcdef")
+    filepath = str(tmp_path / "EN14051000")
+    mirror = MirrorWriter(filepath)
+    mirror.outfile.close()
+    mirror.outfile = FullDisk()
+
+    mirror.update(b"abc")
+    mirror.update(b"def")
+
+    assert not mirror.result()
+    assert not mirror.publish()
+    assert sorted(os.listdir(str(tmp_path))) == ["source"]
+
+    assert mirror.repair(source)
+    assert mirror.result()
+    with open(filepath, "rb") as infile:
+        assert infile.read() == b"abcdef"
+    assert sorted(os.listdir(str(tmp_path))) == ["EN14051000", "source"]
+
+
+def test_unwritable_destination(tmp_path):
+    mirror = MirrorWriter(str(tmp_path / "missing" / "EN14051000"))
+
+    mirror.update(b"abc")
+
+    assert not mirror.result()
+    assert not mirror.publish()
+    assert not mirror.repair(str(tmp_path / "missing" / "source"))
+
+
+def test_abort(tmp_path):
+    mirror = MirrorWriter(str(tmp_path / "EN14051000"))
+    mirror.update(b"abc")
+
+    mirror.abort()
+
+    assert mirror.outfile.closed
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.fixture
+def mirrored(make_datamanager, tmp_path):
+    """
+    Build DataManagers writing to tmp_path/main and copying to
+    tmp_path/copy1 and tmp_path/copy2
+    """
+    def make(**kwargs):
+        sitesArgs = EcmwfInput("test", "test site", "/r", str(tmp_path) + "/main/YEAR/MONTH/DAY/",
+                               _mirrors=[str(tmp_path) + "/copy%d/YEAR/MONTH/DAY/" % i for i in (1, 2)])
+        return make_datamanager(sitesArgs=sitesArgs, **kwargs)
+    return make
+
+
+def day(tmp_path, root):
+    return str(tmp_path) + "/%s/2014/05/10/" % root
+
+
+def content(tmp_path, root, name="EN14051000"):
+    with open(day(tmp_path, root) + name, "rb") as infile:
+        return infile.read()
+
+
+def test_cycle_copies_to_every_mirror(server, mirrored, tmp_path):
+    server.populate("/r", 1, 3000, start=datetime.date(2014, 5, 10))
+    dm = mirrored()
+
+    dm.cycle()
+
+    names = ["EN140510" + step for step in THREE_HOURLY]
+    for root in ("main", "copy1", "copy2"):
+        assert sorted(os.listdir(day(tmp_path, root))) == names
+        assert content(tmp_path, root) == synthetic_chunk("EN14051000", 0, 3000)
+    assert server.list_dir("/r") == []
+
+
+def test_failed_mirror_is_repaired(server, mirrored, tmp_path, monkeypatch):
+    server.add_file("/r/EN14051000", size=50000)
+    failing = day(tmp_path, "copy1") + "EN14051000"
+
+    class Failing(MirrorWriter):
+
+        def update(self, chunk):
+            if self.filepath == failing:
+                self._fail(OSError(errno.EIO, "I/O error"))
+            MirrorWriter.update(self, chunk)
+
+    monkeypatch.setattr(datamanager, "MirrorWriter", Failing)
+    dm = mirrored()
+
+    assert dm._download_ftp_data(["EN14051000"], day(tmp_path, "main"), None,
+                                 [day(tmp_path, "copy1"), day(tmp_path, "copy2")]) == ["EN14051000"]
+
+    for root in ("main", "copy1", "copy2"):
+        assert os.listdir(day(tmp_path, root)) == ["EN14051000"]
+        assert content(tmp_path, root) == synthetic_chunk("EN14051000", 0, 50000)
+    assert 'datamanager_mirror_errors_total{site="test"} 1' in dm.metrics.render()
+
+
+def test_unavailable_mirror_is_skipped(server, mirrored, tmp_path):
+    server.add_file("/r/EN14051000", size=5000)
+    os.makedirs(str(tmp_path) + "/copy1/2014/05")
+    # a file where the day directory of the first mirror goes
+    with open(str(tmp_path) + "/copy1/2014/05/10", "w"):
+        pass
+    dm = mirrored()
+
+    assert dm._download_ftp_data(["EN14051000"], day(tmp_path, "main"), None,
+                                 [day(tmp_path, "copy1"), day(tmp_path, "copy2")]) == ["EN14051000"]
+
+    assert content(tmp_path, "main") == content(tmp_path, "copy2") == synthetic_chunk("EN14051000", 0, 5000)
+
+
+def test_resumed_bytes_reach_the_mirrors(server, mirrored, tmp_path):
+    size, offset = 100000, 60000
+    server.add_file("/r/EN14051000", size=size)
+    os.makedirs(day(tmp_path, "main"))
+    with open(day(tmp_path, "main") + "EN14051000.part", "wb") as outfile:
+        outfile.write(synthetic_chunk("EN14051000", 0, offset))
+    dm = mirrored()
+
+    dm._download_ftp_data(["EN14051000"], day(tmp_path, "main"), None,
+                          [day(tmp_path, "copy1"), day(tmp_path, "copy2")])
+
+    assert server.counters["bytes"] == size - offset
+    for root in ("main", "copy1", "copy2"):
+        assert content(tmp_path, root) == synthetic_chunk("EN14051000", 0, size)
+
+
+def test_failed_record_aborts_the_mirrors(server, mirrored, tmp_path, monkeypatch):
+    server.add_file("/r/EN14051000", size=5000)
+    writers = []
+
+    class Recorded(MirrorWriter):
+
+        def __init__(self, *args, **kwargs):
+            MirrorWriter.__init__(self, *args, **kwargs)
+            writers.append(self)
+
+    def broken(self, filename, values):
+        raise OSError(errno.EROFS, "Read-only file system")
+
+    monkeypatch.setattr(datamanager, "MirrorWriter", Recorded)
+    monkeypatch.setattr(datamanager.Manifest, "record", broken)
+    dm = mirrored()
+
+    assert dm._download_ftp_data(["EN14051000"], day(tmp_path, "main"), None,
+                                 [day(tmp_path, "copy1"), day(tmp_path, "copy2")]) == []
+
+    assert len(writers) == 2
+    assert all(writer.outfile.closed for writer in writers)
+    assert os.listdir(day(tmp_path, "copy1")) == []
+    assert os.listdir(day(tmp_path, "copy2")) == []
+    assert [f.name for f in server.list_dir("/r")] == ["EN14051000"]
@@ -0,0 +1,147 @@
+"""
+FairBudget slot granting and Orchestrator sharing per host.
+"""
+
+import os
+import time
+import datetime
+import threading
+
+import pytest
+
+from ftplib import error_perm
+
+from automatization.datamanager import FTPManager, EcmwfInput
+from automatization.asyncftp import AsyncFTPManager
+from automatization.orchestrator import FairBudget, Orchestrator
+from automatization.patterns import THREE_HOURLY
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise Exception("Timed out")
+        time.sleep(0.01)
+
+
+def test_round_robin():
+    budget = FairBudget(1)
+    granted = []
+
+    def transfer(site):
+        with budget.slot(site):
+            granted.append(site)
+
+    budget.acquire("main")
+    threads = []
+    for site in ("A", "A", "A", "B"):
+        thread = threading.Thread(target=transfer, args=(site,))
+        thread.start()
+        threads.append(thread)
+        # queue in this order
+        wait_for(lambda: sum(budget.queue_depth().values()) == len(threads))
+
+    assert budget.queue_depth() == {"A": 3, "B": 1}
+    budget.release()
+    for thread in threads:
+        thread.join()
+
+    # B does not wait for every transfer of A
+    assert granted == ["A", "B", "A", "A"]
+    assert budget.queue_depth() == {}
+    assert budget.free == 1
+
+
+def test_slots_bound_concurrency():
+    budget = FairBudget(2)
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def transfer(site):
+        with budget.slot(site):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+
+    threads = [threading.Thread(target=transfer, args=("site%d" % (i % 3),)) for i in range(9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert peak[0] == 2
+    assert budget.free == 2
+
+
+def test_slot_released_on_error():
+    budget = FairBudget(1)
+
+    with pytest.raises(ValueError):
+        with budget.slot("A"):
+            raise ValueError()
+
+    assert budget.free == 1
+
+
+def test_budget_needs_slots():
+    with pytest.raises(Exception):
+        FairBudget(0)
+
+
+def site(name, remote_path, tmp_path, **kwargs):
+    return EcmwfInput(name, name, remote_path, str(tmp_path) + "/%s/YEAR/MONTH/DAY/" % name, **kwargs)
+
+
+def test_pools_and_breakers_per_host(tmp_path):
+    sites = [site("a", "/a", tmp_path), site("b", "/b", tmp_path),
+             site("c", "/c", tmp_path, _user="other"),
+             site("d", "/d", tmp_path, _host="ftp.other.com", _port=2121)]
+
+    orchestrator = Orchestrator(sites, "ftp.site.com", "user", "password")
+
+    a, b, c, d = orchestrator.managers
+    assert a.ftp is b.ftp and a.breaker is b.breaker
+    assert c.ftp is not a.ftp and c.breaker is not a.breaker
+    assert d.ftp is not a.ftp and d.breaker is not a.breaker
+    # the site of another host keeps the default user
+    assert sorted(orchestrator.pools) == [("ftp.other.com", 2121, "user"), ("ftp.site.com", 21, "other"),
+                                          ("ftp.site.com", 21, "user")]
+    assert all(m.budget is orchestrator.budget for m in orchestrator.managers)
+
+
+def test_sites_must_be_valid(tmp_path):
+    with pytest.raises(Exception):
+        Orchestrator([], "ftp.site.com")
+    with pytest.raises(Exception):
+        Orchestrator([site("a", "/a", tmp_path), site("a", "/b", tmp_path)], "ftp.site.com")
+    with pytest.raises(Exception):
+        Orchestrator([site("a", "/a", tmp_path)])
+
+
+@pytest.mark.parametrize("ftp_class", [FTPManager, AsyncFTPManager])
+def test_failing_site_does_not_stop_the_others(server, tmp_path, ftp_class):
+    server.populate("/a", 1, 1000, start=datetime.date(2014, 5, 10))
+    server.populate("/b", 1, 1000, start=datetime.date(2014, 5, 11))
+    # the remote directory of c does not exist
+    sites = [site("a", "/a", tmp_path), site("c", "/c", tmp_path), site("b", "/b", tmp_path)]
+    orchestrator = Orchestrator(sites, "127.0.0.1", "user", "password", _port=server.port, _max_transfers=2,
+                                _ftp_class=ftp_class, _options={"_settle_time": 0, "_workers": 4})
+
+    try:
+        errors = orchestrator.download()
+    finally:
+        orchestrator.close()
+
+    assert list(errors) == ["c"]
+    assert isinstance(errors["c"], error_perm)
+    assert sorted(os.listdir(str(tmp_path) + "/a/2014/05/10")) == ["EN140510" + s for s in THREE_HOURLY]
+    assert sorted(os.listdir(str(tmp_path) + "/b/2014/05/11")) == ["EN140511" + s for s in THREE_HOURLY]
+    assert server.list_dir("/a") == [] and server.list_dir("/b") == []
+    # both sites used the one pool of the host
+    assert len(orchestrator.pools) == 1
+    assert orchestrator.queue_depth() == {"a": {"jobs": 0, "transfers": 0}, "b": {"jobs": 0, "transfers": 0},
+                                          "c": {"jobs": 0, "transfers": 0}}
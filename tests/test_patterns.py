@@ -0,0 +1,81 @@
+"""
+FilenamePattern, alone and driving DataManager.getJobs.
+"""
+
+import os
+import datetime
+
+import pytest
+
+from automatization.datamanager import EcmwfInput
+from automatization.patterns import FilenamePattern, DEFAULT_PATTERN, SIX_HOURLY, THREE_HOURLY
+
+
+SIX = FilenamePattern("EA", "%Y%m%d", SIX_HOURLY, ".grb")
+
+
+@pytest.mark.parametrize("pattern, filename, parsed", [
+    (DEFAULT_PATTERN, "EN14051000", ("140510", "00")),
+    (DEFAULT_PATTERN, "EN14051021", ("140510", "21")),
+    (DEFAULT_PATTERN, "EN14051001", None),
+    (DEFAULT_PATTERN, "EN140510000", None),
+    (DEFAULT_PATTERN, "EA14051000", None),
+    (DEFAULT_PATTERN, "EN14023100", None),
+    (DEFAULT_PATTERN, "ENxx051000", None),
+    (DEFAULT_PATTERN, "EN14051000.tmp", None),
+    (SIX, "EA2014051018.grb", ("20140510", "18")),
+    (SIX, "EA2014051018", None),
+    (SIX, "EA2014051003.grb", None),
+    (SIX, "EA14051018.grb", None),
+    (SIX, "EN2014051018.grb", None),
+])
+def test_parse(pattern, filename, parsed):
+    assert pattern.parse(filename) == parsed
+    # answered from the date cache the second time
+    assert pattern.parse(filename) == parsed
+
+
+def test_filenames():
+    day = datetime.date(2014, 5, 10)
+
+    assert SIX.filenames(day) == ["EA20140510%s.grb" % step for step in SIX_HOURLY]
+    assert SIX.glob(day) == "EA20140510*.grb"
+    assert DEFAULT_PATTERN.glob(day) == "EN140510*"
+    assert DEFAULT_PATTERN.datestr(day) == "140510"
+    assert SIX.date("20140510") == datetime.datetime(2014, 5, 10)
+    assert SIX.date("20140532") is None
+
+
+def test_missing():
+    present = SIX.step_bits["00"] | SIX.step_bits["12"]
+
+    assert SIX.missing("20140510", present) == ["EA2014051006.grb", "EA2014051018.grb"]
+    assert SIX.missing("20140510", SIX.full_mask) == []
+    assert DEFAULT_PATTERN.missing("140510", 0) == ["EN140510" + step for step in THREE_HOURLY]
+
+
+def test_unique_steps():
+    with pytest.raises(Exception):
+        FilenamePattern(_steps=["00", "06", "00"])
+
+
+def test_pattern_drives_datamanager(server, make_datamanager, tmp_path):
+    for step in SIX_HOURLY:
+        server.add_file("/r/EA20140510%s.grb" % step, size=100)
+    for step in ("00", "06"):
+        server.add_file("/r/EA20140511%s.grb" % step, size=100)
+    # names of other products or not of the pattern stay on ftp
+    others = ["EN14051000", "EA2014051003.grb", "EA2014051000", "EA2014051200.grb.tmp", "README"]
+    for name in others:
+        server.add_file("/r/" + name, size=10)
+    sitesArgs = EcmwfInput("test", "test site", "/r", str(tmp_path) + "/YEAR/MONTH/DAY/", _pattern=SIX)
+    dm = make_datamanager(sitesArgs=sitesArgs)
+
+    finished, running = dm.cycle()
+
+    assert [job.simulation_date.date() for job in finished] == [datetime.date(2014, 5, 10)]
+    assert [job.simulation_date.date() for job in running] == [datetime.date(2014, 5, 11)]
+    assert finished[0].get_outputs_filenames() == SIX.filenames(datetime.date(2014, 5, 10))
+    assert sorted(os.listdir(str(tmp_path) + "/2014/05/10")) == SIX.filenames(datetime.date(2014, 5, 10))
+    assert not os.path.exists(str(tmp_path) + "/2014/05/11")
+    assert sorted(f.name for f in server.list_dir("/r")) == sorted(others + ["EA2014051100.grb", "EA2014051106.grb"])
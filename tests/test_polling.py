@@ -0,0 +1,119 @@
+"""
+Incremental polling: sequences of listings classifying dates complete or
+running, see DataManager._update_snapshot.
+"""
+
+import os
+import datetime
+
+from automatization.patterns import THREE_HOURLY
+
+
+MAY_10 = datetime.date(2014, 5, 10)
+MAY_11 = datetime.date(2014, 5, 11)
+
+
+def poll(dm):
+    """
+    Dates found complete and running
+    """
+    finished, running = dm.getJobs()
+    return ([job.simulation_date.strftime("%y%m%d") for job in finished],
+            [job.simulation_date.strftime("%y%m%d") for job in running])
+
+
+def test_first_poll_settles(server, make_datamanager):
+    server.populate("/r", 1, 100, start=MAY_10)
+    dm = make_datamanager(_settle_time=0.1)
+
+    # listed twice, _settle_time apart
+    assert poll(dm) == (["140510"], [])
+    assert server.counters["MLSD"] == 2
+    assert poll(dm) == (["140510"], [])
+    assert server.counters["MLSD"] == 3
+
+
+def test_growing_file_keeps_date_running(server, make_datamanager):
+    server.populate("/r", 1, 100, start=MAY_10)
+    dm = make_datamanager()
+    assert poll(dm) == (["140510"], [])
+
+    server.add_file("/r/EN14051003", size=200)
+    assert poll(dm) == ([], ["140510"])
+
+    server.add_file("/r/EN14051003", size=300)
+    assert poll(dm) == ([], ["140510"])
+
+    # unchanged on a second poll
+    assert poll(dm) == (["140510"], [])
+    assert "EN14051003" in dm.stable
+
+
+def test_new_date_completes_after_unchanged_poll(server, make_datamanager):
+    server.populate("/r", 1, 100, start=MAY_10)
+    dm = make_datamanager()
+    poll(dm)
+
+    server.populate("/r", 1, 100, start=MAY_11)
+    assert poll(dm) == (["140510"], ["140511"])
+    assert poll(dm) == (["140510", "140511"], [])
+
+
+def test_missing_step_keeps_date_running(server, make_datamanager):
+    server.populate("/r", 1, 100, start=MAY_10)
+    server.remove_file("/r/EN14051021")
+    dm = make_datamanager()
+
+    assert poll(dm) == ([], ["140510"])
+    assert poll(dm) == ([], ["140510"])
+
+    server.add_file("/r/EN14051021", size=100)
+    assert poll(dm) == ([], ["140510"])
+    assert poll(dm) == (["140510"], [])
+
+
+def test_removed_files_clear_their_steps(server, make_datamanager):
+    server.populate("/r", 1, 100, start=MAY_10)
+    dm = make_datamanager()
+    poll(dm)
+
+    server.remove_file("/r/EN14051000")
+    server.remove_file("/r/EN14051009")
+    assert poll(dm) == ([], ["140510"])
+    assert sorted(dm.dates_found["140510"]) == sorted(set(THREE_HOURLY) - {"00", "09"})
+    assert dm.present["140510"] == dm.pattern.full_mask & ~dm.pattern.step_bits["00"] & ~dm.pattern.step_bits["09"]
+    assert "EN14051000" not in dm.stable
+
+    for step in THREE_HOURLY:
+        server.remove_file("/r/EN140510" + step)
+    assert poll(dm) == ([], [])
+    assert "140510" not in dm.dates_found
+
+
+def test_deleted_after_download_still_counts(server, make_datamanager, tmp_path):
+    server.populate("/r", 1, 100, start=MAY_10)
+    dm = make_datamanager()
+    poll(dm)
+    day = str(tmp_path) + "/2014/05/10/"
+    assert dm._download_ftp_data(["EN14051000"], day) == ["EN14051000"]
+
+    # removed by the delete pipeline once verified
+    server.remove_file("/r/EN14051000")
+    assert poll(dm) == (["140510"], [])
+    assert os.listdir(day) == ["EN14051000"]
+
+
+def test_unchanged_poll_parses_nothing(server, make_datamanager):
+    server.populate("/r", 3, 100, start=MAY_10)
+    dm = make_datamanager()
+    poll(dm)
+    parsed = []
+    parse = dm.pattern.parse
+    dm.pattern.parse = lambda filename: parsed.append(filename) or parse(filename)
+
+    assert poll(dm) == (["140510", "140511", "140512"], [])
+    assert parsed == []
+
+    server.add_file("/r/EN14051103", size=200)
+    assert poll(dm) == (["140510", "140512"], ["140511"])
+    assert parsed == ["EN14051103"]
@@ -0,0 +1,132 @@
+"""
+TransferState rules, and DataManager resuming from it after a crash.
+"""
+
+import os
+import datetime
+
+import pytest
+
+from automatization.state import TransferState, LISTED, DOWNLOADING, DOWNLOADED, DELETED
+from automatization.patterns import THREE_HOURLY
+
+
+@pytest.fixture
+def state():
+    store = TransferState(":memory:")
+    yield store
+    store.close()
+
+
+def test_listed(state):
+    state.listed("test", [("EN14051000", "140510", 100), ("EN14051003", "140510", 200)])
+
+    assert state.day("test", "140510") == {"EN14051000": LISTED, "EN14051003": LISTED}
+    record = state.get("test", "EN14051000")
+    assert (record["state"], record["size"], record["offset"]) == (LISTED, 100, 0)
+    assert state.get("other", "EN14051000") is None
+
+
+def test_listed_keeps_progress(state):
+    state.listed("test", [("EN14051000", "140510", 100)])
+    state.downloaded("test", "EN14051000", 100, "abc")
+
+    # listed again while still on ftp, e.g. a restart before the delete
+    state.listed("test", [("EN14051000", "140510", 100)])
+
+    record = state.get("test", "EN14051000")
+    assert (record["state"], record["checksum"], record["offset"]) == (DOWNLOADED, "abc", 100)
+
+
+def test_listed_resets_new_file(state):
+    state.listed("test", [("EN14051000", "140510", 100), ("EN14051003", "140510", 100)])
+    state.downloading("test", "EN14051000", 60)
+    state.downloaded("test", "EN14051003", 100, "abc")
+    state.deleted("test", ["EN14051003"])
+
+    # a new file with the same name: other size, or after a delete
+    state.listed("test", [("EN14051000", "140510", 150), ("EN14051003", "140510", 100)])
+
+    for filename, size in (("EN14051000", 150), ("EN14051003", 100)):
+        record = state.get("test", filename)
+        assert (record["state"], record["size"], record["offset"], record["checksum"]) == (LISTED, size, 0, None)
+
+
+def test_set_inserts_unknown_files(state):
+    state.downloading("test", "EN14051000", 10)
+
+    record = state.get("test", "EN14051000")
+    assert (record["state"], record["offset"], record["day"]) == (DOWNLOADING, 10, None)
+
+    state.downloaded("test", "EN14051000", 100, "abc")
+    assert state.files("test", DOWNLOADED) == ["EN14051000"]
+    assert state.files("test", DOWNLOADING) == []
+
+
+def test_deleted(state):
+    state.listed("test", [("EN14051000", "140510", 100), ("EN14051003", "140510", 100)])
+
+    state.deleted("test", ["EN14051003", "unknown"])
+
+    assert state.files("test", DELETED) == ["EN14051003"]
+    assert state.state_of("test", "unknown") is None
+
+
+def test_persistent(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = TransferState(path)
+    store.downloaded("test", "EN14051000", 100, "abc")
+    store.close()
+
+    store = TransferState(path)
+    assert store.state_of("test", "EN14051000") == DOWNLOADED
+    store.close()
+
+
+def test_path_required():
+    with pytest.raises(Exception):
+        TransferState("")
+
+
+def test_resume_after_crash_only_deletes(server, make_datamanager, tmp_path):
+    server.populate("/r", 1, 3000, start=datetime.date(2014, 5, 10))
+    path = str(tmp_path / "state.db")
+    day = str(tmp_path) + "/2014/05/10/"
+    names = ["EN140510" + step for step in THREE_HOURLY]
+
+    # downloaded and verified, killed before any delete
+    store = TransferState(path)
+    dm = make_datamanager(_state=store)
+    dm.getJobs()
+    assert dm._download_ftp_data(names, day) == names
+    store.close()
+    assert sorted(f.name for f in server.list_dir("/r")) == names
+    retrieved = server.counters["RETR"]
+
+    store = TransferState(path)
+    dm = make_datamanager(_state=store)
+    finished, running = dm.cycle()
+
+    assert len(finished) == 1
+    assert server.counters["RETR"] == retrieved
+    assert server.list_dir("/r") == []
+    assert store.files("test", DELETED) == names
+    assert sorted(os.listdir(day)) == names
+    store.close()
+
+
+def test_resume_after_crash_restarts_download(server, make_datamanager, tmp_path):
+    server.populate("/r", 1, 3000, start=datetime.date(2014, 5, 10))
+    path = str(tmp_path / "state.db")
+    day = str(tmp_path) + "/2014/05/10/"
+
+    # recorded as downloaded but the local file is gone, e.g. a lost disk
+    store = TransferState(path)
+    store.downloaded("test", "EN14051000", 3000, "abc")
+    dm = make_datamanager(_state=store)
+    dm.cycle()
+
+    assert sorted(os.listdir(day)) == ["EN140510" + step for step in THREE_HOURLY]
+    assert server.counters["RETR"] == len(THREE_HOURLY)
+    assert server.list_dir("/r") == []
+    store.close()